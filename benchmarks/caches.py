@@ -0,0 +1,118 @@
+# Retort - Simple Python CGI framework.
+# Copyright (C) 2016 Dario Giovannetti <dev@dariogiovannetti.net>
+#
+# This file is part of Retort.
+#
+# Retort is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# Retort is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with Retort.  If not, see <http://www.gnu.org/licenses/>.
+
+"""
+Compare SQLiteCache and FileCache under concurrent processes, e.g. CGI
+processes, each running a mix of reads and writes on a shared set of keys.
+
+    python benchmarks/caches.py [--operations N] [--keys N] [--size BYTES]
+                                [--writes FRACTION]
+"""
+
+from __future__ import (absolute_import, division,
+                        print_function, unicode_literals)
+
+import os
+import sys
+import time
+import random
+import shutil
+import tempfile
+import argparse
+import multiprocessing
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(
+                                                                __file__))))
+
+from retort.cache import SQLiteCache, FileCache  # noqa
+
+
+def make_cache(backend, directory):
+    if backend == 'sqlite':
+        return SQLiteCache(os.path.join(directory, 'cache.db'))
+    return FileCache(os.path.join(directory, 'cache'))
+
+
+def worker(backend, directory, args, start, results):
+    cache = make_cache(backend, directory)
+    value = 'x' * args.size
+    errors = 0
+    start.wait()
+    begin = time.time()
+    for _ in range(args.operations):
+        key = 'key{0}'.format(random.randrange(args.keys))
+        try:
+            if random.random() < args.writes:
+                cache.set(key, value)
+            else:
+                cache.get(key, refresh=lambda: value)
+        except Exception:
+            # E.g. 'database is locked'
+            errors += 1
+    results.put((time.time() - begin, errors))
+
+
+def run(backend, processes, args):
+    directory = tempfile.mkdtemp()
+    try:
+        cache = make_cache(backend, directory)
+        if backend == 'sqlite':
+            cache.create_db_table()
+        start = multiprocessing.Event()
+        results = multiprocessing.Queue()
+        workers = [multiprocessing.Process(target=worker,
+                                           args=(backend, directory, args,
+                                                 start, results))
+                   for _ in range(processes)]
+        for process in workers:
+            process.start()
+        begin = time.time()
+        start.set()
+        outcomes = [results.get() for _ in workers]
+        elapsed = time.time() - begin
+        for process in workers:
+            process.join()
+    finally:
+        shutil.rmtree(directory)
+    slowest = max(duration for duration, errors in outcomes)
+    errors = sum(errors for duration, errors in outcomes)
+    return processes * args.operations / elapsed, slowest, errors
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Cache backend benchmark.')
+    parser.add_argument('--operations', type=int, default=2000,
+                        help='operations per process')
+    parser.add_argument('--keys', type=int, default=200,
+                        help='number of distinct keys')
+    parser.add_argument('--size', type=int, default=2000,
+                        help='bytes per value')
+    parser.add_argument('--writes', type=float, default=0.2,
+                        help='fraction of operations that are writes')
+    args = parser.parse_args()
+
+    print('processes\tbackend\tops_per_s\tslowest_s\terrors')
+    for processes in (1, 8, 32):
+        for backend in ('sqlite', 'file'):
+            ops, slowest, errors = run(backend, processes, args)
+            print('{0}\t{1}\t{2:.0f}\t{3:.2f}\t{4}'.format(
+                                processes, backend, ops, slowest, errors))
+
+
+if __name__ == '__main__':
+    main()
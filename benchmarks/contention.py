@@ -0,0 +1,282 @@
+# Retort - Simple Python CGI framework.
+# Copyright (C) 2016 Dario Giovannetti <dev@dariogiovannetti.net>
+#
+# This file is part of Retort.
+#
+# Retort is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# Retort is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with Retort.  If not, see <http://www.gnu.org/licenses/>.
+
+"""
+Load a single SQLite database with the sessions and the cache of a site
+from N concurrent processes, as CGI processes committing at the same time
+would, and report the throughput, the time spent waiting for the database
+lock and the rate of 'database is locked' errors.
+
+Each process runs a mix of logins (TokenSQLiteSession.initiate),
+identifications with autoextend, SQLiteCache.set_dict and SQLiteCache.get
+with a refresh function. The lock wait of an operation is estimated as its
+mean duration in excess of the mean duration of the same operation in a
+single process, which is run first as the baseline.
+
+Use --pragma, e.g. journal_mode=DELETE or synchronous=FULL, and
+--separate-databases to compare settings, schemas and backends.
+
+    python benchmarks/contention.py [--processes N,...] [--operations N]
+                                    [--mix OPERATION=WEIGHT,...]
+                                    [--pragma NAME=VALUE ...]
+                                    [--separate-databases]
+"""
+
+from __future__ import (absolute_import, division,
+                        print_function, unicode_literals)
+
+import os
+import io
+import sys
+import time
+import random
+import shutil
+import sqlite3
+import tempfile
+import argparse
+import multiprocessing
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(
+                                                                __file__))))
+
+from retort import Retort  # noqa
+from retort import sqlite  # noqa
+from retort.response import Response  # noqa
+from retort.gateway import StreamGateway  # noqa
+from retort.cache import SQLiteCache  # noqa
+from retort.session import TokenSQLiteSession  # noqa
+
+clock = getattr(time, 'perf_counter', time.time)
+
+OPERATIONS = ('login', 'identify', 'set_dict', 'get')
+DEFAULT_MIX = 'login=1,identify=8,set_dict=1,get=10'
+COOKIE_NAME = str('RetortSessionID')
+LIFETIME = 3600
+SESSIONS = 1000
+KEYS = 200
+DICT_KEYS = 5
+VALUE = 'x' * 2000
+
+
+class Workload(object):
+    def __init__(self, directory, args):
+        """
+        The session and the cache of a site, and the operations run on them.
+        """
+        self.cache_path = os.path.join(directory, 'site.db')
+        self.session_path = (os.path.join(directory, 'sessions.db')
+                             if args.separate_databases else self.cache_path)
+        self.pragmas = args.pragmas
+        self.cache = SQLiteCache(self.cache_path, default_timeout=args.ttl,
+                                 lease_wait=0, pragmas=self.pragmas)
+        self.session = TokenSQLiteSession(self.session_path, 'example.com',
+                                          LIFETIME, cookie_name=COOKIE_NAME,
+                                          autoextend=True,
+                                          pragmas=self.pragmas)
+
+    def setup(self):
+        self.cache.create_db_table()
+        self.session.create_db_table()
+        now = int(time.time())
+        conn = sqlite.connect(self.session_path, self.pragmas)
+        # Spread the expiries, so that some of the identifications extend
+        # the session
+        conn.executemany('INSERT INTO Sessions VALUES (?, ?, ?, NULL)',
+                         [('session{0}'.format(index),
+                           now + random.randint(60, LIFETIME),
+                           'user{0}'.format(index))
+                          for index in range(SESSIONS)])
+        conn.commit()
+        sqlite.close_all()
+
+    def _make_app(self, cookie=None):
+        environ = {'PATH_INFO': '/', 'REQUEST_METHOD': 'GET'}
+        if cookie:
+            environ['HTTP_COOKIE'] = str(cookie)
+        app = Retort(cache=self.cache)
+        app.gateway = StreamGateway(environ, None, io.BytesIO())
+        app.response = Response()
+        app.response.post_init(app)
+        return app
+
+    def login(self):
+        app = self._make_app()
+        self.session.process_request(app)
+        self.session.initiate('user')
+
+    def identify(self):
+        app = self._make_app('{0}=session{1}'.format(
+                                COOKIE_NAME, random.randrange(SESSIONS)))
+        self.session.process_request(app)
+
+    def set_dict(self):
+        self.cache.set_dict(dict(('key{0}'.format(random.randrange(KEYS)),
+                                  VALUE) for _ in range(DICT_KEYS)))
+
+    def get(self):
+        self.cache.get('key{0}'.format(random.randrange(KEYS)),
+                       refresh=lambda: VALUE)
+
+    def rollback(self):
+        # A failed write may leave its transaction open
+        for path in (self.cache_path, self.session_path):
+            sqlite.connect(path, self.pragmas).rollback()
+
+
+def parse_mix(mix):
+    weights = []
+    for item in mix.split(','):
+        name, _, weight = item.partition('=')
+        if name not in OPERATIONS:
+            raise ValueError('Unknown operation: {0}'.format(name))
+        weights.append((name, float(weight)))
+    return weights
+
+
+def choose(weights):
+    point = random.random() * sum(weight for name, weight in weights)
+    for name, weight in weights:
+        point -= weight
+        if point < 0:
+            return name
+    return weights[-1][0]
+
+
+def worker(directory, args, start, results):
+    workload = Workload(directory, args)
+    weights = parse_mix(args.mix)
+    # name: ([duration, ...], locked errors, other errors)
+    stats = dict((name, ([], 0, 0)) for name in OPERATIONS)
+    start.wait()
+    begin = clock()
+    for _ in range(args.operations):
+        name = choose(weights)
+        durations, locked, failed = stats[name]
+        operation_begin = clock()
+        try:
+            getattr(workload, name)()
+        except sqlite3.OperationalError as exc:
+            message = '{0}'.format(exc)
+            if 'locked' in message or 'busy' in message:
+                locked += 1
+            else:
+                failed += 1
+            workload.rollback()
+        durations.append(clock() - operation_begin)
+        stats[name] = (durations, locked, failed)
+    results.put((clock() - begin, stats))
+
+
+def run(processes, args):
+    directory = tempfile.mkdtemp()
+    try:
+        Workload(directory, args).setup()
+        start = multiprocessing.Event()
+        results = multiprocessing.Queue()
+        workers = [multiprocessing.Process(target=worker,
+                                           args=(directory, args, start,
+                                                 results))
+                   for _ in range(processes)]
+        for process in workers:
+            process.start()
+        begin = clock()
+        start.set()
+        outcomes = [results.get() for _ in workers]
+        elapsed = clock() - begin
+        for process in workers:
+            process.join()
+    finally:
+        shutil.rmtree(directory)
+
+    stats = dict((name, ([], 0, 0)) for name in OPERATIONS)
+    for _, worker_stats in outcomes:
+        for name, (durations, locked, failed) in worker_stats.items():
+            total = stats[name]
+            stats[name] = (total[0] + durations, total[1] + locked,
+                           total[2] + failed)
+    return elapsed, stats
+
+
+def percentile(values, fraction):
+    values = sorted(values)
+    if not values:
+        return 0.0
+    return values[min(len(values) - 1, int(len(values) * fraction))]
+
+
+def mean(values):
+    return sum(values) / len(values) if values else 0.0
+
+
+def main():
+    parser = argparse.ArgumentParser(
+                        description='SQLite session and cache contention.')
+    parser.add_argument('--processes', default='1,4,12,32',
+                        help='comma-separated numbers of processes')
+    parser.add_argument('--operations', type=int, default=500,
+                        help='operations per process')
+    parser.add_argument('--mix', default=DEFAULT_MIX,
+                        help='relative weights of the operations, '
+                             'default ' + DEFAULT_MIX)
+    parser.add_argument('--ttl', type=int, default=2,
+                        help='cache timeout, so that get() refreshes values')
+    parser.add_argument('--pragma', action='append', default=[],
+                        help='NAME=VALUE applied to the connections, e.g. '
+                             'journal_mode=DELETE')
+    parser.add_argument('--separate-databases', action='store_true',
+                        help='store the sessions and the cache in two files')
+    args = parser.parse_args()
+    args.pragmas = tuple(tuple(pragma.split('=', 1))
+                         for pragma in args.pragma)
+    parse_mix(args.mix)
+
+    # The baseline for the lock wait
+    elapsed, stats = run(1, args)
+    baselines = dict((name, mean(durations))
+                     for name, (durations, _, _) in stats.items())
+
+    print('processes\toperation\tcount\tops_per_s\tp50_ms\tp99_ms\t'
+          'lock_wait_ms\tlock_wait_pct\tlocked_errors\tlocked_pct\t'
+          'other_errors')
+    for processes in [int(value) for value in args.processes.split(',')]:
+        if processes != 1:
+            elapsed, stats = run(processes, args)
+        rows = []
+        for name in OPERATIONS:
+            durations, locked, failed = stats[name]
+            if durations:
+                wait = max(0.0, mean(durations) - baselines[name])
+                rows.append((name, durations, wait * len(durations), locked,
+                             failed))
+        rows.append(('all', [duration for row in rows for duration in row[1]],
+                     sum(row[2] for row in rows), sum(row[3] for row in rows),
+                     sum(row[4] for row in rows)))
+        for name, durations, wait, locked, failed in rows:
+            count = len(durations)
+            print('{0}\t{1}\t{2}\t{3:.0f}\t{4:.2f}\t{5:.2f}\t{6:.2f}\t'
+                  '{7:.1f}\t{8}\t{9:.2f}\t{10}'.format(
+                            processes, name, count, count / elapsed,
+                            percentile(durations, 0.5) * 1e3,
+                            percentile(durations, 0.99) * 1e3,
+                            wait / count * 1e3,
+                            wait / sum(durations) * 100,
+                            locked, locked / count * 100, failed))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,353 @@
+# Retort - Simple Python CGI framework.
+# Copyright (C) 2016 Dario Giovannetti <dev@dariogiovannetti.net>
+#
+# This file is part of Retort.
+#
+# Retort is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# Retort is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with Retort.  If not, see <http://www.gnu.org/licenses/>.
+
+"""
+Serve representative requests end to end, either in this process with a
+patched os.environ, stdin and stdout, or by spawning the application as a
+real CGI process for every request, and report the latency percentiles and,
+in process where tracemalloc is available, the memory allocated per request.
+
+The results can be saved as JSON and compared with a previous run, e.g. of
+another commit:
+
+    python benchmarks/endtoend.py [--mode inprocess|cgi] [--requests N]
+                                  [--scenarios NAME,...] [--output FILE]
+                                  [--compare FILE]
+"""
+
+from __future__ import (absolute_import, division,
+                        print_function, unicode_literals)
+
+import os
+import io
+import gc
+import sys
+import json
+import time
+import shutil
+import tempfile
+import argparse
+import subprocess
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+from retort import Retort  # noqa
+from retort import sqlite  # noqa
+from retort.route import RouteExact, RouteRegex, Handler  # noqa
+from retort.cache import SQLiteCache, OutputCache  # noqa
+from retort.session import TokenSQLiteSession  # noqa
+
+try:
+    import tracemalloc
+except ImportError:
+    # Python 2
+    tracemalloc = None
+
+clock = getattr(time, 'perf_counter', time.time)
+
+# Environment variable with the database directory of a CGI process
+DIRECTORY_VARIABLE = 'RETORT_BENCHMARK_DIRECTORY'
+COOKIE_NAME = str('RetortSessionID')
+TOKEN = 'benchmark-session'
+# Routes of a typical site, besides the ones tested by the scenarios
+FILLER_ROUTES = 50
+FORM_BODY = b'name=Retort&email=retort%40example.com&message=' + b'x' * 500
+
+# name: (method, url, query string, body, cookie, expected status)
+SCENARIOS = (
+    ('exact', ('GET', '/about.htm', '', b'', None, '200')),
+    ('regex', ('GET', '/article/1234.htm', '', b'', None, '200')),
+    ('not_found', ('GET', '/missing.htm', '', b'', None, '404')),
+    ('post_form', ('POST', '/contact.htm', '', FORM_BODY, None, '200')),
+    ('session', ('GET', '/account.htm', '', b'',
+                 '{0}={1}'.format(COOKIE_NAME, TOKEN), '200')),
+    ('cache_hit', ('GET', '/cached.htm', 'page=1', b'', None, '200')),
+    # A new query string for every request
+    ('cache_miss', ('GET', '/cached.htm', None, b'', None, '200')),
+)
+
+
+def page(app, *args):
+    return '<p>{0}</p>'.format('Lorem ipsum dolor sit amet. ' * 40)
+
+
+def contact(app):
+    return '<p>Thanks, {0}</p>'.format(app.request.form.getfirst('name'))
+
+
+def account(app):
+    return '<p>Welcome, {0}</p>'.format(app.session.user)
+
+
+def not_found(app):
+    app.response.set_status(404)
+    return '<p>Not found</p>'
+
+
+def make_app(directory):
+    cache = SQLiteCache(os.path.join(directory, 'cache.db'))
+    session = TokenSQLiteSession(os.path.join(directory, 'sessions.db'),
+                                 'example.com', 3600, cookie_name=COOKIE_NAME,
+                                 autoextend=True)
+    routes = []
+    for index in range(FILLER_ROUTES // 2):
+        routes.append(RouteExact('/section{0}/index.htm'.format(index), page))
+        routes.append(RouteRegex(r'^/section{0}/(\d+)\.htm$'.format(index),
+                                 page))
+    routes.extend((
+        RouteExact('/about.htm', page),
+        RouteRegex(r'^/article/(\d+)\.htm$', page),
+        RouteExact('/contact.htm', contact),
+        RouteExact('/account.htm', account, session=session),
+        RouteExact('/cached.htm', page, output_cache=OutputCache()),
+    ))
+    return Retort(routes=routes, handlers={404: Handler(not_found)},
+                  cache=cache)
+
+
+def setup(directory):
+    cache = SQLiteCache(os.path.join(directory, 'cache.db'))
+    cache.create_db_table()
+    session = TokenSQLiteSession(os.path.join(directory, 'sessions.db'),
+                                 'example.com', 3600)
+    session.create_db_table()
+    conn = sqlite.connect(os.path.join(directory, 'sessions.db'))
+    conn.execute('INSERT INTO Sessions VALUES (?, ?, ?, NULL)',
+                 (TOKEN, int(time.time()) + 3600, 'user'))
+    conn.commit()
+    sqlite.close_all()
+
+
+def make_environ(scenario, index):
+    method, url, query, body, cookie, _ = scenario
+    environ = {
+        'REQUEST_METHOD': method,
+        'SCRIPT_NAME': '',
+        'PATH_INFO': url,
+        'QUERY_STRING': 'page={0}'.format(index) if query is None else query,
+        'SERVER_NAME': 'example.com',
+        'SERVER_PORT': '443',
+        'SERVER_PROTOCOL': 'HTTP/1.1',
+        'HTTPS': 'on',
+        'HTTP_HOST': 'example.com',
+        'HTTP_USER_AGENT': 'Mozilla/5.0 (benchmark)',
+        'HTTP_ACCEPT': 'text/html',
+    }
+    if body:
+        environ['CONTENT_TYPE'] = 'application/x-www-form-urlencoded'
+        environ['CONTENT_LENGTH'] = str(len(body))
+    if cookie:
+        environ['HTTP_COOKIE'] = cookie
+    # The environment of a CGI process only contains native strings
+    return dict((str(name), str(value)) for name, value in environ.items())
+
+
+class _FileStream(io.BytesIO):
+    def write(self, data):
+        # Like Python 2 files, also accept unicode strings
+        if isinstance(data, type('')):
+            data = data.encode('utf-8')
+        return io.BytesIO.write(self, data)
+
+
+def make_stream(data=b''):
+    if str is bytes:
+        return _FileStream(data)
+    return io.TextIOWrapper(io.BytesIO(data), encoding='utf-8')
+
+
+def serve_in_process(directory, environ, body):
+    """
+    Serve the request like a CGI process would, but without starting one.
+    """
+    saved = os.environ, sys.stdin, sys.stdout
+    os.environ = environ
+    sys.stdin = make_stream(body)
+    sys.stdout = make_stream()
+    try:
+        try:
+            make_app(directory).run()
+        except SystemExit:
+            pass
+        sys.stdout.flush()
+        output = getattr(sys.stdout, 'buffer', sys.stdout).getvalue()
+    finally:
+        os.environ, sys.stdin, sys.stdout = saved
+        # A new process would open new connections
+        sqlite.close_all()
+    return output
+
+
+def serve_cgi(directory, environ, body):
+    environ = dict(environ)
+    # As set up by the web server
+    for name in ('PATH', 'PYTHONPATH'):
+        if name in os.environ:
+            environ[str(name)] = os.environ[name]
+    environ[str(DIRECTORY_VARIABLE)] = str(directory)
+    process = subprocess.Popen([sys.executable, os.path.abspath(__file__),
+                                '--cgi'], env=environ,
+                               stdin=subprocess.PIPE, stdout=subprocess.PIPE)
+    return process.communicate(body)[0]
+
+
+def check(output, scenario, name):
+    status = scenario[5]
+    if not output.startswith('Status: {0}'.format(status).encode('ascii')):
+        raise AssertionError('{0}: expected status {1}, got {2!r}'.format(
+                                                name, status, output[:200]))
+
+
+def percentile(values, fraction):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * fraction))]
+
+
+def measure_allocations(directory, scenario, requests):
+    """
+    Return the median peak and retained bytes allocated by a request.
+    """
+    peaks = []
+    retained = []
+    gc.collect()
+    tracemalloc.start()
+    try:
+        for index in range(requests):
+            environ = make_environ(scenario, requests + index)
+            before = tracemalloc.get_traced_memory()[0]
+            if hasattr(tracemalloc, 'reset_peak'):
+                tracemalloc.reset_peak()
+            serve_in_process(directory, environ, scenario[3])
+            # Don't count the reference cycles that are yet to be collected
+            gc.collect()
+            current, peak = tracemalloc.get_traced_memory()
+            peaks.append(peak - before)
+            retained.append(current - before)
+    finally:
+        tracemalloc.stop()
+    return percentile(peaks, 0.5), percentile(retained, 0.5)
+
+
+def run_scenario(name, scenario, args):
+    directory = tempfile.mkdtemp()
+    try:
+        setup(directory)
+        serve = serve_cgi if args.mode == 'cgi' else serve_in_process
+        # Also fills the output cache for cache_hit
+        check(serve(directory, make_environ(scenario, -1), scenario[3]),
+              scenario, name)
+        latencies = []
+        for index in range(args.requests):
+            environ = make_environ(scenario, index)
+            begin = clock()
+            serve(directory, environ, scenario[3])
+            latencies.append(clock() - begin)
+        result = {
+            'requests': args.requests,
+            'p50_ms': percentile(latencies, 0.5) * 1e3,
+            'p95_ms': percentile(latencies, 0.95) * 1e3,
+            'p99_ms': percentile(latencies, 0.99) * 1e3,
+            'peak_bytes': None,
+            'retained_bytes': None,
+        }
+        if args.mode == 'inprocess' and tracemalloc is not None:
+            result['peak_bytes'], result['retained_bytes'] = \
+                    measure_allocations(directory, scenario,
+                                        min(args.requests, 100))
+    finally:
+        shutil.rmtree(directory)
+    return result
+
+
+def git_commit():
+    try:
+        output = subprocess.Popen(['git', 'rev-parse', 'HEAD'], cwd=ROOT,
+                                  stdout=subprocess.PIPE,
+                                  stderr=subprocess.PIPE).communicate()[0]
+    except OSError:
+        return None
+    return output.decode('ascii').strip() or None
+
+
+def format_value(value, format_):
+    return '-' if value is None else format_.format(value)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='End-to-end benchmark.')
+    parser.add_argument('--mode', choices=('inprocess', 'cgi'),
+                        default='inprocess',
+                        help='serve the requests in this process, or spawn '
+                             'a CGI process for each one')
+    parser.add_argument('--requests', type=int, default=200,
+                        help='requests per scenario')
+    parser.add_argument('--scenarios',
+                        help='comma-separated scenarios, default all')
+    parser.add_argument('--output', help='save the results as JSON')
+    parser.add_argument('--compare', help='JSON results of a previous run')
+    parser.add_argument('--cgi', action='store_true',
+                        help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.cgi:
+        # Spawned by serve_cgi
+        make_app(os.environ[DIRECTORY_VARIABLE]).run()
+        return
+
+    names = args.scenarios.split(',') if args.scenarios else None
+    previous = None
+    if args.compare:
+        with open(args.compare) as stream:
+            previous = json.load(stream)
+        if previous['mode'] != args.mode:
+            parser.error('{0} was run in {1} mode'.format(args.compare,
+                                                          previous['mode']))
+        previous = previous['scenarios']
+
+    results = {}
+    print('scenario\tp50_ms\tp95_ms\tp99_ms\tpeak_bytes\tretained_bytes'
+          '\tp50_change')
+    for name, scenario in SCENARIOS:
+        if names and name not in names:
+            continue
+        result = run_scenario(name, scenario, args)
+        results[name] = result
+        change = None
+        if previous and name in previous:
+            change = (result['p50_ms'] / previous[name]['p50_ms'] - 1) * 100
+        print('{0}\t{1:.2f}\t{2:.2f}\t{3:.2f}\t{4}\t{5}\t{6}'.format(
+                                name, result['p50_ms'], result['p95_ms'],
+                                result['p99_ms'],
+                                format_value(result['peak_bytes'], '{0}'),
+                                format_value(result['retained_bytes'],
+                                             '{0}'),
+                                format_value(change, '{0:+.1f}%')))
+
+    if args.output:
+        with open(args.output, 'w') as stream:
+            json.dump({'commit': git_commit(),
+                       'python': sys.version.split()[0],
+                       'mode': args.mode,
+                       'time': int(time.time()),
+                       'scenarios': results}, stream, indent=2,
+                      sort_keys=True)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,111 @@
+# Retort - Simple Python CGI framework.
+# Copyright (C) 2016 Dario Giovannetti <dev@dariogiovannetti.net>
+#
+# This file is part of Retort.
+#
+# Retort is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# Retort is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with Retort.  If not, see <http://www.gnu.org/licenses/>.
+
+"""
+Compare the cost of finding the route for a url with the indexed dispatcher
+and with the old linear scan of all the routes, as the number of routes grows.
+
+    python benchmarks/routes.py [--number N]
+"""
+
+from __future__ import (absolute_import, division,
+                        print_function, unicode_literals)
+
+import os
+import sys
+import re
+import timeit
+import argparse
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(
+                                                                __file__))))
+
+from retort.route import RouteExact, RouteRegex, _Dispatcher  # noqa
+
+
+class _FakeRequest(object):
+    def __init__(self, url):
+        self.redirect_url = url
+
+
+class _FakeApp(object):
+    def __init__(self, url):
+        self.request = _FakeRequest(url)
+
+
+def make_routes(count):
+    """
+    Half exact urls, half regular expressions, as in a typical site.
+    """
+    routes = []
+    for index in range(count // 2):
+        routes.append(RouteExact('/section{0}/index.htm'.format(index), None))
+        routes.append(RouteRegex(r'^/section{0}/page(\d+)\.htm$'.format(index),
+                                 None))
+    return routes
+
+
+def linear(routes, app):
+    # What Retort.run did before the dispatcher: re.match compiles (or looks
+    # up in re's small cache) every pattern for every request
+    url = app.request.redirect_url
+    for route in routes:
+        if isinstance(route, RouteRegex):
+            if re.match(route.pattern, url, flags=route.flags):
+                return route
+        elif route.test(app):
+            return route
+
+
+def indexed(dispatcher, app):
+    for route in dispatcher.candidates(app.request.redirect_url):
+        route.serve_args = []
+        route.serve_kwargs = {}
+        if route.test(app):
+            return route
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Route lookup benchmark.')
+    parser.add_argument('--number', type=int, default=2000,
+                        help='lookups per measurement')
+    args = parser.parse_args()
+
+    print('routes\tscenario\tlinear_us\tindexed_us\tbuild_us')
+    for count in (10, 100, 1000, 5000):
+        routes = make_routes(count)
+        build = timeit.timeit(lambda: _Dispatcher(routes), number=10) / 10
+        dispatcher = _Dispatcher(routes)
+        last = count // 2 - 1
+        for scenario, url in (
+                ('first', '/section0/index.htm'),
+                ('last_exact', '/section{0}/index.htm'.format(last)),
+                ('last_regex', '/section{0}/page42.htm'.format(last)),
+                ('not_found', '/missing.htm')):
+            app = _FakeApp(url)
+            number = max(1, args.number // max(1, count // 100))
+            tlinear = timeit.timeit(lambda: linear(routes, app),
+                                    number=number) / number
+            tindexed = timeit.timeit(lambda: indexed(dispatcher, app),
+                                     number=args.number) / args.number
+            print('{0}\t{1}\t{2:.2f}\t{3:.2f}\t{4:.2f}'.format(
+                count, scenario, tlinear * 1e6, tindexed * 1e6, build * 1e6))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,181 @@
+# Retort - Simple Python CGI framework.
+# Copyright (C) 2016 Dario Giovannetti <dev@dariogiovannetti.net>
+#
+# This file is part of Retort.
+#
+# Retort is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# Retort is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with Retort.  If not, see <http://www.gnu.org/licenses/>.
+
+"""
+Measure the latency of requests that use a TokenSQLiteSession and a
+SQLiteCache, from concurrent processes, with the default SQLite settings and
+with the ones applied by retort.sqlite, e.g. WAL.
+
+Every request opens new connections, as a CGI process would. Writes are
+timed separately, since that's where processes wait for the database lock.
+
+    python benchmarks/sqlite.py [--requests N] [--writes FRACTION]
+"""
+
+from __future__ import (absolute_import, division,
+                        print_function, unicode_literals)
+
+import os
+import io
+import sys
+import time
+import random
+import shutil
+import tempfile
+import argparse
+import multiprocessing
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(
+                                                                __file__))))
+
+from retort import Retort  # noqa
+from retort import sqlite  # noqa
+from retort.route import RouteExact  # noqa
+from retort.gateway import StreamGateway  # noqa
+from retort.cache import SQLiteCache  # noqa
+from retort.session import TokenSQLiteSession  # noqa
+
+CONFIGURATIONS = (
+    # The defaults of SQLite
+    ('default', (('journal_mode', 'DELETE'), ('synchronous', 'FULL'),
+                 ('busy_timeout', 5000))),
+    ('tuned', ()),
+)
+SESSIONS = 100
+FRAGMENTS = 20
+
+
+def make_app(directory, pragmas, args, write_times):
+    cache = SQLiteCache(os.path.join(directory, 'cache.db'), pragmas=pragmas,
+                        lease_wait=0)
+    session = TokenSQLiteSession(os.path.join(directory, 'sessions.db'),
+                                 'example.com', 3600,
+                                 cookie_name=str('RetortSessionID'),
+                                 pragmas=pragmas)
+
+    def page(app):
+        keys = ['fragment{0}'.format(index) for index in range(FRAGMENTS)]
+        fragments = app.cache.get_dict(*keys)
+        if random.random() < args.writes:
+            begin = time.time()
+            app.cache.set(random.choice(keys), 'x' * 1000)
+            app.session.data['visits'] = app.session.data.get('visits',
+                                                              0) + 1
+            app.session.process_response(app)
+            write_times.append(time.time() - begin)
+        return '{0} {1}'.format(app.session.user, len(fragments))
+
+    return Retort(routes=[RouteExact('/page', page)], cache=cache,
+                  default_session=session)
+
+
+def setup(directory, pragmas):
+    cache = SQLiteCache(os.path.join(directory, 'cache.db'), pragmas=pragmas)
+    cache.create_db_table()
+    cache.set_dict(dict(('fragment{0}'.format(index), 'x' * 1000)
+                        for index in range(FRAGMENTS)))
+    session = TokenSQLiteSession(os.path.join(directory, 'sessions.db'),
+                                 'example.com', 3600, pragmas=pragmas)
+    session.create_db_table()
+    conn = sqlite.connect(os.path.join(directory, 'sessions.db'), pragmas)
+    conn.executemany('INSERT INTO Sessions VALUES (?, ?, ?, NULL)',
+                     [('session{0}'.format(index), int(time.time()) + 3600,
+                       'user{0}'.format(index))
+                      for index in range(SESSIONS)])
+    conn.commit()
+    sqlite.close_all()
+
+
+def worker(directory, pragmas, args, start, results):
+    write_times = []
+    app = make_app(directory, pragmas, args, write_times)
+    latencies = []
+    errors = 0
+    start.wait()
+    for _ in range(args.requests):
+        environ = {'PATH_INFO': '/page', 'REQUEST_METHOD': 'GET',
+                   'HTTP_COOKIE': str('RetortSessionID=session{0}'.format(
+                                            random.randrange(SESSIONS)))}
+        begin = time.time()
+        try:
+            app._serve(StreamGateway(environ, None, io.BytesIO()))
+        except Exception:
+            # E.g. 'database is locked'
+            errors += 1
+        # Like a new CGI process
+        sqlite.close_all()
+        latencies.append(time.time() - begin)
+    results.put((latencies, write_times, errors))
+
+
+def percentile(values, fraction):
+    values = sorted(values)
+    if not values:
+        return 0.0
+    return values[min(len(values) - 1, int(len(values) * fraction))]
+
+
+def run(pragmas, processes, args):
+    directory = tempfile.mkdtemp()
+    try:
+        setup(directory, pragmas)
+        start = multiprocessing.Event()
+        results = multiprocessing.Queue()
+        workers = [multiprocessing.Process(target=worker,
+                                           args=(directory, pragmas, args,
+                                                 start, results))
+                   for _ in range(processes)]
+        for process in workers:
+            process.start()
+        start.set()
+        outcomes = [results.get() for _ in workers]
+        for process in workers:
+            process.join()
+    finally:
+        shutil.rmtree(directory)
+    latencies = [value for outcome in outcomes for value in outcome[0]]
+    write_times = [value for outcome in outcomes for value in outcome[1]]
+    errors = sum(outcome[2] for outcome in outcomes)
+    return latencies, write_times, errors
+
+
+def main():
+    parser = argparse.ArgumentParser(description='SQLite settings benchmark.')
+    parser.add_argument('--requests', type=int, default=200,
+                        help='requests per process')
+    parser.add_argument('--writes', type=float, default=0.1,
+                        help='fraction of requests that write')
+    args = parser.parse_args()
+
+    print('processes\tconfig\tp50_ms\tp95_ms\tp99_ms\twrite_p50_ms\t'
+          'write_p99_ms\terrors')
+    for processes in (1, 8, 32):
+        for name, pragmas in CONFIGURATIONS:
+            latencies, write_times, errors = run(pragmas, processes, args)
+            print('{0}\t{1}\t{2:.2f}\t{3:.2f}\t{4:.2f}\t{5:.2f}\t{6:.2f}\t'
+                  '{7}'.format(processes, name,
+                               percentile(latencies, 0.5) * 1e3,
+                               percentile(latencies, 0.95) * 1e3,
+                               percentile(latencies, 0.99) * 1e3,
+                               percentile(write_times, 0.5) * 1e3,
+                               percentile(write_times, 0.99) * 1e3,
+                               errors))
+
+
+if __name__ == '__main__':
+    main()
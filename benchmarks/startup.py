@@ -0,0 +1,160 @@
+# Retort - Simple Python CGI framework.
+# Copyright (C) 2016 Dario Giovannetti <dev@dariogiovannetti.net>
+#
+# This file is part of Retort.
+#
+# Retort is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# Retort is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with Retort.  If not, see <http://www.gnu.org/licenses/>.
+
+"""
+Measure the startup cost that every CGI request pays: the wall-clock time of
+a cold process that imports retort and instantiates the application, minus
+the time of an empty interpreter, and, where -X importtime is supported, the
+modules imported by retort and their cost.
+
+Exit with status 1 if the median cost exceeds the budget, or if a module that
+retort only needs for specific features is imported at startup.
+
+    python benchmarks/startup.py [--runs N] [--budget MS] [--python PATH]
+"""
+
+from __future__ import (absolute_import, division,
+                        print_function, unicode_literals)
+
+import os
+import sys
+import time
+import argparse
+import subprocess
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+# Milliseconds, a little above the measured cost (2-4 ms with CPython 3.11),
+# so that small regressions fail too
+DEFAULT_BUDGET = 6
+# Imported only by the features that need them; copy is replaced by
+# route._copy, and only long-lived processes import it
+LAZY_MODULES = ('cgi', 'copy', 'Cookie', 'http.cookies', 'datetime',
+                'functools', 'json', 're', 'sqlite3', 'uuid', 'hashlib',
+                'hmac', 'zlib', 'email')
+STARTUP = 'import retort; retort.Retort()'
+CHECK = ('import sys; before = set(sys.modules); ' + STARTUP + '; '
+         'print(" ".join(sorted(set(sys.modules) - before)))')
+
+
+def make_env(write_bytecode=False):
+    env = dict(os.environ)
+    env['PYTHONPATH'] = os.pathsep.join(filter(None, (
+                                    ROOT, env.get('PYTHONPATH'))))
+    if write_bytecode:
+        env.pop('PYTHONDONTWRITEBYTECODE', None)
+    return env
+
+
+def time_process(python, code, env):
+    begin = time.time()
+    subprocess.check_call([python, '-c', code], env=env)
+    return time.time() - begin
+
+
+def median(values):
+    values = sorted(values)
+    return values[len(values) // 2]
+
+
+def import_times(python, env):
+    """
+    Return (module, self_us, cumulative_us) for retort and the modules it
+    imports, or None if -X importtime is not supported.
+    """
+    process = subprocess.Popen([python, '-X', 'importtime', '-c', STARTUP],
+                               env=env, stderr=subprocess.PIPE)
+    stderr = process.communicate()[1].decode('utf-8', 'replace')
+    times = []
+    for line in stderr.splitlines():
+        if not line.startswith('import time:'):
+            continue
+        fields = line[len('import time:'):].split('|')
+        try:
+            self_us, cumulative_us = int(fields[0]), int(fields[1])
+        except ValueError:
+            # The header
+            continue
+        # Nested imports are indented by two more spaces
+        depth = (len(fields[2]) - len(fields[2].lstrip()) - 1) // 2
+        times.append((fields[2].strip(), depth, self_us, cumulative_us))
+
+    # A module is listed after the modules it imports, so retort's are the
+    # nested ones right before it
+    for index, (module, depth, _, _) in enumerate(times):
+        if module == 'retort' and depth == 0:
+            break
+    else:
+        return None
+    begin = index
+    while begin > 0 and times[begin - 1][1] > 0:
+        begin -= 1
+    return [(module, self_us, cumulative_us)
+            for module, _, self_us, cumulative_us in times[begin:index + 1]]
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Startup time benchmark.')
+    parser.add_argument('--runs', type=int, default=20,
+                        help='processes started for each measurement')
+    parser.add_argument('--budget', type=float, default=DEFAULT_BUDGET,
+                        help='maximum median startup cost in milliseconds')
+    parser.add_argument('--python', default=sys.executable,
+                        help='interpreter to measure')
+    args = parser.parse_args()
+
+    env = make_env()
+    # Write the bytecode first, as a deployed site would have it
+    subprocess.check_call([args.python, '-c', STARTUP],
+                          env=make_env(write_bytecode=True))
+
+    baseline = [time_process(args.python, 'pass', env)
+                for _ in range(args.runs)]
+    startup = [time_process(args.python, STARTUP, env)
+               for _ in range(args.runs)]
+    cost = (median(startup) - median(baseline)) * 1e3
+    print('interpreter_ms\t{0:.2f}'.format(median(baseline) * 1e3))
+    print('retort_ms\t{0:.2f}'.format(median(startup) * 1e3))
+    print('cost_ms\t{0:.2f}'.format(cost))
+
+    times = import_times(args.python, env)
+    if times is not None:
+        print('\nmodule\tself_us\tcumulative_us')
+        for module, self_us, cumulative_us in sorted(
+                                times, key=lambda item: -item[2])[:15]:
+            print('{0}\t{1}\t{2}'.format(module, self_us, cumulative_us))
+
+    imported = subprocess.Popen([args.python, '-c', CHECK], env=env,
+                                stdout=subprocess.PIPE).communicate()[0]
+    imported = imported.decode('utf-8').split()
+    eager = [module for module in imported
+             if module.split('.')[0] in LAZY_MODULES or module in LAZY_MODULES]
+
+    failed = False
+    if cost > args.budget:
+        print('\nFAIL: startup cost {0:.2f} ms exceeds the budget of '
+              '{1:.2f} ms'.format(cost, args.budget))
+        failed = True
+    if eager:
+        print('\nFAIL: imported at startup: {0}'.format(' '.join(eager)))
+        failed = True
+    if failed:
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -24,36 +24,153 @@ from __future__ import (absolute_import, division,
 # from builtins import super
 
 import sys
-import os
-from functools import wraps
+# cgi is imported only when a request body must be parsed
 # https://docs.python.org/2.6/library/internet.html
 # https://docs.python.org/2.6/library/cgi.html
 # http://www.tutorialspoint.com/python/python_cgi_programming.htm
-import cgi
 
-from .cookie import Cookie
-from .route import Diversion, Handler
+from .route import Diversion, Handler, _Dispatcher
 from .session import NullSession
 from .response import Response
+from .gateway import CGIGateway, WSGIGateway
+from .exceptions import RequestServed
 
 
 class _Request(object):
-    def __init__(self, keep_blank_form_values):
+    def __init__(self, keep_blank_form_values, environ, stdin=None,
+                 timer=None):
         """
         Store the HTTP request data, e.g. GET or POST data.
-        """
-        # TODO: Do something in case REDIRECT_URL is not defined?
-        self.redirect_url = os.environ['REDIRECT_URL']
-        self.cookies = Cookie(os.environ.get('HTTP_COOKIE', ''))
 
+        The form data and the cookies are parsed only when they are accessed
+        for the first time.
+        """
+        try:
+            self.redirect_url = environ['REDIRECT_URL']
+        except KeyError:
+            # The url was not rewritten, e.g. the application is served
+            # directly through FastCGI or SCGI
+            self.redirect_url = (environ.get('SCRIPT_NAME', '') +
+                                 environ.get('PATH_INFO', ''))
+        self._environ = environ
+        self._stdin = stdin
+        self._keep_blank_form_values = keep_blank_form_values
+        self._timer = timer
+        self._cookies = None
+        self._form = None
+
+    @property
+    def cookies(self):
+        if self._cookies is None:
+            from .cookie import Cookie
+            self._cookies = Cookie(self._environ.get('HTTP_COOKIE', ''))
+        return self._cookies
+
+    @property
+    def form(self):
         # FieldStorage must be instantiated only once
-        self.form = cgi.FieldStorage(
-                keep_blank_values=keep_blank_form_values)
+        if self._form is None:
+            if self._timer is not None:
+                begin = self._timer.now()
+            # FieldStorage only parses the query string of GET and HEAD
+            # requests, so don't even import it
+            if self._environ.get('REQUEST_METHOD', 'GET').upper() in ('GET',
+                                                                    'HEAD'):
+                self._form = _QueryStringForm(
+                                    self._environ.get('QUERY_STRING', ''),
+                                    self._keep_blank_form_values)
+            else:
+                import cgi
+                self._form = cgi.FieldStorage(
+                        fp=self._stdin, environ=self._environ,
+                        keep_blank_values=self._keep_blank_form_values)
+            if self._timer is not None:
+                self._timer.add('form', begin)
+        return self._form
+
+
+class _QueryStringField(object):
+    def __init__(self, name, value):
+        """
+        Like cgi.MiniFieldStorage.
+        """
+        self.name = name
+        self.value = value
+
+
+class _QueryStringForm(object):
+    def __init__(self, query_string, keep_blank_values):
+        """
+        Implement the part of the cgi.FieldStorage interface that is useful
+        for the data of a query string.
+        """
+        try:
+            from urllib.parse import parse_qsl
+        except ImportError:
+            # Python 2
+            from urlparse import parse_qsl
+        self.list = [_QueryStringField(name, value) for name, value in
+                     parse_qsl(query_string, keep_blank_values)]
+
+    def __getitem__(self, key):
+        found = [item for item in self.list if item.name == key]
+        if not found:
+            raise KeyError(key)
+        if len(found) == 1:
+            return found[0]
+        return found
+
+    def getvalue(self, key, default=None):
+        try:
+            value = self[key]
+        except KeyError:
+            return default
+        if isinstance(value, list):
+            return [item.value for item in value]
+        return value.value
+
+    def getfirst(self, key, default=None):
+        for item in self.list:
+            if item.name == key:
+                return item.value
+        return default
+
+    def getlist(self, key):
+        return [item.value for item in self.list if item.name == key]
+
+    def keys(self):
+        keys = []
+        for item in self.list:
+            if item.name not in keys:
+                keys.append(item.name)
+        return keys
+
+    def __contains__(self, key):
+        return any(item.name == key for item in self.list)
+
+    def has_key(self, key):
+        return key in self
+
+    def __iter__(self):
+        return iter(self.keys())
+
+    def __len__(self):
+        return len(self.keys())
+
+    def __bool__(self):
+        return bool(self.list)
+
+    __nonzero__ = __bool__
 
 
 class Retort(object):
     DEFAULT_SESSION = NullSession
     DEFAULT_RESPONSE = Response
+    _debug = False
+    # Set by the handler that serves the request
+    session = None
+    response = None
+    _session_source = None
 
     @staticmethod
     def debug():
@@ -81,6 +198,8 @@ Content-type: text/plain
             sys.exit(1)
 
         sys.excepthook = display_uncaught_exception
+        # Long-lived servers don't let exceptions reach sys.excepthook
+        Retort._debug = True
 
     # cgitb seems to give more trouble than help...
     # @staticmethod
@@ -99,19 +218,40 @@ Content-type: text/plain
 
     def __init__(self, routes=[], handlers={}, keep_blank_form_values=False,
                  default_diversion=Diversion(404), default_session=None,
-                 default_response=None, cache=None):
+                 default_response=None, cache=None, timing=None):
         """
         The main application.
+
+        Pass a retort.timing.Timing object as timing to measure the phases of
+        every request.
         """
         # TODO: Implement logging for use in production
 
         self.routes = routes
+        # The dispatcher is (re)built lazily from self.routes when the first
+        # url is dispatched after adding routes
+        self._dispatcher = None
         self.handlers = handlers
-        self.request = _Request(keep_blank_form_values)
+        self.gateway = CGIGateway()
+        self._keep_blank_form_values = keep_blank_form_values
+        self._request = None
         self.default_diversion = default_diversion
         self.set_default_session(default_session or self.DEFAULT_SESSION())
         self.set_default_response(default_response or self.DEFAULT_RESPONSE())
         self.cache = cache
+        self.timing = timing
+        # The RequestTimer of the current request, if timing is set
+        self._timer = None
+
+    @property
+    def request(self):
+        # Parse the request only when it's needed, so that a long-lived server
+        # can set up the application before receiving any request
+        if self._request is None:
+            self._request = _Request(self._keep_blank_form_values,
+                                     self.gateway.environ, self.gateway.stdin,
+                                     self._timer)
+        return self._request
 
     def set_default_session(self, session):
         self._default_session = session
@@ -132,14 +272,30 @@ Content-type: text/plain
             @app.route(RouteExact, '/hello_world.htm')
             def hello_world(app):
                 return 'Hello World!'
+
+        If a handler is passed, e.g. a dotted path, which is imported only when
+        the route matches, the route is added right away instead:
+
+            app.route(RouteExact, '/reports.htm',
+                      handler='site.pages.reports:make')
         """
+        handler = route_kwargs.pop('handler', None)
+        if handler is not None:
+            self.routes.append(RouteClass(*(route_args + (handler, )),
+                                          **route_kwargs))
+            self._dispatcher = None
+            return
+
         def decorator(function):
+            from functools import wraps
+
             @wraps(function)
             def inner(*args, **kwargs):
                 return function(*args, **kwargs)
             lroute_args = list(route_args)
             lroute_args.append(inner)
             self.routes.append(RouteClass(*lroute_args, **route_kwargs))
+            self._dispatcher = None
             # TODO: Also register the routes in self.handlers; as an alias,
             #       maybe use the name of their function (as in Flask), or
             #       allow an optional 'alias' kwarg
@@ -169,6 +325,8 @@ Content-type: text/plain
                 RouteExact('/hello_world_module.htm', hello_world_module),
                 RouteExact('/hello_world_function.htm', hello_world_function),
                 RouteExact('/hello_world_class.htm', HelloWorldClass()),
+                # Imported only when the route matches
+                RouteExact('/reports.htm', 'site.pages.reports:make'),
             )
         """
         # Python 2 must be supported, so the following definition can't be
@@ -177,6 +335,7 @@ Content-type: text/plain
         default_diversion = kwargs.pop('default_diversion', None)
 
         self.routes.extend(routes)
+        self._dispatcher = None
 
         # TODO: Also register the routes in self.handlers; as an alias, maybe
         #       use the name of their function (as in Flask), or allow an
@@ -186,8 +345,20 @@ Content-type: text/plain
             # default_diversion can also be set in the constructor
             self.default_diversion = default_diversion
 
-    def handler(self, alias, **handler_kwargs):
+    def handler(self, alias, handler=None, **handler_kwargs):
+        """
+        Register the decorated function as a handler, see add_handlers.
+
+        If a handler is passed, e.g. a 'package.module:attribute' dotted path,
+        it's registered right away instead.
+        """
+        if handler is not None:
+            self.handlers[alias] = Handler(handler, **handler_kwargs)
+            return
+
         def decorator(function):
+            from functools import wraps
+
             @wraps(function)
             def inner(*args, **kwargs):
                 return function(*args, **kwargs)
@@ -212,9 +383,74 @@ Content-type: text/plain
             return ''
         Handler(function).serve(self)
 
+    def _get_dispatcher(self):
+        # Also rebuild the index if self.routes was modified directly
+        if (self._dispatcher is None or
+                len(self._dispatcher.routes) != len(self.routes)):
+            self._dispatcher = _Dispatcher(self.routes)
+        return self._dispatcher
+
     def run(self):
-        for route in self.routes:
+        if self.timing is not None:
+            self._timer = self.timing.start(self)
+        for route in self._get_dispatcher().candidates(
+                                                self.request.redirect_url):
             # If a route responds, it will exit the appliction by default, so
             # no need to break here
             route.attempt(self)
         self.default_diversion.serve(self)
+
+    def _serve(self, gateway):
+        """
+        Serve one request in a long-lived process, without exiting.
+        """
+        # Build the route table only once, not for every request
+        self._get_dispatcher()
+        from copy import copy
+        app = copy(self)
+        app.gateway = gateway
+        app._request = None
+        try:
+            app.run()
+        except RequestServed:
+            pass
+
+    def wsgi_app(self, environ, start_response):
+        """
+        Serve a request as a WSGI application, e.g.:
+
+            application = app.wsgi_app
+
+        Every request is served by a copy of the application, so the
+        application can be used by multi-threaded WSGI servers.
+        """
+        gateway = WSGIGateway(environ)
+        self._serve(gateway)
+        start_response(gateway.status, gateway.headers)
+        return gateway.body
+
+    def serve_fastcgi(self, address=None, workers=4, max_requests=0,
+                      backlog=128):
+        """
+        Serve the application through FastCGI with a pool of pre-forked
+        worker processes, which set up the application only once.
+
+        address can be a (host, port) tuple, the path of a Unix socket, or None
+        to use the socket passed by the web server as the standard input.
+        Each worker is replaced after serving max_requests requests, unless
+        it's 0. Send SIGHUP to gracefully restart the workers, SIGTERM or
+        SIGINT to gracefully stop the server.
+        """
+        from .server import FastCGIServer
+        FastCGIServer(self, address, workers=workers,
+                      max_requests=max_requests,
+                      backlog=backlog).serve_forever()
+
+    def serve_scgi(self, address=('127.0.0.1', 4000), workers=4,
+                   max_requests=0, backlog=128):
+        """
+        Serve the application through SCGI; see serve_fastcgi.
+        """
+        from .server import SCGIServer
+        SCGIServer(self, address, workers=workers, max_requests=max_requests,
+                   backlog=backlog).serve_forever()
@@ -23,6 +23,9 @@ from __future__ import (absolute_import, division,
 # TODO: Test builtins.super
 # from builtins import super
 
+import os
+from collections import OrderedDict
+
 
 class Cache(object):
     def __init__(self, default_timeout=360):
@@ -59,97 +62,910 @@ class Cache(object):
         raise NotImplementedError()
 
 
+class OutputCache(object):
+    KEY_PREFIX = 'retort.output.'
+
+    def __init__(self, max_age=None, vary_cookies=(), vary_headers=(),
+                 cache=None):
+        """
+        Store whole pages, i.e. their headers and body, so that the following
+        requests for the same page are served before processing the session
+        and the form, and without calling the handler.
+
+        Pass it to a route or handler as the output_cache argument. The pages
+        are stored in cache, or in the application's cache if None, for
+        max_age seconds, or for the cache's default timeout if None. Each page
+        is stored once for every url, query string and combination of the
+        values of the vary_cookies and vary_headers (e.g. 'Accept-Language').
+
+        Only GET and HEAD requests whose session allows it (see
+        Session.can_share_output) are cached, e.g. no authenticated requests;
+        only 200 responses with a string body and no cookies are stored.
+        """
+        self.max_age = max_age
+        self.vary_cookies = vary_cookies
+        self.vary_headers = vary_headers
+        self.cache = cache
+
+    def process_request(self, app, session):
+        """
+        Serve the stored page, if any, otherwise let the response store the
+        page that the handler is about to make.
+        """
+        environ = app.gateway.environ
+        if (environ.get('REQUEST_METHOD', 'GET').upper() not in ('GET',
+                                                                 'HEAD') or
+                not session.can_share_output(app)):
+            return
+
+        cache = self.cache or app.cache
+        key = self._make_key(app)
+        value = cache.get(key, max_age=self.max_age)
+        if value is None:
+            vary = tuple(self.vary_headers)
+            if self.vary_cookies:
+                vary += ('Cookie', )
+            if vary:
+                app.response.headers['Vary'] = app.response.headers.get(
+                                                        'Vary', ()) + vary
+            app.response.output_cache = (cache, key)
+            return
+
+        import json
+        headers, body, binary = json.loads(value)
+        if binary:
+            import base64
+            body = base64.b64decode(body)
+        response = app.response
+        for name, values in headers:
+            response.headers[name] = tuple(values)
+        response.status = 200
+        response.content_type = response.headers['Content-type'][0]
+        if app._timer is not None:
+            app._timer.mark('output_cache')
+        response.serve(body)
+
+    def _make_key(self, app):
+        import hashlib
+        environ = app.gateway.environ
+        parts = [app.request.redirect_url, environ.get('QUERY_STRING', '')]
+        if self.vary_cookies:
+            cookies = app.request.cookies
+            for name in self.vary_cookies:
+                parts.append(cookies[name].value if name in cookies else '')
+        for name in self.vary_headers:
+            parts.append(environ.get(
+                    'HTTP_' + name.upper().replace('-', '_'), ''))
+        return self.KEY_PREFIX + hashlib.sha1('\0'.join(parts).encode(
+                                                    'utf-8')).hexdigest()
+
+    @staticmethod
+    def store(response, body):
+        """
+        Store the page, if the response can be shared; called by
+        Response.serve before computing the ETag and compressing the body.
+        """
+        if (response.status != 200 or response._cookies or
+                not isinstance(body, (bytes, type('')))):
+            return
+        import json
+        cache, key = response.output_cache
+        binary = isinstance(body, bytes)
+        if binary:
+            # Cache values are strings
+            import base64
+            body = base64.b64encode(body).decode('ascii')
+        headers = [(name, list(values))
+                   for name, values in response.headers.items()]
+        cache.set(key, json.dumps((headers, body, binary)))
+
+
 class SQLiteCache(Cache):
     # Use SQLite, not just text files (e.g. JSON) because of concurrency
     # problems!
-    def __init__(self, db_path, default_timeout=360):
+    # Keys looked up by each query of get_dict
+    MAX_QUERY_KEYS = 500
+    # Seconds between checks while waiting for another process's refresh
+    LEASE_POLL_INTERVAL = 0.05
+    # The access time of a key is updated at most once in this many seconds,
+    # so that most reads don't write to the database
+    ACCESS_RESOLUTION = 60
+    # Evict this fraction of the limits more than strictly necessary, so that
+    # the next writes don't have to evict again
+    EVICTION_MARGIN = 0.1
+    # Pages freed by each incremental vacuum
+    VACUUM_PAGES = 256
+
+    def __init__(self, db_path, default_timeout=360, stale_grace=0,
+                 stale_if_error=False, lease_timeout=60, lease_wait=2,
+                 max_entries=None, max_bytes=None, expire_after=None,
+                 sweep_probability=0.05, serializer=None,
+                 compress_min_size=None, pragmas=None):
+        """
+        Only one process at a time refreshes expired values: it takes a lease
+        on the keys, which lasts at most lease_timeout seconds, while the
+        other processes return the values that expired less than stale_grace
+        seconds before, or wait up to lease_wait seconds for the refreshed
+        values, and then refresh them on their own.
+
+        If stale_if_error is True and the refresh function raises an
+        exception, the last stored values are returned, however old.
+
+        Writes are followed, with sweep_probability, by a sweep that deletes
+        the values older than expire_after seconds, if set, and then the least
+        recently used values in excess of max_entries values or max_bytes
+        bytes, if set. expire_after must not be lower than the longest max_age
+        that the values are read with, e.g. by an OutputCache or a
+        TieredCache, whose generation value is read with a max_age of 2 ** 31
+        seconds.
+
+        If serializer is set, e.g. to a JSONSerializer, any value that it
+        supports can be stored, otherwise values are stored as they are. If
+        compress_min_size is set, the values that are at least that many bytes
+        long when serialized (or encoded, if they are strings) are compressed
+        with zlib.
+
+        pragmas are applied to the database connection, see
+        retort.sqlite.connect.
+        """
         # For performance, do only what's strictly necessary to configure
         # the object, and leave everything else to process_request, since
         # another cache object may be used depending on the matched url,
         # so this would become useless
         super(SQLiteCache, self).__init__(default_timeout=default_timeout)
+        self.stale_grace = stale_grace
+        self.stale_if_error = stale_if_error
+        self.lease_timeout = lease_timeout
+        self.lease_wait = lease_wait
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.expire_after = expire_after
+        self.sweep_probability = sweep_probability
+        self.serializer = serializer
+        self.compress_min_size = compress_min_size
 
         # Don't always import unneeded modules
 
         global sqlite3
         import sqlite3
 
-        global datetime, timedelta
-        from datetime import datetime, timedelta
+        global time
+        import time
+
+        global random
+        import random
 
-        # TODO: Allow explicitly closing the connection, perhaps supporting
-        #       the 'with' statement, or adding a 'close' method?
-        self._db_conn = sqlite3.connect(db_path)
-        # TODO: Investigate why sqlite3.Row doesn't work (doesn't like
-        #       row indices to be unicode strings...)
-        # self._db_conn.row_factory = sqlite3.Row
+        global connect
+        from .sqlite import connect
 
-        def dict_factory(cursor, row):
-            d = {}
-            for idx, col in enumerate(cursor.description):
-                d[col[0]] = row[idx]
-            return d
-        self._db_conn.row_factory = dict_factory
+        self._db_path = db_path
+        self._pragmas = pragmas
+
+    @property
+    def _db_conn(self):
+        # One connection per process and thread, shared with the other
+        # objects that use the same database
+        return connect(self._db_path, self._pragmas)
 
     def create_db_table(self):
         cur = self._db_conn.cursor()
-        cur.execute('PRAGMA auto_vacuum=FULL')
+        # Shrink the file in batches after the sweeps, not at every delete
+        cur.execute('PRAGMA auto_vacuum=INCREMENTAL')
+        # The times are stored in seconds since the epoch, so that expired
+        # values can be filtered out in SQL; size is the length of the value
+        # in bytes; format tells how the value was serialized, if at all
         cur.execute('''CREATE TABLE Cache (key TEXT PRIMARY KEY,
-                                           value TEXT,
-                                           creation TEXT NOT NULL)''')
+                                           value BLOB,
+                                           creation INTEGER NOT NULL,
+                                           access INTEGER NOT NULL,
+                                           size INTEGER NOT NULL,
+                                           format TEXT)''')
+        self._create_indices(cur)
+        self._create_leases_table(cur)
         cur.close()
+        # Only now that auto_vacuum is stored in the database
+        from .sqlite import set_journal_mode
+        set_journal_mode(self._db_path)
+
+    @staticmethod
+    def _create_indices(cur):
+        cur.execute('''CREATE INDEX IF NOT EXISTS CacheAccess
+                       ON Cache (access)''')
+
+    @staticmethod
+    def _create_leases_table(cur):
+        # A lease is held by the process that is refreshing the keys
+        cur.execute('''CREATE TABLE IF NOT EXISTS CacheLeases (
+                                            key TEXT PRIMARY KEY,
+                                            expiry INTEGER NOT NULL)''')
+
+    def upgrade_db_table(self):
+        """
+        Convert a table created by an older version of Retort, e.g. one that
+        stored the creation times as ISO 8601 text, to the current format; it
+        must be run once, before serving requests, on existing databases.
+        """
+        conn = self._db_conn
+        with conn:
+            cur = conn.cursor()
+            self._create_leases_table(cur)
+            cur.execute('PRAGMA table_info(Cache)')
+            # (cid, name, type, notnull, dflt_value, pk)
+            columns = dict((row[1], row[2].upper())
+                           for row in cur.fetchall())
+
+            if columns['creation'] != 'INTEGER':
+                import calendar
+                from datetime import datetime
+                import _strptime  # noqa
+
+                rows = []
+                for key, creation in conn.execute(
+                                        'SELECT key, creation FROM Cache'):
+                    creation = calendar.timegm(datetime.strptime(
+                            creation, "%Y-%m-%dT%H:%M:%SZ").timetuple())
+                    rows.append((creation, key))
+                cur.executemany('UPDATE Cache SET creation=? WHERE key=?',
+                                rows)
+
+            if columns['creation'] != 'INTEGER' or columns['value'] != 'BLOB':
+                # The column types can't be altered, and TEXT columns would
+                # compare the integer times as strings, and convert the
+                # numbers stored as values to strings, unlike in a new table;
+                # keep the columns added by the intermediate versions, the
+                # missing ones are added below
+                names = ['key', 'value', 'creation']
+                definitions = ['key TEXT PRIMARY KEY', 'value BLOB',
+                               'creation INTEGER NOT NULL']
+                for name, definition in (
+                        ('access', 'access INTEGER NOT NULL DEFAULT 0'),
+                        ('size', 'size INTEGER NOT NULL DEFAULT 0'),
+                        ('format', 'format TEXT')):
+                    if name in columns:
+                        names.append(name)
+                        definitions.append(definition)
+                cur.execute('CREATE TABLE CacheUpgrade ({0})'.format(
+                                                    ', '.join(definitions)))
+                cur.execute('''INSERT INTO CacheUpgrade ({0})
+                               SELECT {0} FROM Cache'''.format(
+                                                    ', '.join(names)))
+                cur.execute('DROP TABLE Cache')
+                cur.execute('ALTER TABLE CacheUpgrade RENAME TO Cache')
+
+            if 'access' not in columns:
+                cur.execute('''ALTER TABLE Cache ADD COLUMN
+                               access INTEGER NOT NULL DEFAULT 0''')
+                cur.execute('''ALTER TABLE Cache ADD COLUMN
+                               size INTEGER NOT NULL DEFAULT 0''')
+                # length(NULL) is NULL
+                cur.execute('''UPDATE Cache SET
+                                access=creation,
+                                size=COALESCE(length(CAST(value AS BLOB)), 0)
+                            ''')
+
+            if 'format' not in columns:
+                # The existing values are read as they are
+                cur.execute('ALTER TABLE Cache ADD COLUMN format TEXT')
+
+            self._create_indices(cur)
+            cur.close()
 
     def inspect_db_table(self, value=False):
         cur = self._db_conn.cursor()
-        fields = ['key', 'creation']
+        fields = ['key', 'creation', 'format']
         if value:
             fields.insert(1, 'value')
         cur.execute('''SELECT {0} FROM Cache'''.format(', '.join(fields)))
         text = ['\t'.join(fields)]
         for row in cur:
-            text.append('\t'.join(row[field] for field in fields))
+            row = dict(zip(fields, row))
+            if value:
+                try:
+                    row['value'] = self._decode(row['value'], row['format'])
+                except KeyError:
+                    row['value'] = repr(bytes(row['value']))
+            text.append('\t'.join('{0}'.format(row[field])
+                                  for field in fields))
         cur.close()
         return '\n'.join(text)
 
     def set(self, key, value):
-        creation = datetime.utcnow().strftime("%Y-%m-%dT%H:%M:%SZ")
-        cur = self._db_conn.cursor()
-        cur.execute('''INSERT OR REPLACE INTO Cache (key, value, creation)
-                       VALUES (?, ?, ?)''', (key, value, creation))
-        cur.close()
-        self._db_conn.commit()
+        self.set_dict({key: value})
 
     def set_dict(self, key_to_value):
-        creation = datetime.utcnow().strftime("%Y-%m-%dT%H:%M:%SZ")
-        cur = self._db_conn.cursor()
-        for key, value in key_to_value.items():
-            cur.execute('''INSERT OR REPLACE INTO Cache (key, value, creation)
-                           VALUES (?, ?, ?)''', (key, value, creation))
+        self._store(key_to_value)
+
+    def _store(self, key_to_value, lease=None):
+        now = int(time.time())
+        conn = self._db_conn
+        try:
+            rows = []
+            for key, value in key_to_value.items():
+                value, format_ = self._encode(value)
+                rows.append((key, value, now, now, value, format_))
+            # The connection is shared and lives as long as the process, so
+            # a failed transaction must be rolled back, or it would keep the
+            # database locked
+            with conn:
+                cur = conn.cursor()
+                cur.executemany('''INSERT OR REPLACE INTO Cache (
+                                        key, value, creation, access, size,
+                                        format)
+                                   VALUES (?, ?, ?, ?,
+                                           COALESCE(length(CAST(? AS BLOB)),
+                                                    0),
+                                           ?)''', rows)
+                if lease is not None:
+                    # Release the lease in the same transaction
+                    cur.execute('DELETE FROM CacheLeases WHERE key=?',
+                                (lease, ))
+                cur.close()
+        except BaseException:
+            if lease is not None:
+                self._release_lease(lease)
+            raise
+
+        # Sweep only once in a while, so that the cost is shared among many
+        # writes
+        if random.random() < self.sweep_probability:
+            self.sweep(now)
+
+    def sweep(self, now=None):
+        """
+        Delete the expired values, and evict the least recently used ones in
+        excess of the limits; called automatically after some writes.
+        """
+        if now is None:
+            now = int(time.time())
+        conn = self._db_conn
+        with conn:
+            self._sweep(conn.cursor(), now)
+        # Does nothing unless the database was created with
+        # auto_vacuum=INCREMENTAL, see create_db_table; each step of the
+        # statement frees one page, and, unlike execute(), executescript()
+        # runs all of them in every Python version
+        conn.executescript('PRAGMA incremental_vacuum({0:d});'.format(
+                                                        self.VACUUM_PAGES))
+
+    def _sweep(self, cur, now):
+        if self.expire_after is not None:
+            cur.execute('DELETE FROM Cache WHERE creation<?',
+                        (now - self.expire_after, ))
+
+        if self.max_entries is not None:
+            cur.execute('SELECT COUNT(*) FROM Cache')
+            count = cur.fetchone()[0]
+            if count > self.max_entries:
+                cur.execute('''DELETE FROM Cache WHERE key IN (
+                                    SELECT key FROM Cache
+                                    ORDER BY access LIMIT ?)''',
+                            (count - int(self.max_entries *
+                                         (1 - self.EVICTION_MARGIN)), ))
+
+        if self.max_bytes is not None:
+            cur.execute('SELECT TOTAL(size) FROM Cache')
+            total = cur.fetchone()[0]
+            if total > self.max_bytes:
+                excess = total - self.max_bytes * (1 - self.EVICTION_MARGIN)
+                keys = []
+                cur.execute('SELECT key, size FROM Cache ORDER BY access')
+                for key, size in cur:
+                    keys.append(key)
+                    excess -= size
+                    if excess <= 0:
+                        break
+                self._delete(cur, keys)
 
         cur.close()
-        self._db_conn.commit()
+
+    def _delete(self, cur, keys):
+        # Old SQLite versions allow at most 999 parameters per query
+        for index in range(0, len(keys), self.MAX_QUERY_KEYS):
+            chunk = keys[index:index + self.MAX_QUERY_KEYS]
+            cur.execute('''DELETE FROM Cache WHERE key IN ({0})'''.format(
+                        ', '.join('?' * len(chunk))), chunk)
 
     def get(self, key, max_age=None, refresh=None):
-        # TODO: In theory there may be a race bug by which a server request
-        #       could trigger a duplicate value refresh if it happens *while*
-        #       this method is still running due to a previous, but
-        #       quasi-simultaneous request; it would be harmless, however, only
-        #       inefficient
+        return self._get_values(
+                        (key, ), max_age,
+                        refresh and (lambda: {key: refresh()})).get(key)
+
+    def get_dict(self, *keys, **kwargs):
+        max_age = kwargs.pop('max_age', None)
+        refresh = kwargs.pop('refresh', None)
+        return self._get_values(keys, max_age, refresh)
+
+    def _get_values(self, keys, max_age, refresh):
+        keys = list(set(keys))
+        now = int(time.time())
+        min_creation = now - (self._default_timeout if max_age is None
+                              else max_age)
+
+        if not refresh:
+            return dict((key, value) for key, (value, creation)
+                        in self._select(keys, min_creation).items())
+
+        min_stale_creation = min_creation - self.stale_grace
+        # Also retrieve the values that may have to be used if the refresh
+        # fails
+        rows = self._select(keys, 0 if self.stale_if_error
+                            else min_stale_creation)
+        if (len(rows) == len(keys) and
+                all(creation >= min_creation
+                    for value, creation in rows.values())):
+            return dict((key, value) for key, (value, creation)
+                        in rows.items())
+
+        # This is reached only if a key doesn't exist or it's expired
+        lease = keys[0] if len(keys) == 1 else '\0'.join(sorted(keys))
+        if self._acquire_lease(lease, now):
+            return self._refresh(refresh, rows, len(keys), lease)
+
+        # Another process is refreshing the values
+        if (len(rows) == len(keys) and
+                all(creation >= min_stale_creation
+                    for value, creation in rows.values())):
+            return dict((key, value) for key, (value, creation)
+                        in rows.items())
 
-        maxdelta = timedelta(seconds=self._default_timeout
-                             if max_age is None else max_age)
+        deadline = time.time() + self.lease_wait
+        while time.time() < deadline:
+            time.sleep(self.LEASE_POLL_INTERVAL)
+            fresh = self._select(keys, min_creation)
+            if len(fresh) == len(keys):
+                return dict((key, value) for key, (value, creation)
+                            in fresh.items())
 
+        # The other process is taking too long, or it failed
+        return self._refresh(refresh, rows, len(keys))
+
+    def _select(self, keys, min_creation):
+        key_to_row = {}
+        # The access times matter only for the LRU eviction
+        min_access = None
+        if self.max_entries is not None or self.max_bytes is not None:
+            min_access = int(time.time()) - self.ACCESS_RESOLUTION
+        touched = []
         cur = self._db_conn.cursor()
-        cur.execute('''SELECT value, creation FROM Cache
-                       WHERE key=?''', (key, ))
-        row = cur.fetchone()
+        # Old SQLite versions allow at most 999 parameters per query
+        for index in range(0, len(keys), self.MAX_QUERY_KEYS):
+            chunk = keys[index:index + self.MAX_QUERY_KEYS]
+            cur.execute('''SELECT key, value, creation, access, format
+                           FROM Cache
+                           WHERE key IN ({0}) AND creation>=?'''.format(
+                                            ', '.join('?' * len(chunk))),
+                        chunk + [min_creation])
+            for key, value, creation, access, format_ in cur:
+                try:
+                    value = self._decode(value, format_)
+                except KeyError:
+                    # Stored with a serializer that isn't configured, treat it
+                    # as missing, so that it's refreshed
+                    continue
+                key_to_row[key] = (value, creation)
+                if min_access is not None and access < min_access:
+                    touched.append(key)
+
+        if touched:
+            now = min_access + self.ACCESS_RESOLUTION
+            with self._db_conn:
+                for index in range(0, len(touched), self.MAX_QUERY_KEYS):
+                    chunk = touched[index:index + self.MAX_QUERY_KEYS]
+                    cur.execute('''UPDATE Cache SET access=?
+                                   WHERE key IN ({0})'''.format(
+                                            ', '.join('?' * len(chunk))),
+                                [now] + chunk)
+
         cur.close()
+        return key_to_row
+
+    def _encode(self, value):
+        if self.serializer is not None:
+            data = self.serializer.dumps(value)
+            format_ = self.serializer.tag
+        elif (self.compress_min_size is not None and
+                isinstance(value, type(''))):
+            data = value.encode('utf-8')
+            format_ = 'text'
+        else:
+            # Stored as it is, as by older versions
+            return value, None
+
+        if (self.compress_min_size is not None and
+                len(data) >= self.compress_min_size):
+            import zlib
+            data = zlib.compress(data)
+            format_ += '+zlib'
+        return sqlite3.Binary(data), format_
+
+    def _decode(self, value, format_):
+        if format_ is None:
+            return value
+        name, _, compression = format_.partition('+')
+        # Python 2 returns BLOBs as buffers
+        data = bytes(value)
+        if compression == 'zlib':
+            import zlib
+            data = zlib.decompress(data)
+        if name == 'text':
+            return data.decode('utf-8')
+        if self.serializer is not None and name == self.serializer.tag:
+            return self.serializer.loads(data)
+        # Values stored with another serializer can still be read, except
+        # pickles, which require the configured list of allowed classes
+        from .serializers import JSONSerializer, MarshalSerializer
+        for serializer in (JSONSerializer, MarshalSerializer):
+            if name == serializer.tag:
+                return serializer().loads(data)
+        raise KeyError(format_)
+
+    def _acquire_lease(self, lease, now):
+        with self._db_conn:
+            cur = self._db_conn.cursor()
+            # Leases left behind by crashed processes expire
+            cur.execute('''DELETE FROM CacheLeases
+                           WHERE key=? AND expiry<?''', (lease, now))
+            cur.execute('''INSERT OR IGNORE INTO CacheLeases (key, expiry)
+                           VALUES (?, ?)''', (lease, now + self.lease_timeout))
+            acquired = cur.rowcount == 1
+            cur.close()
+        return acquired
+
+    def _release_lease(self, lease):
+        # Called while an exception is being raised, which must not be
+        # replaced by this one
+        try:
+            with self._db_conn:
+                self._db_conn.execute('DELETE FROM CacheLeases WHERE key=?',
+                                      (lease, ))
+        except sqlite3.Error:
+            # The lease expires anyway after lease_timeout seconds
+            pass
 
-        if row:
-            age = (datetime.utcnow() -
-                   datetime.strptime(row['creation'], "%Y-%m-%dT%H:%M:%SZ"))
-            if age <= maxdelta:
-                return row['value']
+    def _refresh(self, refresh, rows, nkeys, lease=None):
+        try:
+            key_to_value = refresh()
+        except BaseException as exc:
+            if lease is not None:
+                self._release_lease(lease)
+            if (isinstance(exc, Exception) and self.stale_if_error and
+                    len(rows) == nkeys):
+                return dict((key, value) for key, (value, creation)
+                            in rows.items())
+            raise
+        self._store(key_to_value, lease)
+        return key_to_value
+
+    def clear(self, *keys):
+        with self._db_conn:
+            cur = self._db_conn.cursor()
+            self._delete(cur, list(keys))
+            cur.close()
+
+    def clear_all(self):
+        with self._db_conn:
+            self._db_conn.execute('''DELETE FROM Cache''')
+
+
+class TieredCache(Cache):
+    # Key of the backend value that changes whenever keys are cleared
+    GENERATION_KEY = 'retort.tiered.generation'
+
+    def __init__(self, backend, max_entries=1024, local_timeout=5,
+                 generation_check_interval=1):
+        """
+        Keep the most recently used values of the backend cache, e.g. a
+        SQLiteCache, in memory, for long-lived processes.
+
+        Values are kept in memory for at most local_timeout seconds, and never
+        longer than the max_age of the reads, counting from when they were
+        read from the backend; at most max_entries values are kept.
+
+        Clearing keys also changes a generation value in the backend, which
+        all the processes check every generation_check_interval seconds,
+        emptying their memory tier if it changed.
+
+        The hits and misses of each tier are counted in self.stats.
+        """
+        # For performance, do only what's strictly necessary to configure
+        # the object
+        super(TieredCache, self).__init__(
+                                default_timeout=backend._default_timeout)
+
+        global time
+        import time
+
+        global threading
+        import threading
+
+        self.backend = backend
+        self.max_entries = max_entries
+        self.local_timeout = local_timeout
+        self.generation_check_interval = generation_check_interval
+        # key: (value, time when it was read from the backend)
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        self._generation = None
+        self._next_generation_check = 0
+        self.stats = {'local': {'hits': 0, 'misses': 0},
+                      'backend': {'hits': 0, 'misses': 0}}
+
+    def _check_generation(self, now):
+        if now < self._next_generation_check:
+            return
+        self._next_generation_check = now + self.generation_check_interval
+        # The generation value must never expire
+        generation = self.backend.get(self.GENERATION_KEY, max_age=2 ** 31)
+        if generation != self._generation:
+            with self._lock:
+                self._entries.clear()
+            self._generation = generation
+
+    def _invalidate(self):
+        import uuid
+        # A random value, unlike a counter, can't go back to a value already
+        # seen by another process if the backend loses it
+        generation = uuid.uuid4().hex
+        self.backend.set(self.GENERATION_KEY, generation)
+        self._generation = generation
+
+    def _get_local(self, key, max_age, now):
+        max_age = (self._default_timeout if max_age is None else max_age)
+        min_time = now - min(self.local_timeout, max_age)
+        with self._lock:
+            try:
+                value, time_ = self._entries[key]
+            except KeyError:
+                return False, None
+            if time_ < min_time:
+                del self._entries[key]
+                return False, None
+            # Move the key to the end of the LRU order
+            del self._entries[key]
+            self._entries[key] = (value, time_)
+        return True, value
+
+    def _set_local(self, key_to_value, now):
+        with self._lock:
+            for key, value in key_to_value.items():
+                self._entries.pop(key, None)
+                self._entries[key] = (value, now)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+    @staticmethod
+    def _counting(refresh, calls):
+        # The backend missed if it had to call the refresh function
+        if not refresh:
+            return None
+
+        def counted_refresh():
+            calls.append(None)
+            return refresh()
+        return counted_refresh
+
+    def set(self, key, value):
+        self.set_dict({key: value})
+
+    def set_dict(self, key_to_value):
+        self.backend.set_dict(key_to_value)
+        self._set_local(key_to_value, time.time())
+
+    def get(self, key, max_age=None, refresh=None):
+        now = time.time()
+        self._check_generation(now)
+        found, value = self._get_local(key, max_age, now)
+        if found:
+            self.stats['local']['hits'] += 1
+            return value
+        self.stats['local']['misses'] += 1
+
+        calls = []
+        value = self.backend.get(key, max_age=max_age,
+                                 refresh=self._counting(refresh, calls))
+        if value is None or calls:
+            self.stats['backend']['misses'] += 1
+        else:
+            self.stats['backend']['hits'] += 1
+        if value is not None:
+            self._set_local({key: value}, now)
+        return value
+
+    def get_dict(self, *keys, **kwargs):
+        max_age = kwargs.pop('max_age', None)
+        refresh = kwargs.pop('refresh', None)
+
+        now = time.time()
+        self._check_generation(now)
+        key_to_value = {}
+        for key in keys:
+            found, value = self._get_local(key, max_age, now)
+            if not found:
+                break
+            key_to_value[key] = value
+        else:
+            self.stats['local']['hits'] += 1
+            return key_to_value
+        self.stats['local']['misses'] += 1
+
+        calls = []
+        key_to_value = self.backend.get_dict(
+                                        *keys, max_age=max_age,
+                                        refresh=self._counting(refresh, calls))
+        if calls or len(key_to_value) < len(set(keys)):
+            self.stats['backend']['misses'] += 1
+        else:
+            self.stats['backend']['hits'] += 1
+        self._set_local(key_to_value, now)
+        return key_to_value
+
+    def clear(self, *keys):
+        self.backend.clear(*keys)
+        with self._lock:
+            for key in keys:
+                self._entries.pop(key, None)
+        self._invalidate()
+
+    def clear_all(self):
+        self.backend.clear_all()
+        with self._lock:
+            self._entries.clear()
+        self._invalidate()
+
+
+class FileCache(Cache):
+    # Each value is stored in its own file, named after the hash of the key,
+    # in nested shard directories, so that no directory grows too large
+    SHARD_LEVELS = 2
+    SHARD_LENGTH = 2
+    # Values being written
+    TEMP_PREFIX = '.tmp'
+    # Temporary files older than this many seconds were left behind by
+    # crashed writers
+    TEMP_TIMEOUT = 3600
+
+    def __init__(self, directory, default_timeout=360, use_mmap=False):
+        """
+        Store every value in a separate file, so that concurrent writers,
+        e.g. CGI processes, never wait for each other, unlike with
+        SQLiteCache, whose writers share a single database lock.
+
+        Values are written to temporary files and renamed, so that readers
+        never see partial values; the age of a value is the modification time
+        of its file. If use_mmap is True, the files are read through mmap.
+        Like SQLiteCache without a serializer, it stores strings, bytes,
+        integers, floats and None.
+        """
+        # For performance, do only what's strictly necessary to configure
+        # the object
+        super(FileCache, self).__init__(default_timeout=default_timeout)
+
+        global time
+        import time
+
+        global errno
+        import errno
+
+        global numbers
+        import numbers
+
+        self._directory = directory
+        self._use_mmap = use_mmap
+
+    def _path(self, key):
+        import hashlib
+        # Python 2 byte strings, like those accepted by SQLiteCache, would be
+        # decoded as ASCII by encode()
+        if not isinstance(key, bytes):
+            key = key.encode('utf-8')
+        digest = hashlib.sha1(key).hexdigest()
+        shards = [digest[index * self.SHARD_LENGTH:
+                         (index + 1) * self.SHARD_LENGTH]
+                  for index in range(self.SHARD_LEVELS)]
+        return os.path.join(self._directory, *(shards + [digest]))
+
+    @staticmethod
+    def _encode(value):
+        # Each file starts with a line that tells the type of the value
+        if isinstance(value, type('')):
+            return b'text\n' + value.encode('utf-8')
+        if isinstance(value, bytes):
+            return b'bytes\n' + value
+        if value is None:
+            return b'null\n'
+        # Also Python 2's long; booleans are stored as integers, as by SQLite
+        if isinstance(value, numbers.Integral):
+            return 'int\n{0:d}'.format(value).encode('ascii')
+        if isinstance(value, float):
+            return 'float\n{0!r}'.format(value).encode('ascii')
+        raise TypeError('Unsupported type: {0}'.format(type(value).__name__))
+
+    @staticmethod
+    def _decode(data):
+        format_, _, data = data.partition(b'\n')
+        if format_ == b'text':
+            return data.decode('utf-8')
+        if format_ == b'bytes':
+            return data
+        if format_ == b'null':
+            return None
+        if format_ == b'int':
+            return int(data)
+        if format_ == b'float':
+            return float(data)
+        raise ValueError('Unknown format: {0!r}'.format(format_))
+
+    def _read(self, key, min_mtime):
+        """
+        Raise KeyError if the key doesn't exist or it's expired.
+        """
+        try:
+            file_ = open(self._path(key), 'rb')
+        except IOError as exc:
+            if exc.errno == errno.ENOENT:
+                raise KeyError(key)
+            raise
+        with file_:
+            stat = os.fstat(file_.fileno())
+            if stat.st_mtime < min_mtime:
+                raise KeyError(key)
+            if self._use_mmap and stat.st_size:
+                import mmap
+                map_ = mmap.mmap(file_.fileno(), 0, access=mmap.ACCESS_READ)
+                try:
+                    data = map_[:]
+                finally:
+                    map_.close()
+            else:
+                data = file_.read()
+        return self._decode(data)
+
+    def _write(self, key, value, mtime):
+        import tempfile
+        data = self._encode(value)
+        path = self._path(key)
+        directory = os.path.dirname(path)
+        try:
+            fd, temp_path = tempfile.mkstemp(prefix=self.TEMP_PREFIX,
+                                             dir=directory)
+        except OSError as exc:
+            if exc.errno != errno.ENOENT:
+                raise
+            try:
+                os.makedirs(directory)
+            except OSError as exc:
+                # Another process may have created it in the meantime
+                if exc.errno != errno.EEXIST:
+                    raise
+            fd, temp_path = tempfile.mkstemp(prefix=self.TEMP_PREFIX,
+                                             dir=directory)
+        try:
+            with os.fdopen(fd, 'wb') as file_:
+                file_.write(data)
+            os.utime(temp_path, (mtime, mtime))
+            # Atomic on POSIX systems, even if the file exists
+            os.rename(temp_path, path)
+        except BaseException:
+            os.unlink(temp_path)
+            raise
+
+    def _min_mtime(self, max_age):
+        return time.time() - (self._default_timeout if max_age is None
+                              else max_age)
+
+    def set(self, key, value):
+        self._write(key, value, time.time())
+
+    def set_dict(self, key_to_value):
+        mtime = time.time()
+        for key, value in key_to_value.items():
+            self._write(key, value, mtime)
+
+    def get(self, key, max_age=None, refresh=None):
+        try:
+            return self._read(key, self._min_mtime(max_age))
+        except KeyError:
+            pass
 
         # This is reached only if the key doesn't exist or it's expired
         if refresh:
@@ -158,50 +974,52 @@ class SQLiteCache(Cache):
             return value
 
     def get_dict(self, *keys, **kwargs):
-        # TODO: In theory there may be a race bug by which a server request
-        #       could trigger a duplicate value refresh if it happens *while*
-        #       this method is still running due to a previous, but
-        #       quasi-simultaneous request; it would be harmless, however, only
-        #       inefficient
         max_age = kwargs.pop('max_age', None)
         refresh = kwargs.pop('refresh', None)
 
+        min_mtime = self._min_mtime(max_age)
         key_to_value = {}
-        maxdelta = timedelta(seconds=self._default_timeout
-                             if max_age is None else max_age)
-        cur = self._db_conn.cursor()
-
         for key in keys:
-            cur.execute('''SELECT value, creation FROM Cache
-                           WHERE key=?''', (key, ))
-            row = cur.fetchone()
-
-            if row:
-                age = (datetime.utcnow() -
-                       datetime.strptime(row['creation'],
-                                         "%Y-%m-%dT%H:%M:%SZ"))
-                if age <= maxdelta:
-                    key_to_value[key] = row['value']
-                    continue
-
-            # This is reached only if a key doesn't exist or it's expired
-            if refresh:
-                key_to_value = refresh()
-                self.set_dict(key_to_value)
-                break
-
-        cur.close()
+            try:
+                key_to_value[key] = self._read(key, min_mtime)
+            except KeyError:
+                # This is reached only if a key doesn't exist or it's expired
+                if refresh:
+                    key_to_value = refresh()
+                    self.set_dict(key_to_value)
+                    break
         return key_to_value
 
     def clear(self, *keys):
-        cur = self._db_conn.cursor()
-        cur.execute('''DELETE FROM Cache WHERE key IN ({0})'''.format(
-                    ', '.join('?' * len(keys))), keys)
-        cur.close()
-        self._db_conn.commit()
+        for key in keys:
+            try:
+                os.unlink(self._path(key))
+            except OSError as exc:
+                if exc.errno != errno.ENOENT:
+                    raise
 
     def clear_all(self):
-        cur = self._db_conn.cursor()
-        cur.execute('''DELETE FROM Cache''')
-        cur.close()
-        self._db_conn.commit()
+        self.sweep(max_age=-1)
+
+    def sweep(self, max_age=None):
+        """
+        Delete the values older than max_age seconds, or than the default
+        timeout if None; expired values are otherwise never deleted. Also
+        delete the temporary files older than TEMP_TIMEOUT seconds.
+        """
+        min_mtime = self._min_mtime(max_age)
+        # Temporary files still being written must not be deleted, even by
+        # clear_all
+        min_temp_mtime = time.time() - self.TEMP_TIMEOUT
+        for directory, subdirectories, files in os.walk(self._directory):
+            for name in files:
+                path = os.path.join(directory, name)
+                try:
+                    if os.stat(path).st_mtime < (
+                            min_temp_mtime if name.startswith(self.TEMP_PREFIX)
+                            else min_mtime):
+                        os.unlink(path)
+                except OSError as exc:
+                    # Also removed by another process
+                    if exc.errno != errno.ENOENT:
+                        raise
@@ -27,8 +27,11 @@ from __future__ import (absolute_import, division,
 # https://pymotw.com/2/Cookie/
 # http://jayconrod.com/posts/17/how-to-use-http-cookies-in-python
 # https://en.wikipedia.org/wiki/HTTP_cookie#Cookie_attributes
-from Cookie import SimpleCookie
-from datetime import datetime, timedelta
+try:
+    from http.cookies import SimpleCookie
+except ImportError:
+    # Python 2
+    from Cookie import SimpleCookie
 
 
 class Cookie(SimpleCookie):
@@ -50,4 +53,5 @@ class Cookie(SimpleCookie):
         self[name]['expires'] = expires.strftime("%a, %d %b %Y %H:%M:%S GMT")
 
     def expire(self, name):
+        from datetime import datetime, timedelta
         self.store_expires(name, datetime.utcnow() + timedelta(days=-1))
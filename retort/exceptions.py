@@ -30,3 +30,17 @@ class RetortError(Exception):
 
 class ExistingSessionError(RetortError):
     pass
+
+
+class SessionPayloadTooLargeError(RetortError):
+    pass
+
+
+class RequestServed(BaseException):
+    """
+    Stop processing a request after serving its response, when the process
+    must not exit, e.g. in the workers of a persistent server.
+    """
+    # Like SystemExit, don't derive from Exception, so that handlers catching
+    # all the exceptions don't intercept it
+    pass
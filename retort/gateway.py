@@ -0,0 +1,225 @@
+# Retort - Simple Python CGI framework.
+# Copyright (C) 2016 Dario Giovannetti <dev@dariogiovannetti.net>
+#
+# This file is part of Retort.
+#
+# Retort is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# Retort is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with Retort.  If not, see <http://www.gnu.org/licenses/>.
+
+# The module must also support Python 2.6
+# http://python-future.org/
+from __future__ import (absolute_import, division,
+                        print_function, unicode_literals)
+# TODO: Test builtins.super
+# from builtins import super
+
+import sys
+import os
+
+from .exceptions import RequestServed
+
+
+class Gateway(object):
+    ENCODING = 'utf-8'
+    # Bytes read at a time from file-like bodies
+    CHUNK_SIZE = 65536
+
+    def __init__(self, environ, stdin=None):
+        """
+        Connect the application to the web server: provide the request
+        environment and body, and deliver the response.
+
+        If stdin is None, the request body is read from sys.stdin.
+        """
+        self.environ = environ
+        self.stdin = stdin
+
+    def _encode(self, data):
+        if isinstance(data, bytes):
+            return data
+        # Mimic print(), which CGIGateway uses
+        if not isinstance(data, type('')):
+            data = '{0}'.format(data)
+        return data.encode(self.ENCODING)
+
+    @staticmethod
+    def _is_stream(body):
+        """
+        Tell whether the body is an iterable, e.g. a generator, or a file-like
+        object, rather than a string.
+        """
+        return (not isinstance(body, (bytes, type(''))) and
+                (hasattr(body, 'read') or hasattr(body, '__iter__')))
+
+    def _iterate_chunks(self, body):
+        try:
+            if hasattr(body, 'read'):
+                while True:
+                    chunk = body.read(self.CHUNK_SIZE)
+                    if not chunk:
+                        break
+                    yield self._encode(chunk)
+            else:
+                for chunk in body:
+                    # Don't let empty chunks look like the end of the body
+                    if chunk:
+                        yield self._encode(chunk)
+        finally:
+            # Close files, and generators that were not exhausted
+            if hasattr(body, 'close'):
+                body.close()
+
+    def _write_chunks(self, stdout, body):
+        # Let the kernel copy files if possible, e.g. for FileResponse
+        if hasattr(body, 'sendfile'):
+            try:
+                fileno = stdout.fileno()
+            except (AttributeError, ValueError, IOError, OSError):
+                # Not a real file, e.g. a FastCGI stream
+                fileno = None
+            if fileno is not None:
+                stdout.flush()
+                if body.sendfile(fileno):
+                    return
+        for chunk in self._iterate_chunks(body):
+            stdout.write(chunk)
+
+    def send(self, response, body, headers=None):
+        """
+        Send the response headers, i.e. the list of (name, value) tuples in
+        headers, or response._list_headers() if None, and body; the body can
+        be a string, an iterable of strings, e.g. a generator, or a file-like
+        object, which are sent in chunks after the headers.
+        """
+        raise NotImplementedError()
+
+    def exit(self):
+        """
+        Stop processing the request after the response has been sent.
+        """
+        raise NotImplementedError()
+
+
+class CGIGateway(Gateway):
+    def __init__(self):
+        super(CGIGateway, self).__init__(os.environ)
+
+    def send(self, response, body, headers=None):
+        stream = self._is_stream(body)
+        # In Python 3 print() would write the representation of bytes, e.g.
+        # compressed bodies
+        if not stream and not (isinstance(body, bytes) and str is not bytes):
+            # Maximize client compatibility with \r\n
+            print(response._compile_headers(headers), body,
+                  sep='\r\n\r\n', end='')
+            return
+
+        # Don't mix the text and binary layers of stdout (Python 3)
+        sys.stdout.flush()
+        stdout = getattr(sys.stdout, 'buffer', sys.stdout)
+        # Send the headers as soon as possible
+        stdout.write(self._encode(response._compile_headers(headers)) +
+                     b'\r\n\r\n')
+        if stream:
+            stdout.flush()
+            self._write_chunks(stdout, body)
+        else:
+            stdout.write(body)
+        stdout.flush()
+
+    def exit(self):
+        # Don't test the remaining routes
+        sys.exit(0)
+
+
+class StreamGateway(Gateway):
+    def __init__(self, environ, stdin, stdout):
+        """
+        Serve a request in a long-lived process, writing the CGI response to a
+        binary stream, e.g. a FastCGI or SCGI connection.
+        """
+        super(StreamGateway, self).__init__(environ, stdin)
+        self.stdout = stdout
+        self.sent = False
+
+    def send(self, response, body, headers=None):
+        self.sent = True
+        headers = self._encode(response._compile_headers(headers))
+
+        if not self._is_stream(body):
+            # Maximize client compatibility with \r\n
+            self.stdout.write(b'\r\n\r\n'.join((headers,
+                                                self._encode(body))))
+            return
+
+        self.stdout.write(headers + b'\r\n\r\n')
+        self._write_chunks(self.stdout, body)
+
+    def exit(self):
+        # Don't test the remaining routes, but keep the process alive
+        raise RequestServed()
+
+
+class WSGIGateway(Gateway):
+    def __init__(self, environ):
+        """
+        Serve a request as a WSGI application: the response is stored, to be
+        returned to the WSGI server.
+        """
+        if str is not bytes:
+            # PEP 3333 decodes the path as latin-1, while CGI uses the
+            # file-system encoding
+            environ = environ.copy()
+            for name in ('SCRIPT_NAME', 'PATH_INFO'):
+                if name in environ:
+                    environ[name] = environ[name].encode('latin-1').decode(
+                                                self.ENCODING, 'replace')
+        super(WSGIGateway, self).__init__(environ, environ['wsgi.input'])
+        self.status = None
+        self.headers = None
+        self._bodies = []
+
+    def send(self, response, body, headers=None):
+        if self.status is None:
+            if headers is None:
+                headers = response._list_headers()
+            # WSGI requires native strings, i.e. bytes in Python 2
+            self.headers = []
+            for name, value in headers:
+                if name == 'Status':
+                    self.status = str(value)
+                else:
+                    self.headers.append((str(name), str(value)))
+        file_wrapper = self.environ.get('wsgi.file_wrapper')
+        if getattr(body, 'whole_file', False) and file_wrapper:
+            # The server may be able to send the file efficiently
+            self._bodies.append(file_wrapper(body.file, self.CHUNK_SIZE))
+        elif self._is_stream(body):
+            # The WSGI server will consume the chunks after the application
+            # returns
+            self._bodies.append(self._iterate_chunks(body))
+        else:
+            self._bodies.append([self._encode(body)])
+
+    @property
+    def body(self):
+        """
+        The iterable to be returned to the WSGI server.
+        """
+        if len(self._bodies) == 1:
+            return self._bodies[0]
+        return (chunk for body in self._bodies for chunk in body)
+
+    def exit(self):
+        # Don't test the remaining routes, but keep the process alive
+        raise RequestServed()
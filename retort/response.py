@@ -24,21 +24,46 @@ from __future__ import (absolute_import, division,
 # from builtins import super
 
 import sys
-import cgi
-from collections import OrderedDict
+import os
+import errno
+import time
+if sys.version_info >= (3, 7):
+    # Dictionaries preserve the insertion order, and collections doesn't need
+    # to be imported
+    _OrderedDict = dict
+else:
+    from collections import OrderedDict as _OrderedDict
+# Under CGI the modules are imported for every request, so cgi, Cookie,
+# datetime etc. are imported only when the features using them are used
 
-from .cookie import Cookie
 from .data import http_status_codes
 
 
 class Response(object):
     DEFAULT_STATUS = 200
     DEFAULT_CONTENT_TYPE = 'text/html'
+    DEFAULT_COMPRESS_MIN_SIZE = 1024
+    COMPRESS_LEVEL = 6
+    COMPRESSIBLE_CONTENT_TYPES = ('text/', 'application/json',
+                                  'application/javascript',
+                                  'application/xml', 'application/xhtml+xml',
+                                  'image/svg+xml')
 
     def __init__(self, status=DEFAULT_STATUS,
-                 content_type=DEFAULT_CONTENT_TYPE):
+                 content_type=DEFAULT_CONTENT_TYPE, etag=None, compress=False,
+                 compress_min_size=DEFAULT_COMPRESS_MIN_SIZE,
+                 cache_compressed=False):
         """
         Set up and send the HTTP response, headers and body.
+
+        If etag is 'strong' or 'weak', an ETag is computed from the body,
+        unless the handler sets one, and requests whose If-None-Match matches
+        it are answered with 304 Not Modified and no body.
+
+        If compress is True, bodies of at least compress_min_size bytes are
+        compressed with gzip or deflate, if the client accepts them; if
+        cache_compressed is True, the compressed bodies are also stored in the
+        application's cache, so that each one is compressed only once.
         """
         # For performance, do only what's strictly necessary to configure
         # the object, and leave everything else to post_init, since
@@ -46,8 +71,13 @@ class Response(object):
         # so this would become useless
         self.status = status
         self.content_type = content_type
+        self.etag = etag
+        self.compress = compress
+        self.compress_min_size = compress_min_size
+        self.cache_compressed = cache_compressed
 
     def post_init(self, app):
+        self.app = app
         # In theory the order of headers shouldn't count, but it depends on the
         # clients, so be safe here and use OrderedDict
         # Note that some header names can be repeated, so the values of the
@@ -55,15 +85,25 @@ class Response(object):
         # TODO: Implement generic set_header(), get_header(), add_header(),
         #       remove_header() ... methods to ensure that users enter tuples
         #       or lists as values, not simple strings
-        self.headers = OrderedDict()
+        self.headers = _OrderedDict()
         # TODO: Allow setting default cookies or cookie parameters
         #       Especially set default 'Domain' and 'Path' attributes
         #       Also make it easy to set 'Expires' and 'Max-Age' attributes
         #       https://en.wikipedia.org/wiki/HTTP_cookie#Cookie_attributes
-        self.cookies = Cookie()
+        # Created only when accessed, see the cookies property
+        self._cookies = None
+        # Set by OutputCache to a (cache, key) tuple to store the page
+        self.output_cache = None
         self.set_status(self.status)
         self.set_content_type(self.content_type)
 
+    @property
+    def cookies(self):
+        if self._cookies is None:
+            from .cookie import Cookie
+            self._cookies = Cookie()
+        return self._cookies
+
     def set_status(self, code):
         self.status = code
         self.headers['Status'] = (http_status_codes[code], )
@@ -75,24 +115,83 @@ class Response(object):
         self.content_type = content_type
         self.headers['Content-type'] = (content_type, )
 
-    def _compile_headers(self):
+    def set_etag(self, etag, weak=False):
+        """
+        Set the ETag header from a validator string, without quotes.
+        """
+        prefix = 'W/' if weak else ''
+        self.headers['ETag'] = ('{0}"{1}"'.format(prefix, etag), )
+
+    def check_etag(self, etag, weak=False):
+        """
+        Set the ETag header and, if the client already has this version of
+        the page, serve 304 Not Modified right away: call this with a cheap
+        validator, e.g. a version number, before generating an expensive body.
+        """
+        self.set_etag(etag, weak=weak)
+        matched = self._is_etag_matched()
+        if matched:
+            if matched != '*':
+                self.headers['ETag'] = (matched, )
+            self.set_status(304)
+            # The handler never returns, so Handler.serve can't save the
+            # session
+            if self.app.session is not None:
+                self.app.session.process_response(self.app)
+            self._send('', exit=True)
+
+    def _is_etag_matched(self):
+        environ = self.app.gateway.environ
+        if_none_match = environ.get('HTTP_IF_NONE_MATCH')
+        if (not if_none_match or 'ETag' not in self.headers or
+                environ.get('REQUEST_METHOD', 'GET') not in ('GET', 'HEAD')):
+            return False
+        if if_none_match.strip() == '*':
+            return '*'
+
+        # If-None-Match uses the weak comparison, which also ignores the
+        # suffix added to strong ETags of compressed bodies, so that
+        # check_etag() can match them before the body is generated
+        def opaque(etag):
+            etag = etag.strip()
+            if etag.startswith('W/'):
+                etag = etag[2:]
+            for suffix in ('-gzip"', '-deflate"'):
+                if etag.endswith(suffix):
+                    return etag[:-len(suffix)] + '"'
+            return etag
+
+        etag = opaque(self.headers['ETag'][0])
+        for tag in if_none_match.split(','):
+            if opaque(tag) == etag:
+                # Return the client's version of the ETag, which may carry
+                # the compression suffix
+                return tag.strip()
+        return False
+
+    def _list_headers(self):
         headers = []
         for name, values in self.headers.items():
             for value in values:
-                headers.append(': '.join((name, value)))
-        cookies = self.cookies.output()
-        # If no cookies are set this is an empty string which would add an
-        # unwanted empty line under the headers
-        if cookies:
-            headers.append(cookies)
+                headers.append((name, value))
+        if self._cookies:
+            # Same order as SimpleCookie.output()
+            for name, morsel in sorted(self._cookies.items()):
+                headers.append(('Set-Cookie', morsel.OutputString()))
+        return headers
+
+    def _compile_headers(self, headers=None):
+        if headers is None:
+            headers = self._list_headers()
         # Maximize client compatibility with \r\n
-        return '\r\n'.join(headers)
+        return '\r\n'.join(': '.join(header) for header in headers)
 
     def test(self):
         """
         Output cgi.test() and other information.
         """
         import io
+        import cgi
         import platform
 
         html = """<!doctype html>
@@ -129,9 +228,320 @@ class Response(object):
         return html
 
     def serve(self, body, exit=True):
-        # Maximize client compatibility with \r\n
-        print(self._compile_headers(), body, sep='\r\n\r\n', end='')
+        """
+        Send the headers and the body, which can also be an iterable of
+        strings, e.g. a generator, or a file-like object: the headers are
+        then sent first, and the body is written in chunks as it's produced.
+        """
+        if self.output_cache is not None:
+            from .cache import OutputCache
+            OutputCache.store(self, body)
+        if self.status == 200:
+            encoding = None
+            if isinstance(body, (bytes, type(''))):
+                if not isinstance(body, bytes) and (self.etag or
+                                                    self.compress):
+                    body = body.encode(self.app.gateway.ENCODING)
+                encoding = self._negotiate_encoding(body)
+                if self.etag and 'ETag' not in self.headers:
+                    import hashlib
+                    self.set_etag(hashlib.sha1(body).hexdigest(),
+                                  weak=self.etag == 'weak')
+                etag = self.headers.get('ETag')
+                if encoding and etag and not etag[0].startswith('W/'):
+                    # A strong ETag must be different for each encoding
+                    self.headers['ETag'] = ('{0}-{1}"'.format(etag[0][:-1],
+                                                              encoding), )
+            if self._is_etag_matched():
+                if hasattr(body, 'close'):
+                    body.close()
+                self.set_status(304)
+                body = ''
+            elif encoding:
+                body = self._compress(body, encoding)
+                self.headers['Content-Encoding'] = (encoding, )
+        self._send(body, exit=exit)
+
+    def _negotiate_encoding(self, body):
+        if (not self.compress or len(body) < self.compress_min_size or
+                'Content-Encoding' in self.headers or
+                not self.content_type.startswith(
+                                        self.COMPRESSIBLE_CONTENT_TYPES)):
+            return None
+
+        self.headers['Vary'] = self.headers.get('Vary', ()) + (
+                                                        'Accept-Encoding', )
+
+        qvalues = {}
+        for item in self.app.gateway.environ.get('HTTP_ACCEPT_ENCODING',
+                                                 '').split(','):
+            coding, _, params = item.partition(';')
+            qvalue = 1.0
+            params = params.strip().lower()
+            if params.startswith('q='):
+                try:
+                    qvalue = float(params[2:])
+                except ValueError:
+                    qvalue = 0.0
+            qvalues[coding.strip().lower()] = qvalue
+
+        best = None
+        best_qvalue = 0.0
+        # Prefer gzip when equally acceptable
+        for coding in ('gzip', 'deflate'):
+            qvalue = qvalues.get(coding, qvalues.get('*', 0.0))
+            if qvalue > best_qvalue:
+                best = coding
+                best_qvalue = qvalue
+        return best
+
+    def _compress(self, body, encoding):
+        cache = self.app.cache if self.cache_compressed else None
+        if cache is not None:
+            import hashlib
+            import base64
+            # Cache values are strings, so store the compressed bytes encoded
+            # in base64
+            key = 'retort.compressed.{0}.{1}'.format(
+                                encoding, hashlib.sha1(body).hexdigest())
+            compressed = cache.get(key)
+            if compressed is not None:
+                return base64.b64decode(compressed)
+
+        import zlib
+        # wbits=31 writes the gzip header and trailer, 15 the zlib ones,
+        # which HTTP calls 'deflate'
+        compressor = zlib.compressobj(self.COMPRESS_LEVEL, zlib.DEFLATED,
+                                      31 if encoding == 'gzip' else 15)
+        compressed = compressor.compress(body) + compressor.flush()
+
+        if cache is not None:
+            cache.set(key, base64.b64encode(compressed).decode('ascii'))
+        return compressed
+
+    def _send(self, body, exit=True):
+        # List the headers, i.e. also format the cookies, here, so that the
+        # response phase includes it
+        headers = self._list_headers()
+        timer = self.app._timer
+        if timer is not None:
+            timer.mark('response')
+            self.app.timing.before_send(self.app, timer, headers)
+        self.app.gateway.send(self, body, headers)
+        if timer is not None:
+            timer.mark('send')
+            self.app.timing.report(self.app, timer)
 
         if exit:
             # Don't test the remaining routes
-            sys.exit(0)
+            self.app.gateway.exit()
+
+
+class FileResponse(Response):
+    DEFAULT_CONTENT_TYPE = 'application/octet-stream'
+    # Serve the whole file if a client asks for more ranges than this
+    MAX_RANGES = 32
+
+    def __init__(self, status=Response.DEFAULT_STATUS,
+                 content_type=DEFAULT_CONTENT_TYPE, etag=None):
+        """
+        Send the contents of a file, supporting conditional (If-Modified-Since,
+        If-None-Match) and partial (Range) requests.
+
+        The handler returns the path of the file, or a file object opened in
+        binary mode, instead of the body. If etag is set, a weak ETag is
+        derived from the file's size and modification time.
+        """
+        super(FileResponse, self).__init__(status=status,
+                                           content_type=content_type,
+                                           etag=etag)
+
+    def serve(self, body, exit=True):
+        if isinstance(body, (bytes, type(''))):
+            file_ = open(body, 'rb')
+        else:
+            file_ = body
+        stat = os.fstat(file_.fileno())
+        size = stat.st_size
+        mtime = int(stat.st_mtime)
+        environ = self.app.gateway.environ
+
+        # Same format as cookie expiry dates
+        last_modified = time.strftime("%a, %d %b %Y %H:%M:%S GMT",
+                                      time.gmtime(mtime))
+        self.headers['Last-Modified'] = (last_modified, )
+        self.headers['Accept-Ranges'] = ('bytes', )
+        if self.etag and 'ETag' not in self.headers:
+            self.set_etag('{0:x}-{1:x}'.format(size, mtime), weak=True)
+
+        # If-None-Match takes precedence over If-Modified-Since
+        if self._is_etag_matched() or (
+                'HTTP_IF_NONE_MATCH' not in environ and
+                self._is_not_modified(environ.get('HTTP_IF_MODIFIED_SINCE'),
+                                      mtime)):
+            file_.close()
+            self.set_status(304)
+            return super(FileResponse, self).serve('', exit=exit)
+
+        ranges = None
+        if environ.get('HTTP_IF_RANGE', last_modified) == last_modified:
+            ranges = self._parse_ranges(environ.get('HTTP_RANGE'), size)
+
+        if ranges is None:
+            parts = [(0, size)]
+            length = size
+        elif not ranges:
+            file_.close()
+            self.set_status(416)
+            self.headers['Content-Range'] = ('bytes */{0}'.format(size), )
+            return super(FileResponse, self).serve('', exit=exit)
+        elif len(ranges) == 1:
+            self.set_status(206)
+            start, end = ranges[0]
+            self.headers['Content-Range'] = ('bytes {0}-{1}/{2}'.format(
+                                                        start, end, size), )
+            parts = [(start, end - start + 1)]
+            length = end - start + 1
+        else:
+            self.set_status(206)
+            parts = self._make_multipart(ranges, size)
+            length = sum(len(part) if isinstance(part, bytes) else part[1]
+                         for part in parts)
+
+        self.headers['Content-Length'] = ('{0}'.format(length), )
+
+        if environ.get('REQUEST_METHOD') == 'HEAD':
+            file_.close()
+            return super(FileResponse, self).serve('', exit=exit)
+
+        body = _FileBody(file_, parts, whole_file=ranges is None)
+        super(FileResponse, self).serve(body, exit=exit)
+
+    def _is_not_modified(self, if_modified_since, mtime):
+        if not if_modified_since:
+            return False
+        from email.utils import parsedate_tz, mktime_tz
+        date = parsedate_tz(if_modified_since)
+        if date is None:
+            return False
+        return mtime <= mktime_tz(date)
+
+    def _parse_ranges(self, header, size):
+        """
+        Return the list of satisfiable (first, last) byte ranges, or None if
+        the header is missing or invalid, i.e. it must be ignored.
+        """
+        if not header:
+            return None
+        unit, _, specs = header.partition('=')
+        if unit.strip().lower() != 'bytes':
+            return None
+        specs = [spec.strip() for spec in specs.split(',') if spec.strip()]
+        if not specs or len(specs) > self.MAX_RANGES:
+            return None
+
+        ranges = []
+        for spec in specs:
+            first, sep, last = spec.partition('-')
+            if not sep:
+                return None
+            try:
+                if first:
+                    first = int(first)
+                    if last:
+                        last = int(last)
+                        if last < first:
+                            return None
+                        last = min(last, size - 1)
+                    else:
+                        last = size - 1
+                else:
+                    # Suffix range, i.e. the last bytes of the file
+                    suffix = int(last)
+                    first = max(0, size - suffix)
+                    last = size - 1 if suffix else -1
+            except ValueError:
+                return None
+            if first <= last:
+                ranges.append((first, last))
+        return ranges
+
+    def _make_multipart(self, ranges, size):
+        import binascii
+        boundary = binascii.hexlify(os.urandom(16)).decode('ascii')
+        content_type = self.content_type
+        self.set_content_type('multipart/byteranges; boundary={0}'.format(
+                                                                    boundary))
+        parts = []
+        for first, last in ranges:
+            parts.append('\r\n--{0}\r\nContent-Type: {1}\r\n'
+                         'Content-Range: bytes {2}-{3}/{4}\r\n\r\n'.format(
+                                boundary, content_type, first, last, size)
+                         .encode('ascii'))
+            parts.append((first, last - first + 1))
+        parts.append('\r\n--{0}--\r\n'.format(boundary).encode('ascii'))
+        return parts
+
+
+class _FileBody(object):
+    CHUNK_SIZE = 65536
+
+    def __init__(self, file_, parts, whole_file=False):
+        """
+        Response body made of byte strings and (offset, length) ranges of a
+        file, which are never read in memory all at once.
+        """
+        self.file = file_
+        self.parts = parts
+        self.whole_file = whole_file
+
+    def __iter__(self):
+        for part in self.parts:
+            if isinstance(part, bytes):
+                yield part
+                continue
+            offset, length = part
+            self.file.seek(offset)
+            while length > 0:
+                chunk = self.file.read(min(length, self.CHUNK_SIZE))
+                if not chunk:
+                    # The file was truncated
+                    break
+                length -= len(chunk)
+                yield chunk
+
+    def close(self):
+        self.file.close()
+
+    def sendfile(self, fileno):
+        """
+        Copy the file to the file descriptor in the kernel, if possible;
+        return False if nothing was sent.
+        """
+        if (not hasattr(os, 'sendfile') or len(self.parts) != 1 or
+                isinstance(self.parts[0], bytes)):
+            return False
+        offset, length = self.parts[0]
+        source = self.file.fileno()
+        started = False
+        try:
+            while length > 0:
+                try:
+                    sent = os.sendfile(fileno, source, offset, length)
+                except OSError as exc:
+                    if not started and exc.errno in (errno.EINVAL,
+                                                     errno.ENOSYS):
+                        return False
+                    if exc.errno == errno.EAGAIN:
+                        continue
+                    raise
+                if not sent:
+                    # The file was truncated
+                    break
+                started = True
+                offset += sent
+                length -= sent
+        finally:
+            if started or length <= 0:
+                self.close()
+        return True
@@ -23,6 +23,47 @@ from __future__ import (absolute_import, division,
 # TODO: Test builtins.super
 # from builtins import super
 
+import sys
+
+# Handlers referenced by dotted path, e.g. 'site.pages.reports:make'
+_STRING_TYPES = (str, type(''))
+_lazy_handlers = {}
+
+
+def _resolve(path):
+    """
+    Import and return the object referenced by a 'package.module:attribute'
+    path, or the module itself if the path has no attribute part.
+    """
+    try:
+        return _lazy_handlers[path]
+    except KeyError:
+        pass
+    module_name, _, attributes = path.partition(':')
+    __import__(module_name)
+    handler = sys.modules[module_name]
+    if attributes:
+        for attribute in attributes.split('.'):
+            handler = getattr(handler, attribute)
+    _lazy_handlers[path] = handler
+    return handler
+
+
+def _copy(obj):
+    """
+    Shallow-copy obj like copy.copy(), but without importing the copy module,
+    which would be a large part of the startup time of every CGI request.
+    """
+    cls = type(obj)
+    # Python 2's old-style instances are of another type than their class
+    if (cls is not obj.__class__ or hasattr(cls, '__copy__') or
+            not hasattr(obj, '__dict__')):
+        from copy import copy
+        return copy(obj)
+    clone = cls.__new__(cls)
+    clone.__dict__.update(obj.__dict__)
+    return clone
+
 
 class Diversion(object):
     def __init__(self, alias, *args, **kwargs):
@@ -35,41 +76,103 @@ class Diversion(object):
 
 
 class Handler(object):
-    def __init__(self, handler, session=None, response=None):
+    def __init__(self, handler, session=None, response=None,
+                 output_cache=None):
+        """
+        handler can be an object with a 'make' attribute, e.g. a module, a
+        callable, or a 'package.module:attribute' string, which is imported
+        only when the handler is served.
+        """
         self.handler = handler
         self.session = session
         self.response = response
+        self.output_cache = output_cache
 
     def serve(self, app, *args, **kwargs):
-        try:
-            function = self.handler.make
-        except AttributeError:
-            function = self.handler
+        # Untimed requests only pay for these checks
+        timer = app._timer
+        if timer is not None:
+            timer.mark('dispatch')
+
+        # A handler that hands the request over, e.g. with redirect() or
+        # divert(), never reaches the end of this method: save its session
+        # now, and keep the cookies that it set
+        previous_response = app.response
+        previous_session = app.session
+        if previous_session is not None:
+            previous_session.process_response(app)
 
-        app.response = self.response or app._default_response
+        # Use copies of the response and session objects, so that the state of
+        # a request never leaks into the next one in long-lived processes
+        app.response = _copy(self.response or app._default_response)
         app.response.post_init(app)
+        if previous_response is not None and previous_response._cookies:
+            app.response.cookies.update(previous_response._cookies)
 
         # Store the response *before* storing the session, since the
         # session may need to set the response headers
 
-        app.session = self.session or app._default_session
-        app.session.process_request(app)
+        session = self.session or app._default_session
+        if self.output_cache is not None:
+            # A stored page is served right away, without processing the
+            # session
+            self.output_cache.process_request(app, session)
+            if timer is not None:
+                timer.mark('output_cache')
 
+        # Keep the session of a handler that handed the request over, if it's
+        # the same, since its state may be newer than the one in the request,
+        # e.g. in the cookie of a SignedCookieSession
+        if previous_session is None or session is not app._session_source:
+            app.session = _copy(session)
+            app._session_source = session
+            app.session.process_request(app)
+        if timer is not None:
+            timer.mark('session')
+
+        handler = self.handler
+        if isinstance(handler, _STRING_TYPES):
+            # Under CGI, import only the module of the handler that is
+            # actually called, i.e. not if the page is served from the output
+            # cache
+            handler = _resolve(handler)
+        try:
+            function = handler.make
+        except AttributeError:
+            function = handler
         body = function(app, *args, **kwargs)
+        if timer is not None:
+            timer.mark('handler')
+        app.session.process_response(app)
+        if timer is not None:
+            timer.mark('session_save')
         app.response.serve(body)
 
 
 class _Route(Handler):
-    def __init__(self, handler, session=None, response=None):
+    def __init__(self, handler, session=None, response=None,
+                 output_cache=None):
         super(_Route, self).__init__(handler, session=session,
-                                     response=response)
+                                     response=response,
+                                     output_cache=output_cache)
+
+    def index(self, dispatcher, position):
+        """
+        Register the route in the dispatcher's index; routes that cannot be
+        indexed are tested for every url.
+        """
+        dispatcher.add_generic(position)
 
     def attempt(self, app):
-        self.serve_args = []
-        self.serve_kwargs = {}
-        testres = self.test(app)
+        # test() stores the arguments in the route, so use a copy, since the
+        # same route may be attempted concurrently, e.g. by a multi-threaded
+        # WSGI server
+        route = _copy(self)
+        route.serve_args = []
+        route.serve_kwargs = {}
+        testres = route.test(app)
         if testres:
-            self.serve(app, *self.serve_args, **self.serve_kwargs)
+            route.serve(app, *route.serve_args, **route.serve_kwargs)
 
     def test(self, app):
         raise NotImplementedError()
@@ -81,27 +184,168 @@ class RouteDefault(_Route):
 
 
 class RouteExact(_Route):
-    def __init__(self, url, handler, session=None, response=None):
+    def __init__(self, url, handler, session=None, response=None,
+                 output_cache=None):
         super(RouteExact, self).__init__(handler, session=session,
-                                         response=response)
+                                         response=response,
+                                         output_cache=output_cache)
         self.url = url
 
+    def index(self, dispatcher, position):
+        dispatcher.add_exact(self.url, position)
+
     def test(self, app):
         return self.url == app.request.redirect_url
 
 
 class RouteRegex(_Route):
-    def __init__(self, pattern, handler, flags=0, session=None, response=None):
+    def __init__(self, pattern, handler, flags=0, session=None, response=None,
+                 output_cache=None):
         super(RouteRegex, self).__init__(handler, session=session,
-                                         response=response)
+                                         response=response,
+                                         output_cache=output_cache)
         self.pattern = pattern
         self.flags = flags
+        # Compile the pattern only when it's tested for the first time, under
+        # CGI most routes are never tested at all
+        self._regex = None
+
+    def index(self, dispatcher, position):
+        dispatcher.add_prefix(_literal_prefix(self.pattern, self.flags),
+                              position)
+
+    def _match(self, app):
+        if self._regex is None:
+            import re
+            self._regex = re.compile(self.pattern, self.flags)
+        return self._regex.match(app.request.redirect_url)
+
+    def attempt(self, app):
+        # Subclasses may add conditions to test(); compare with == since
+        # Python 2 creates a new unbound method at every access
+        if type(self).test != RouteRegex.test:
+            return super(RouteRegex, self).attempt(app)
+        # Don't copy the route, the match is not stored in it
+        match = self._match(app)
+        if match:
+            self.serve(app, match)
 
     def test(self, app):
-        import re
-        match = re.match(self.pattern, app.request.redirect_url,
-                         flags=self.flags)
+        match = self._match(app)
         if match:
             self.serve_args.append(match)
             return True
         return False
+
+
+_regex_literal_prefix = None
+
+
+def _literal_prefix(pattern, flags=0):
+    """
+    Return the literal string that every url matched by the pattern (with
+    re.match) must start with; the empty string is always a safe answer.
+    """
+    global _regex_literal_prefix
+    import re
+
+    if flags & (re.IGNORECASE | re.VERBOSE):
+        return ''
+
+    # Top-level alternations and global inline flags, e.g. '(?i)', which in
+    # old Python versions may also appear in the middle of the pattern, make
+    # any prefix unreliable
+    if ('|' in pattern or '(?' in pattern) and _unsafe_for_prefix(pattern):
+        return ''
+
+    if _regex_literal_prefix is None:
+        # Escaped alphanumeric characters are special sequences, e.g. '\\d'
+        _regex_literal_prefix = re.compile(r'(?:\^|\\A)?'
+                                           r'((?:[^.^$*+?{}\[\]\\|()]|'
+                                           r'\\[^A-Za-z0-9_])*)'
+                                           r'([*?{]?)')
+    literal, quantifier = _regex_literal_prefix.match(pattern).groups()
+    if '\\' in literal:
+        literal = re.sub(r'\\(.)', r'\1', literal)
+    if quantifier:
+        # The last character may not be repeated at all
+        literal = literal[:-1]
+    return literal
+
+
+def _unsafe_for_prefix(pattern):
+    depth = 0
+    index = 0
+    while index < len(pattern):
+        char = pattern[index]
+        if char == '\\':
+            index += 1
+        elif char == '[':
+            index += 1
+            if pattern[index:index + 1] == '^':
+                index += 1
+            # ']' is literal if it's the first character of the class
+            if pattern[index:index + 1] == ']':
+                index += 1
+            while index < len(pattern) and pattern[index] != ']':
+                if pattern[index] == '\\':
+                    index += 1
+                index += 1
+        elif char == '(':
+            if pattern.startswith('(?', index):
+                end = pattern.find(')', index)
+                if end > 0 and pattern[index + 2:end].isalpha():
+                    return True
+            depth += 1
+        elif char == ')':
+            depth -= 1
+        elif char == '|' and depth == 0:
+            return True
+        index += 1
+    return False
+
+
+class _Dispatcher(object):
+    def __init__(self, routes):
+        """
+        Index the routes so that only the ones that may match a url are tested,
+        in declaration order.
+
+        Exact urls are looked up in a dictionary, regular expressions are
+        grouped by their literal prefix, and any other route is tested for
+        every url.
+        """
+        self.routes = list(routes)
+        self._exact = {}
+        self._prefixes = {}
+        self._generic = []
+        for position, route in enumerate(self.routes):
+            route.index(self, position)
+        self._prefix_lengths = sorted(set(len(prefix)
+                                          for prefix in self._prefixes))
+
+    def add_exact(self, url, position):
+        # Only the first route declared for a url can ever be served
+        self._exact.setdefault(url, position)
+
+    def add_prefix(self, prefix, position):
+        self._prefixes.setdefault(prefix, []).append(position)
+
+    def add_generic(self, position):
+        self._generic.append(position)
+
+    def candidates(self, url):
+        """
+        Return the routes that must be attempted for the url, in declaration
+        order.
+        """
+        positions = list(self._generic)
+        position = self._exact.get(url)
+        if position is not None:
+            positions.append(position)
+        for length in self._prefix_lengths:
+            if length > len(url):
+                break
+            positions.extend(self._prefixes.get(url[:length], ()))
+        positions.sort()
+        return [self.routes[position] for position in positions]
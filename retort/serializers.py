@@ -0,0 +1,104 @@
+# Retort - Simple Python CGI framework.
+# Copyright (C) 2016 Dario Giovannetti <dev@dariogiovannetti.net>
+#
+# This file is part of Retort.
+#
+# Retort is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# Retort is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with Retort.  If not, see <http://www.gnu.org/licenses/>.
+
+# The module must also support Python 2.6
+# http://python-future.org/
+from __future__ import (absolute_import, division,
+                        print_function, unicode_literals)
+# TODO: Test builtins.super
+# from builtins import super
+
+import io
+
+
+class Serializer(object):
+    # Stored with every value, so that it can be deserialized even if the
+    # cache is later configured with another serializer
+    tag = None
+
+    def dumps(self, value):
+        """
+        Return the value serialized to bytes.
+        """
+        raise NotImplementedError()
+
+    def loads(self, data):
+        raise NotImplementedError()
+
+
+class JSONSerializer(Serializer):
+    tag = 'json'
+
+    def dumps(self, value):
+        import json
+        return json.dumps(value, separators=(',', ':')).encode('utf-8')
+
+    def loads(self, data):
+        import json
+        return json.loads(data.decode('utf-8'))
+
+
+class MarshalSerializer(Serializer):
+    """
+    Faster than JSON, but the format may change between Python versions.
+    """
+    tag = 'marshal'
+
+    def dumps(self, value):
+        import marshal
+        return marshal.dumps(value)
+
+    def loads(self, data):
+        import marshal
+        return marshal.loads(data)
+
+
+class PickleSerializer(Serializer):
+    tag = 'pickle'
+    # Built-in types that pickle can't store without naming them; Python 3
+    # stores bytes with _codecs.encode in protocol 2
+    SAFE_CLASSES = ('builtins.set', 'builtins.frozenset', 'builtins.complex',
+                    'builtins.bytearray', '_codecs.encode')
+
+    def __init__(self, allowed_classes=()):
+        """
+        Unpickling can run arbitrary code, so only the built-in types and the
+        classes in allowed_classes, e.g. 'datetime.datetime', can be loaded.
+        """
+        self.allowed_classes = frozenset(allowed_classes)
+
+    def dumps(self, value):
+        import pickle
+        # Also readable by Python 2
+        return pickle.dumps(value, protocol=2)
+
+    def loads(self, data):
+        import pickle
+        allowed_classes = self.allowed_classes.union(self.SAFE_CLASSES)
+
+        class RestrictedUnpickler(pickle.Unpickler):
+            def find_class(self, module, name):
+                # Python 2's name of the builtins module
+                qualified_module = ('builtins' if module == '__builtin__'
+                                    else module)
+                qualified_name = '{0}.{1}'.format(qualified_module, name)
+                if qualified_name in allowed_classes:
+                    return pickle.Unpickler.find_class(self, module, name)
+                raise pickle.UnpicklingError(
+                            'Class not allowed: {0}.{1}'.format(module, name))
+        return RestrictedUnpickler(io.BytesIO(data)).load()
@@ -0,0 +1,463 @@
+# Retort - Simple Python CGI framework.
+# Copyright (C) 2016 Dario Giovannetti <dev@dariogiovannetti.net>
+#
+# This file is part of Retort.
+#
+# Retort is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# Retort is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with Retort.  If not, see <http://www.gnu.org/licenses/>.
+
+# The module must also support Python 2.6
+# http://python-future.org/
+from __future__ import (absolute_import, division,
+                        print_function, unicode_literals)
+# TODO: Test builtins.super
+# from builtins import super
+
+import sys
+import os
+import errno
+import signal
+import socket
+import struct
+import time
+import traceback
+
+from .gateway import StreamGateway
+
+# http://www.mit.edu/~yandros/doc/specs/fcgi-spec.html
+_FCGI_VERSION_1 = 1
+_FCGI_BEGIN_REQUEST = 1
+_FCGI_ABORT_REQUEST = 2
+_FCGI_END_REQUEST = 3
+_FCGI_PARAMS = 4
+_FCGI_STDIN = 5
+_FCGI_STDOUT = 6
+_FCGI_GET_VALUES = 9
+_FCGI_GET_VALUES_RESULT = 10
+_FCGI_UNKNOWN_TYPE = 11
+_FCGI_RESPONDER = 1
+_FCGI_KEEP_CONN = 1
+_FCGI_REQUEST_COMPLETE = 0
+_FCGI_CANT_MPX_CONN = 1
+_FCGI_UNKNOWN_ROLE = 3
+# Python 2.6's struct doesn't accept unicode formats
+_FCGI_HEADER = struct.Struct(str('!BBHHBx'))
+_FCGI_BEGIN_REQUEST_BODY = struct.Struct(str('!HB5x'))
+_FCGI_END_REQUEST_BODY = struct.Struct(str('!IB3x'))
+_FCGI_UNKNOWN_TYPE_BODY = struct.Struct(str('!B7x'))
+# Keep the records 8-byte aligned
+_FCGI_MAX_CONTENT = 65528
+
+_ERROR_RESPONSE = (b'Status: 500 Internal Server Error\r\n'
+                   b'Content-type: text/plain\r\n\r\n')
+
+
+def _native(data):
+    # Like os.environ: bytes in Python 2, str in Python 3
+    if str is bytes:
+        return data
+    return data.decode('utf-8', 'surrogateescape')
+
+
+def _bytes(data):
+    if isinstance(data, bytes):
+        return data
+    return data.encode('utf-8')
+
+
+class _PreforkServer(object):
+    # Seconds between the checks for dead workers
+    POLL_INTERVAL = 0.5
+
+    def __init__(self, app, address, workers=4, max_requests=0, backlog=128):
+        """
+        Accept the connections from the web server in a pool of forked worker
+        processes, each reusing the same application for many requests.
+        """
+        self.app = app
+        self.address = address
+        self.workers = workers
+        self.max_requests = max_requests
+        self.backlog = backlog
+        # Only the master process uses these
+        self._worker_generations = {}
+        self._generation = 0
+        self._stopping = False
+        self._restarting = False
+        # Only the workers use these
+        self._served = 0
+        self._busy = False
+
+    def handle_connection(self, sock):
+        raise NotImplementedError()
+
+    def serve_forever(self):
+        self._socket = self._listen()
+        # Set up the application only once, before forking, so that the
+        # workers share it
+        self.app._get_dispatcher()
+
+        signal.signal(signal.SIGTERM, self._handle_stop)
+        signal.signal(signal.SIGINT, self._handle_stop)
+        signal.signal(signal.SIGHUP, self._handle_restart)
+
+        try:
+            while not self._stopping:
+                if self._restarting:
+                    self._restarting = False
+                    self._generation += 1
+                    # The old workers finish their current request and then
+                    # exit, they are no longer counted
+                    for pid in list(self._worker_generations):
+                        self._kill(pid)
+                self._reap()
+                while (sum(1 for generation in
+                           self._worker_generations.values()
+                           if generation == self._generation) <
+                       self.workers):
+                    self._spawn()
+                time.sleep(self.POLL_INTERVAL)
+        finally:
+            for pid in list(self._worker_generations):
+                self._kill(pid)
+            while self._worker_generations:
+                try:
+                    pid = os.wait()[0]
+                except OSError as exc:
+                    if exc.errno == errno.ECHILD:
+                        break
+                    if exc.errno != errno.EINTR:
+                        raise
+                else:
+                    self._worker_generations.pop(pid, None)
+            self._socket.close()
+            if self.address is not None and not isinstance(self.address,
+                                                           tuple):
+                os.unlink(self.address)
+
+    def _listen(self):
+        if self.address is None:
+            # The web server passes the listening socket as the standard
+            # input, as FastCGI applications expect
+            try:
+                return socket.socket(fileno=0)
+            except TypeError:
+                # Python < 3.7
+                return socket.fromfd(0, socket.AF_UNIX, socket.SOCK_STREAM)
+        if isinstance(self.address, tuple):
+            sock = socket.socket(socket.AF_INET6 if ':' in self.address[0]
+                                 else socket.AF_INET, socket.SOCK_STREAM)
+            sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        else:
+            if os.path.exists(self.address):
+                os.unlink(self.address)
+            sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        sock.bind(self.address)
+        sock.listen(self.backlog)
+        return sock
+
+    def _handle_stop(self, signum, frame):
+        self._stopping = True
+
+    def _handle_restart(self, signum, frame):
+        self._restarting = True
+
+    def _kill(self, pid):
+        try:
+            os.kill(pid, signal.SIGTERM)
+        except OSError as exc:
+            if exc.errno != errno.ESRCH:
+                raise
+
+    def _reap(self):
+        while self._worker_generations:
+            try:
+                pid = os.waitpid(-1, os.WNOHANG)[0]
+            except OSError as exc:
+                if exc.errno == errno.EINTR:
+                    continue
+                if exc.errno != errno.ECHILD:
+                    raise
+                pid = 0
+            if not pid:
+                break
+            self._worker_generations.pop(pid, None)
+
+    def _spawn(self):
+        pid = os.fork()
+        if pid:
+            self._worker_generations[pid] = self._generation
+            return
+        status = 0
+        try:
+            self._work()
+        except SystemExit as exc:
+            status = exc.code or 0
+        except BaseException:
+            traceback.print_exc()
+            status = 1
+        finally:
+            # Never return to the master's loop
+            sys.stdout.flush()
+            sys.stderr.flush()
+            os._exit(status)
+
+    def _work(self):
+        signal.signal(signal.SIGTERM, self._handle_worker_stop)
+        # The master also receives these and stops or restarts the workers
+        signal.signal(signal.SIGINT, signal.SIG_IGN)
+        signal.signal(signal.SIGHUP, signal.SIG_IGN)
+
+        while self._keep_serving():
+            try:
+                sock = self._socket.accept()[0]
+            except socket.error as exc:
+                # Python < 3.5 doesn't retry after signals
+                if exc.args[0] == errno.EINTR:
+                    continue
+                raise
+            # Don't interrupt a connection as soon as it's accepted
+            self._busy = True
+            try:
+                self.handle_connection(sock)
+            finally:
+                self._busy = False
+                self._close(sock)
+
+    def _close(self, sock):
+        # Other objects, e.g. files made with makefile(), may still reference
+        # the connection, which would prevent close() from ending it
+        try:
+            sock.shutdown(socket.SHUT_RDWR)
+        except socket.error:
+            # The web server may have already closed it
+            pass
+        sock.close()
+
+    def _handle_worker_stop(self, signum, frame):
+        self._stopping = True
+        if not self._busy:
+            # Interrupt waiting for a connection or a request
+            sys.exit(0)
+
+    def _keep_serving(self):
+        return not self._stopping and not (
+                        self.max_requests and
+                        self._served >= self.max_requests)
+
+    def serve_request(self, environ, stdin, stdout):
+        gateway = StreamGateway(environ, stdin, stdout)
+        try:
+            self.app._serve(gateway)
+        except Exception:
+            traceback.print_exc()
+            if not gateway.sent:
+                body = b''
+                if self.app._debug:
+                    body = traceback.format_exc().encode('utf-8')
+                stdout.write(_ERROR_RESPONSE + body)
+        finally:
+            self._served += 1
+
+
+class FastCGIServer(_PreforkServer):
+    def handle_connection(self, sock):
+        """
+        Serve the requests of a FastCGI connection one at a time; requests
+        are not multiplexed.
+        """
+        connection = _FastCGIConnection(sock)
+        request_id = None
+
+        while True:
+            if request_id is None:
+                # Waiting for the next request on a kept connection can be
+                # interrupted
+                if self._stopping:
+                    return
+                self._busy = False
+            record = connection.read_record()
+            self._busy = True
+            if record is None:
+                return
+            type_, record_id, content = record
+
+            if record_id == 0:
+                connection.answer_management_record(type_, content)
+            elif type_ == _FCGI_BEGIN_REQUEST:
+                role, flags = _FCGI_BEGIN_REQUEST_BODY.unpack(content)
+                if request_id is not None:
+                    connection.end_request(record_id, _FCGI_CANT_MPX_CONN)
+                elif role != _FCGI_RESPONDER:
+                    connection.end_request(record_id, _FCGI_UNKNOWN_ROLE)
+                else:
+                    request_id = record_id
+                    keep_conn = flags & _FCGI_KEEP_CONN
+                    params = []
+                    stdin = _spooled_file()
+            elif record_id != request_id:
+                # Records of rejected requests
+                continue
+            elif type_ == _FCGI_ABORT_REQUEST:
+                connection.end_request(request_id, _FCGI_REQUEST_COMPLETE)
+                request_id = None
+                if not keep_conn:
+                    return
+            elif type_ == _FCGI_PARAMS:
+                params.append(content)
+            elif type_ == _FCGI_STDIN:
+                if content:
+                    stdin.write(content)
+                    continue
+                # An empty record ends the request's standard input
+                stdin.seek(0)
+                stdout = _FastCGIStdout(connection, request_id)
+                self.serve_request(
+                            _parse_fastcgi_params(b''.join(params)),
+                            stdin, stdout)
+                stdout.close()
+                connection.end_request(request_id, _FCGI_REQUEST_COMPLETE)
+                stdin.close()
+                request_id = None
+                if not keep_conn or not self._keep_serving():
+                    return
+
+
+class SCGIServer(_PreforkServer):
+    def handle_connection(self, sock):
+        """
+        Serve the only request of an SCGI connection.
+        """
+        # https://python.ca/scgi/protocol.txt
+        rfile = sock.makefile('rb')
+        wfile = sock.makefile('wb')
+        try:
+            length = b''
+            while True:
+                char = rfile.read(1)
+                if not char:
+                    return
+                if char == b':':
+                    break
+                length += char
+            headers = rfile.read(int(length))
+            if rfile.read(1) != b',':
+                return
+            items = headers.split(b'\0')
+            environ = {}
+            for index in range(0, len(items) - 1, 2):
+                environ[_native(items[index])] = _native(items[index + 1])
+            self.serve_request(environ, rfile, wfile)
+            wfile.flush()
+        finally:
+            rfile.close()
+            wfile.close()
+
+
+def _spooled_file():
+    import tempfile
+    # Keep small request bodies in memory
+    return tempfile.SpooledTemporaryFile(max_size=1024 * 1024)
+
+
+def _parse_fastcgi_params(data):
+    data = bytearray(data)
+    params = {}
+    index = 0
+    while index < len(data):
+        lengths = []
+        for _ in range(2):
+            if data[index] < 128:
+                lengths.append(data[index])
+                index += 1
+            else:
+                lengths.append(struct.unpack(str('!I'), bytes(
+                                data[index:index + 4]))[0] & 0x7fffffff)
+                index += 4
+        name = bytes(data[index:index + lengths[0]])
+        index += lengths[0]
+        value = bytes(data[index:index + lengths[1]])
+        index += lengths[1]
+        params[_native(name)] = _native(value)
+    return params
+
+
+def _format_fastcgi_params(params):
+    data = []
+    for name, value in params:
+        name = _bytes(name)
+        value = _bytes(value)
+        for item in (name, value):
+            if len(item) < 128:
+                data.append(struct.pack(str('!B'), len(item)))
+            else:
+                data.append(struct.pack(str('!I'), len(item) | 0x80000000))
+        data.append(name)
+        data.append(value)
+    return b''.join(data)
+
+
+class _FastCGIConnection(object):
+    def __init__(self, sock):
+        self._sock = sock
+        self._rfile = sock.makefile('rb')
+
+    def read_record(self):
+        header = self._rfile.read(_FCGI_HEADER.size)
+        if len(header) < _FCGI_HEADER.size:
+            return None
+        type_, request_id, length, padding = _FCGI_HEADER.unpack(header)[1:]
+        content = self._rfile.read(length)
+        self._rfile.read(padding)
+        return type_, request_id, content
+
+    def write_record(self, type_, request_id, content=b''):
+        padding = -len(content) % 8
+        self._sock.sendall(b''.join((
+                _FCGI_HEADER.pack(_FCGI_VERSION_1, type_, request_id,
+                                  len(content), padding),
+                content, b'\0' * padding)))
+
+    def end_request(self, request_id, protocol_status):
+        self.write_record(_FCGI_END_REQUEST, request_id,
+                          _FCGI_END_REQUEST_BODY.pack(0, protocol_status))
+
+    def answer_management_record(self, type_, content):
+        if type_ != _FCGI_GET_VALUES:
+            self.write_record(_FCGI_UNKNOWN_TYPE, 0,
+                              _FCGI_UNKNOWN_TYPE_BODY.pack(type_))
+            return
+        values = {'FCGI_MAX_CONNS': '1', 'FCGI_MAX_REQS': '1',
+                  'FCGI_MPXS_CONNS': '0'}
+        result = []
+        for name in _parse_fastcgi_params(content):
+            if name in values:
+                result.append((name, values[name]))
+        self.write_record(_FCGI_GET_VALUES_RESULT, 0,
+                          _format_fastcgi_params(result))
+
+
+class _FastCGIStdout(object):
+    def __init__(self, connection, request_id):
+        self._connection = connection
+        self._request_id = request_id
+
+    def write(self, data):
+        for index in range(0, len(data), _FCGI_MAX_CONTENT):
+            self._connection.write_record(
+                                _FCGI_STDOUT, self._request_id,
+                                data[index:index + _FCGI_MAX_CONTENT])
+
+    def close(self):
+        # An empty record ends the stream
+        self._connection.write_record(_FCGI_STDOUT, self._request_id)
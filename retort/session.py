@@ -23,18 +23,43 @@ from __future__ import (absolute_import, division,
 # TODO: Test builtins.super
 # from builtins import super
 
-from .exceptions import ExistingSessionError
+try:
+    # Unlike collections.abc, already imported when the interpreter starts
+    from _collections_abc import MutableMapping
+except ImportError:
+    # Python 2
+    from collections import MutableMapping
+
+from .exceptions import ExistingSessionError, SessionPayloadTooLargeError
 
 
 class Session(object):
     def process_request(self, app):
         raise NotImplementedError()
 
+    def process_response(self, app):
+        """
+        Called after the handler has made the body, right before the response
+        is served, e.g. to store the modified session data.
+        """
+        pass
+
+    def can_share_output(self, app):
+        """
+        Tell, before process_request is called, whether the request is
+        certainly anonymous, so that its response can be shared with other
+        clients (see OutputCache).
+        """
+        return False
+
 
 class NullSession(Session):
     def process_request(self, app):
         pass
 
+    def can_share_output(self, app):
+        return True
+
 
 class TokenSQLiteSession(Session):
     # Use SQLite, not just a text file (e.g. JSON) because of concurrency
@@ -42,7 +67,22 @@ class TokenSQLiteSession(Session):
     def __init__(self, db_path, domain, lifetime, path='/', secure=True,
                  httponly=True, cookie_name='RetortSessionID',
                  session_cookie=True, unidentified_diversion=None,
-                 autoextend=False):
+                 autoextend=False, autoextend_threshold=None,
+                 gc_probability=0.1, gc_batch=1000, pragmas=None):
+        """
+        If autoextend is True, the expiry of a session, and of its cookie if
+        it's not a session cookie, is postponed to lifetime seconds from now,
+        but only when less than autoextend_threshold seconds are left, by
+        default half of lifetime, so that most requests don't write to the
+        database.
+
+        Expired sessions are deleted, at most gc_batch at a time, when a
+        session is initiated, with gc_probability; call gc() from a scheduled
+        job to delete all of them.
+
+        pragmas are applied to the database connection, see
+        retort.sqlite.connect.
+        """
         # For performance, do only what's strictly necessary to configure
         # the object, and leave everything else to process_request, since
         # another session object may be used depending on the matched url,
@@ -62,9 +102,28 @@ class TokenSQLiteSession(Session):
         self._session_cookie = session_cookie
         self._unidentified_diversion = unidentified_diversion
         self.autoextend = autoextend
+        self.autoextend_threshold = (lifetime / 2
+                                     if autoextend_threshold is None
+                                     else autoextend_threshold)
+        self.gc_probability = gc_probability
+        self.gc_batch = gc_batch
+        self._pragmas = pragmas
+
+    def can_share_output(self, app):
+        # Don't look the session up in the database, only anonymous requests,
+        # without a session cookie, are shared; unidentified requests may have
+        # to be diverted instead
+        return (not self._unidentified_diversion and
+                self._cookie_name not in app.request.cookies)
+
+    def _connect(self):
+        # One connection per process and thread, shared with the other
+        # objects that use the same database
+        from .sqlite import connect
+        return connect(self._db_path, self._pragmas)
 
     def create_db_table(self):
-        conn = sqlite3.connect(self._db_path)
+        conn = self._connect()
         cur = conn.cursor()
 
         cur.execute('PRAGMA auto_vacuum=FULL')
@@ -72,15 +131,75 @@ class TokenSQLiteSession(Session):
         # TODO: For some reason using INTEGER for 'id' results in violations
         #       of the primary key uniqueness (see comment when creating
         #       the uuid further below)...
+        # The expiry is stored in seconds since the epoch, and indexed, so
+        # that the expired sessions can be found without a full scan
         cur.execute('''CREATE TABLE Sessions (id TEXT PRIMARY KEY,
-                                              expiry TEXT NOT NULL,
+                                              expiry INTEGER NOT NULL,
                                               user TEXT NOT NULL,
                                               data TEXT)''')
+        cur.execute('CREATE INDEX SessionsExpiry ON Sessions (expiry)')
         cur.close()
-        conn.close()
+        conn.commit()
+        # Only now that auto_vacuum is stored in the database
+        from .sqlite import set_journal_mode
+        set_journal_mode(self._db_path)
+
+    def upgrade_db_table(self):
+        """
+        Convert a table created by an older version of Retort, which stored
+        the expiry dates as ISO 8601 text, to the current format; it must be
+        run once, before serving requests, on existing databases.
+        """
+        import calendar
+        from datetime import datetime
+        import _strptime  # noqa
+
+        conn = self._connect()
+        cur = conn.cursor()
+        cur.execute('PRAGMA table_info(Sessions)')
+        # (cid, name, type, notnull, dflt_value, pk)
+        if any(row[1] == 'expiry' and row[2].upper() == 'INTEGER'
+               for row in cur.fetchall()):
+            cur.close()
+            return
+
+        with conn:
+            rows = []
+            for session_id, expiry in conn.execute(
+                                        'SELECT id, expiry FROM Sessions'):
+                expiry = calendar.timegm(datetime.strptime(
+                                expiry, "%Y-%m-%dT%H:%M:%SZ").timetuple())
+                rows.append((expiry, session_id))
+            cur.executemany('UPDATE Sessions SET expiry=? WHERE id=?', rows)
+            # The column type can't be altered, and a TEXT column would
+            # compare the integer dates as strings
+            cur.execute('''CREATE TABLE SessionsUpgrade (
+                                                id TEXT PRIMARY KEY,
+                                                expiry INTEGER NOT NULL,
+                                                user TEXT NOT NULL,
+                                                data TEXT)''')
+            cur.execute('''INSERT INTO SessionsUpgrade (id, expiry, user, data)
+                           SELECT id, expiry, user, data FROM Sessions''')
+            cur.execute('DROP TABLE Sessions')
+            cur.execute('ALTER TABLE SessionsUpgrade RENAME TO Sessions')
+            cur.execute('CREATE INDEX SessionsExpiry ON Sessions (expiry)')
+            cur.close()
+
+    def gc(self, batch=None):
+        """
+        Delete the expired sessions, at most batch of them, or all of them if
+        None, and return how many were deleted.
+
+        Meant to be run periodically, e.g. with the command:
+
+            python -m retort.session /path/to/sessions.db
+        """
+        return _delete_expired_sessions(self._connect(),
+                                        batch or self.gc_batch,
+                                        all_=batch is None)
 
     def inspect_db_table(self, data=False):
-        conn = sqlite3.connect(self._db_path)
+        conn = self._connect()
         cur = conn.cursor()
         fields = ['id', 'expiry', 'user']
         if data:
@@ -88,36 +207,25 @@ class TokenSQLiteSession(Session):
         cur.execute('''SELECT {0} FROM Sessions'''.format(', '.join(fields)))
         text = ['\t'.join(fields)]
         for row in cur:
-            text.append('\t'.join(str(val) for val in row))
+            text.append('\t'.join('{0}'.format(val) for val in row))
         cur.close()
-        conn.close()
         return '\n'.join(text)
 
     def process_request(self, app):
         # NullSession is the default, don't always import unneeded modules
 
-        global sqlite3
-        import sqlite3
-
         global uuid
         import uuid
 
         global datetime, timedelta
         from datetime import datetime, timedelta
 
-        self.app = app
+        global calendar
+        import calendar
 
-        self._db_conn = sqlite3.connect(self._db_path)
-        # TODO: Investigate why sqlite3.Row doesn't work (doesn't like
-        #       row indices to be unicode strings...)
-        # self._db_conn.row_factory = sqlite3.Row
+        self.app = app
 
-        def dict_factory(cursor, row):
-            d = {}
-            for idx, col in enumerate(cursor.description):
-                d[col[0]] = row[idx]
-            return d
-        self._db_conn.row_factory = dict_factory
+        self._db_conn = self._connect()
 
         self.id = None
         # self.expiry is when the session expires on the *server*
@@ -137,11 +245,11 @@ class TokenSQLiteSession(Session):
                     secure=self._cookie_secure,
                     httponly=self._cookie_httponly)
 
-    def _parse_expiry(self, expirystr):
-        return datetime.strptime(expirystr, "%Y-%m-%dT%H:%M:%SZ")
+    def _parse_expiry(self, timestamp):
+        return datetime.utcfromtimestamp(timestamp)
 
     def _format_expiry(self, expiry):
-            return expiry.strftime("%Y-%m-%dT%H:%M:%SZ")
+        return calendar.timegm(expiry.utctimetuple())
 
     def _identify(self):
         try:
@@ -154,18 +262,23 @@ class TokenSQLiteSession(Session):
         row = cur.fetchone()
         if not row:
             return False
+        expiry, user, data = row
 
-        expiry = self._parse_expiry(row['expiry'])
+        expiry = self._parse_expiry(expiry)
 
         if self._delete_expired_session(session_id, expiry):
             return False
 
-        if self.autoextend:
+        # Extending the session is a write transaction, so do it only once in
+        # a while
+        if self.autoextend and expiry - datetime.utcnow() < timedelta(
+                                        seconds=self.autoextend_threshold):
             expiry = datetime.utcnow() + timedelta(seconds=self._lifetime)
-            self._db_conn.execute('''UPDATE Sessions SET expiry=?
-                                  WHERE id=?''',
-                                  (self._format_expiry(expiry), session_id))
-            self._db_conn.commit()
+            with self._db_conn:
+                self._db_conn.execute('''UPDATE Sessions SET expiry=?
+                                      WHERE id=?''',
+                                      (self._format_expiry(expiry),
+                                       session_id))
 
             if not self._session_cookie:
                 self._set_cookie(session_id, expires=expiry)
@@ -173,8 +286,8 @@ class TokenSQLiteSession(Session):
         self.id = session_id
         # self.expiry is when the session expires on the *server*
         self.expiry = expiry
-        self.user = row['user']
-        self.data = row['data']
+        self.user = user
+        self.data = SessionData(data)
 
         return True
 
@@ -190,37 +303,39 @@ class TokenSQLiteSession(Session):
         # session_id = uuid.uuid4().int
         session_id = uuid.uuid4().hex
 
-        # TODO: Currently data is unused
-        data = None
-
         self.id = session_id
         # self.expiry is when the session expires on the *server*
         self.expiry = datetime.utcnow() + timedelta(seconds=self._lifetime)
         self.user = user
-        self.data = data
-
-        self._db_conn.execute('''INSERT INTO Sessions (id, expiry, user, data)
-                              VALUES (?, ?, ?, ?)''',
-                              (session_id, self._format_expiry(self.expiry),
-                               user, data))
-        self._db_conn.commit()
+        # Stored by process_response, if modified
+        self.data = SessionData(None)
+
+        # The connection is shared and lives as long as the process, so a
+        # failed transaction must be rolled back, or it would keep the
+        # database locked
+        with self._db_conn:
+            self._db_conn.execute('''INSERT INTO Sessions
+                                          (id, expiry, user, data)
+                                  VALUES (?, ?, ?, NULL)''',
+                                  (session_id,
+                                   self._format_expiry(self.expiry), user))
 
         self._set_cookie(session_id,
                          expires=None if self._session_cookie else self.expiry)
 
-        # Check the database for one expired sessions and delete it (prevent
-        # memory leaks)
-        cur = self._db_conn.execute('SELECT id, expiry FROM Sessions')
-        for row in cur:
-            if self._delete_expired_session(
-                                row['id'], self._parse_expiry(row['expiry'])):
-                # Deleting one session is enough at preventing memory leaks,
-                # since initiate() only adds one more entry
-                # Breaking is also extremely important, because otherwise it's
-                # not safe to loop on the keys of self._dbdata['id_to_data']
-                # and remove them in the loop itself (I should make a list of
-                # them)
-                break
+        # Delete a batch of expired sessions once in a while (prevent memory
+        # leaks), so that the cost is shared among many logins
+        import random
+        if random.random() < self.gc_probability:
+            _delete_expired_sessions(self._db_conn, self.gc_batch)
+
+    def process_response(self, app):
+        if self.data is not None and self.data.modified:
+            with self._db_conn:
+                self._db_conn.execute('''UPDATE Sessions SET data=?
+                                      WHERE id=?''',
+                                      (self.data.serialize(), self.id))
+            self.data.modified = False
 
     def terminate(self):
         if not self.user:
@@ -257,6 +372,313 @@ class TokenSQLiteSession(Session):
         # Note that even though this is an object's method, it doesn't
         # necessarily act on the object's session: it uses self only to reach
         # the database connection
-        self._db_conn.execute('DELETE FROM Sessions WHERE id=?',
-                              (session_id, ))
-        self._db_conn.commit()
+        with self._db_conn:
+            self._db_conn.execute('DELETE FROM Sessions WHERE id=?',
+                                  (session_id, ))
+
+
+class SignedCookieSession(Session):
+    # Browsers accept cookies of at least 4096 bytes, including the name and
+    # the attributes
+    DEFAULT_MAX_PAYLOAD = 3800
+
+    def __init__(self, secret_keys, domain, lifetime, path='/', secure=True,
+                 httponly=True, cookie_name='RetortSession',
+                 session_cookie=True, unidentified_diversion=None,
+                 autoextend=False, autoextend_threshold=None, encrypt=False,
+                 max_payload=DEFAULT_MAX_PAYLOAD):
+        """
+        Store the user, the expiry and the data of the session in the cookie
+        itself, signed with HMAC-SHA256, so that identifying a request needs
+        no database.
+
+        secret_keys is a list of keys: the first one signs the new cookies,
+        all of them are accepted, so that keys can be rotated. If encrypt is
+        True, the payload is also encrypted, which requires the cryptography
+        package. Storing a cookie longer than max_payload bytes raises
+        SessionPayloadTooLargeError.
+
+        The other arguments are the same as TokenSQLiteSession's; the session
+        data must be serializable to JSON.
+        """
+        # For performance, do only what's strictly necessary to configure
+        # the object, and leave everything else to process_request, since
+        # another session object may be used depending on the matched url,
+        # so this would become useless
+        super(SignedCookieSession, self).__init__()
+        if isinstance(secret_keys, (bytes, type(''))):
+            secret_keys = (secret_keys, )
+        self._secret_keys = [key.encode('utf-8')
+                             if isinstance(key, type('')) else key
+                             for key in secret_keys]
+        self._lifetime = lifetime
+        self._cookie_domain = domain
+        self._cookie_path = path
+        self._cookie_secure = secure
+        self._cookie_httponly = httponly
+        self._cookie_name = cookie_name
+        self._session_cookie = session_cookie
+        self._unidentified_diversion = unidentified_diversion
+        self.autoextend = autoextend
+        self.autoextend_threshold = (lifetime / 2
+                                     if autoextend_threshold is None
+                                     else autoextend_threshold)
+        self.encrypt = encrypt
+        self.max_payload = max_payload
+
+    def can_share_output(self, app):
+        return (not self._unidentified_diversion and
+                self._cookie_name not in app.request.cookies)
+
+    def process_request(self, app):
+        global time
+        import time
+
+        self.app = app
+
+        self.id = None
+        # self.expiry is when the session expires on the *server*
+        self.expiry = None
+        self.user = None
+        self.data = None
+        self._changed = False
+
+        if not self._identify() and self._unidentified_diversion:
+            self._unidentified_diversion.serve(app)
+
+    def _identify(self):
+        try:
+            value = self.app.request.cookies[self._cookie_name].value
+        except KeyError:
+            return False
+
+        payload = self._load(value)
+        if payload is None:
+            return False
+
+        import json
+        user, expiry, data = json.loads(payload.decode('utf-8'))
+        now = time.time()
+        if expiry < now:
+            return False
+
+        # The cookie is reissued only once in a while
+        if self.autoextend and expiry - now < self.autoextend_threshold:
+            expiry = int(now) + self._lifetime
+            self._changed = True
+
+        from datetime import datetime
+        self.id = value
+        self.expiry = datetime.utcfromtimestamp(expiry)
+        self.user = user
+        self.data = SessionData(data)
+        return True
+
+    def _sign(self, key, payload):
+        import hmac
+        import hashlib
+        return hmac.new(key, payload, hashlib.sha256).digest()
+
+    def _fernet(self, key):
+        # Optional dependency
+        import base64
+        import hashlib
+        from cryptography.fernet import Fernet
+        return Fernet(base64.urlsafe_b64encode(hashlib.sha256(
+                                            b'encrypt' + key).digest()))
+
+    def _dump(self, payload):
+        key = self._secret_keys[0]
+        if self.encrypt:
+            import base64
+            # Fernet tokens are already encoded in base64
+            payload = base64.urlsafe_b64decode(
+                                        self._fernet(key).encrypt(payload))
+        signature = self._sign(key, payload)
+        return '.'.join(_b64encode(part) for part in (payload, signature))
+
+    def _load(self, value):
+        import hmac
+        try:
+            payload, signature = (_b64decode(part)
+                                  for part in value.split('.'))
+        except (ValueError, TypeError):
+            return None
+        compare = getattr(hmac, 'compare_digest', _compare_digest)
+        for key in self._secret_keys:
+            if compare(self._sign(key, payload), signature):
+                break
+        else:
+            return None
+        if self.encrypt:
+            import base64
+            from cryptography.fernet import InvalidToken
+            try:
+                return self._fernet(key).decrypt(
+                                        base64.urlsafe_b64encode(payload))
+            except InvalidToken:
+                return None
+        return payload
+
+    def initiate(self, user, override=False):
+        if self.user:
+            if override:
+                self.terminate()
+            else:
+                raise ExistingSessionError()
+
+        from datetime import datetime
+        self.expiry = datetime.utcfromtimestamp(int(time.time()) +
+                                                self._lifetime)
+        self.user = user
+        self.data = SessionData(None)
+        self._changed = True
+        # The cookie is set by process_response, so that it also contains
+        # the data set by the handler
+        self.id = None
+
+    def process_response(self, app):
+        if self.user is None or not (self._changed or self.data.modified):
+            return
+
+        import json
+        import calendar
+        expiry = calendar.timegm(self.expiry.utctimetuple())
+        payload = json.dumps((self.user, expiry, self.data.serialize()),
+                             separators=(',', ':')).encode('utf-8')
+        value = self._dump(payload)
+        if len(value) > self.max_payload:
+            raise SessionPayloadTooLargeError(len(value))
+        self.id = value
+        self.app.response.cookies.add(
+                    self._cookie_name, value,
+                    domain=self._cookie_domain,
+                    path=self._cookie_path,
+                    expires=None if self._session_cookie else self.expiry,
+                    secure=self._cookie_secure,
+                    httponly=self._cookie_httponly)
+
+    def terminate(self):
+        if not self.user:
+            return False
+
+        self.id = None
+        # self.expiry is when the session expires on the *server*
+        self.expiry = None
+        self.user = None
+        self.data = None
+
+        # The cookie is the session, so it must be overwritten with an expired
+        # one
+        self.app.response.cookies.add(self._cookie_name, '',
+                                      domain=self._cookie_domain,
+                                      path=self._cookie_path,
+                                      secure=self._cookie_secure,
+                                      httponly=self._cookie_httponly)
+        self.app.response.cookies.expire(self._cookie_name)
+
+
+def _b64encode(data):
+    import base64
+    # Padding characters would make the cookie value quoted
+    return base64.urlsafe_b64encode(data).rstrip(b'=').decode('ascii')
+
+
+def _b64decode(text):
+    import base64
+    text = text.encode('ascii')
+    return base64.urlsafe_b64decode(text + b'=' * (-len(text) % 4))
+
+
+def _compare_digest(a, b):
+    # hmac.compare_digest requires Python 2.7.7
+    if len(a) != len(b):
+        return False
+    result = 0
+    for x, y in zip(bytearray(a), bytearray(b)):
+        result |= x ^ y
+    return result == 0
+
+
+class SessionData(MutableMapping):
+    def __init__(self, serialized):
+        """
+        The data of a session, a dictionary that is deserialized only when
+        it's accessed for the first time, and stored only if it's modified.
+
+        Changes to mutable values, e.g. appending to a list, can't be
+        detected: set self.modified to True to store them.
+        """
+        self._serialized = serialized
+        self._data = None
+        self.modified = False
+
+    @property
+    def _dict(self):
+        if self._data is None:
+            import json
+            self._data = (json.loads(self._serialized) if self._serialized
+                          else {})
+        return self._data
+
+    def serialize(self):
+        import json
+        return json.dumps(self._dict, separators=(',', ':'))
+
+    def __getitem__(self, key):
+        return self._dict[key]
+
+    def __setitem__(self, key, value):
+        self._dict[key] = value
+        self.modified = True
+
+    def __delitem__(self, key):
+        del self._dict[key]
+        self.modified = True
+
+    def __iter__(self):
+        return iter(self._dict)
+
+    def __len__(self):
+        return len(self._dict)
+
+    def __repr__(self):
+        return 'SessionData({0!r})'.format(self._dict)
+
+
+def _delete_expired_sessions(conn, batch, all_=False):
+    import time
+    now = int(time.time())
+    deleted = 0
+    while True:
+        # Commit after every batch, so that the database isn't locked for
+        # too long
+        with conn:
+            # DELETE ... LIMIT requires a compile-time option of SQLite
+            cur = conn.execute('''DELETE FROM Sessions WHERE id IN (
+                                    SELECT id FROM Sessions WHERE expiry<?
+                                    LIMIT ?)''', (now, batch))
+        deleted += cur.rowcount
+        if not all_ or cur.rowcount < batch:
+            return deleted
+
+
+def main():
+    # argparse requires Python 2.7
+    import optparse
+    parser = optparse.OptionParser(
+                usage='%prog [options] db_path',
+                description='Delete the expired sessions of a '
+                            'TokenSQLiteSession database.')
+    parser.add_option('--batch', type='int', default=1000,
+                      help='sessions deleted per transaction')
+    options, args = parser.parse_args()
+    if len(args) != 1:
+        parser.error('the path of the sessions database is required')
+    from .sqlite import connect
+    print(_delete_expired_sessions(connect(args[0]), options.batch,
+                                   all_=True))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,133 @@
+# Retort - Simple Python CGI framework.
+# Copyright (C) 2016 Dario Giovannetti <dev@dariogiovannetti.net>
+#
+# This file is part of Retort.
+#
+# Retort is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# Retort is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with Retort.  If not, see <http://www.gnu.org/licenses/>.
+
+# The module must also support Python 2.6
+# http://python-future.org/
+from __future__ import (absolute_import, division,
+                        print_function, unicode_literals)
+# TODO: Test builtins.super
+# from builtins import super
+
+import os
+import threading
+import sqlite3
+
+# Applied to every new connection; WAL lets readers proceed while a process
+# writes, and, with synchronous=NORMAL, commits don't wait for the disk
+DEFAULT_PRAGMAS = (
+    ('journal_mode', 'WAL'),
+    ('synchronous', 'NORMAL'),
+    ('busy_timeout', 5000),
+)
+# Prepared statements kept by each connection, see sqlite3.connect
+CACHED_STATEMENTS = 256
+
+_local = threading.local()
+# All the connections of this process, closed at exit
+_connections = []
+_lock = threading.Lock()
+_atexit_registered = False
+
+
+def connect(db_path, pragmas=None):
+    """
+    Return the connection to the database at db_path of the current process
+    and thread, opening it the first time.
+
+    pragmas is a sequence of (name, value) pairs applied, overriding
+    DEFAULT_PRAGMAS, when the connection is opened, e.g.
+    (('mmap_size', 2 ** 26), ('cache_size', -8000)). Rows are returned as
+    tuples.
+    """
+    # SQLite connections can't be shared between threads, e.g. of a
+    # multi-threaded WSGI server, and must never be shared with a forked
+    # process, e.g. when the connection is opened before the workers of a
+    # pre-forking server are spawned
+    pid = os.getpid()
+    if getattr(_local, 'pid', None) != pid:
+        _local.pid = pid
+        _local.connections = {}
+        _local.journal_modes = {}
+    try:
+        return _local.connections[db_path]
+    except KeyError:
+        pass
+
+    conn = sqlite3.connect(db_path, cached_statements=CACHED_STATEMENTS)
+    pragmas = tuple(pragmas or ())
+    overridden = set(name for name, value in pragmas)
+    for name, value in tuple(pragma for pragma in DEFAULT_PRAGMAS
+                             if pragma[0] not in overridden) + pragmas:
+        if name == 'journal_mode':
+            # The journal mode is stored in the database, and changing it
+            # requires an exclusive lock, which fails right away if other
+            # processes are using the database
+            if (conn.execute('PRAGMA journal_mode').fetchone()[0].upper() ==
+                    '{0}'.format(value).upper()):
+                continue
+            if not conn.execute('PRAGMA page_count').fetchone()[0]:
+                # Switching a new database to WAL writes its header, after
+                # which auto_vacuum can't be changed anymore, so leave it to
+                # set_journal_mode(), once the tables are created
+                _local.journal_modes[db_path] = value
+                continue
+        # PRAGMA doesn't support parameters
+        conn.execute('PRAGMA {0}={1}'.format(name, value)).fetchall()
+    _local.connections[db_path] = conn
+    _register(conn, pid)
+    return conn
+
+
+def set_journal_mode(db_path):
+    """
+    Apply the journal mode that connect() didn't apply because the database
+    was empty; call it after creating the tables of a new database.
+    """
+    value = _local.journal_modes.pop(db_path, None)
+    if value is not None:
+        _local.connections[db_path].execute(
+                            'PRAGMA journal_mode={0}'.format(value)).fetchall()
+
+
+def _register(conn, pid):
+    global _atexit_registered
+    with _lock:
+        _connections.append((pid, conn))
+        if not _atexit_registered:
+            import atexit
+            atexit.register(close_all)
+            _atexit_registered = True
+
+
+def close_all():
+    """
+    Close the connections opened by this process; called automatically at
+    exit.
+    """
+    pid = os.getpid()
+    with _lock:
+        for conn_pid, conn in _connections:
+            if conn_pid == pid:
+                try:
+                    conn.close()
+                except sqlite3.ProgrammingError:
+                    # Opened by another thread
+                    pass
+        del _connections[:]
+    _local.connections = {}
+    _local.journal_modes = {}
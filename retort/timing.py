@@ -0,0 +1,119 @@
+# Retort - Simple Python CGI framework.
+# Copyright (C) 2016 Dario Giovannetti <dev@dariogiovannetti.net>
+#
+# This file is part of Retort.
+#
+# Retort is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# Retort is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with Retort.  If not, see <http://www.gnu.org/licenses/>.
+
+# The module must also support Python 2.6
+# http://python-future.org/
+from __future__ import (absolute_import, division,
+                        print_function, unicode_literals)
+# TODO: Test builtins.super
+# from builtins import super
+
+import time
+
+_clock = getattr(time, 'perf_counter', time.time)
+
+
+class Timing(object):
+    LOGGER_NAME = 'retort.timing'
+
+    def __init__(self, server_timing=True, log=False):
+        """
+        Measure how long each phase of a request takes, i.e. dispatch (route
+        matching), output_cache, session, handler, session_save, response
+        (ETag, compression, headers) and send, plus form, the parsing of the
+        form data, which is part of the phase that accessed it, usually
+        handler.
+
+        Pass it to Retort as the timing argument. If server_timing is True,
+        the timings, except send, are sent to the client in the Server-Timing
+        header; note that they reveal how the pages are made, e.g. whether a
+        page was cached. If log is True, a line with the timings is logged,
+        after the response is sent, to the LOGGER_NAME logger with the INFO
+        level.
+
+        Override report() to send the timings elsewhere, e.g. to a metrics
+        service.
+        """
+        self.server_timing = server_timing
+        self.log = log
+
+    def start(self, app):
+        """
+        Return the timer of a new request.
+        """
+        return RequestTimer()
+
+    def before_send(self, app, timer, headers):
+        """
+        Called before the response is sent, with the list of its (name, value)
+        headers, which can still be modified.
+        """
+        if self.server_timing:
+            headers.append(('Server-Timing', timer.format_server_timing()))
+
+    def report(self, app, timer):
+        """
+        Called after the response has been sent.
+        """
+        if self.log:
+            import logging
+            environ = app.gateway.environ
+            logging.getLogger(self.LOGGER_NAME).info(
+                'method={0} url={1} status={2} total_ms={3:.3f} {4}'.format(
+                    environ.get('REQUEST_METHOD', 'GET'),
+                    app.request.redirect_url, app.response.status,
+                    timer.total() * 1e3,
+                    ' '.join('{0}_ms={1:.3f}'.format(name, duration * 1e3)
+                             for name, duration in timer.phases)))
+
+
+class RequestTimer(object):
+    def __init__(self):
+        """
+        The durations, in seconds, of the phases of a request, in the order
+        they ended; a phase may appear more than once, e.g. if a handler
+        diverts the request to another handler.
+        """
+        self.begin = self._last = _clock()
+        self.phases = []
+
+    now = staticmethod(_clock)
+
+    def mark(self, name):
+        """
+        End the phase that began when the previous one ended.
+        """
+        now = _clock()
+        self.phases.append((name, now - self._last))
+        self._last = now
+
+    def add(self, name, begin):
+        """
+        Add a phase that began at begin (see now()) and ends now, without
+        affecting the sequence of phases measured by mark().
+        """
+        self.phases.append((name, _clock() - begin))
+
+    def total(self):
+        return _clock() - self.begin
+
+    def format_server_timing(self):
+        metrics = ['{0};dur={1:.3f}'.format(name, duration * 1e3)
+                   for name, duration in self.phases]
+        metrics.append('total;dur={0:.3f}'.format(self.total() * 1e3))
+        return ', '.join(metrics)
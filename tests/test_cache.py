@@ -0,0 +1,267 @@
+# Retort - Simple Python CGI framework.
+# Copyright (C) 2016 Dario Giovannetti <dev@dariogiovannetti.net>
+#
+# This file is part of Retort.
+#
+# Retort is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# Retort is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with Retort.  If not, see <http://www.gnu.org/licenses/>.
+
+from __future__ import (absolute_import, division,
+                        print_function, unicode_literals)
+
+import os
+import time
+import shutil
+import sqlite3
+import tempfile
+import unittest
+
+from retort import sqlite
+from retort.cache import FileCache, SQLiteCache
+
+
+class CacheTests(object):
+    """
+    Behaviour shared by all the cache backends; make_cache returns the cache
+    under test.
+    """
+    def make_cache(self):
+        raise NotImplementedError()
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.cache = self.make_cache()
+
+    def tearDown(self):
+        sqlite.close_all()
+        shutil.rmtree(self.directory)
+
+    def test_missing(self):
+        self.assertEqual(self.cache.get('key'), None)
+        self.assertEqual(self.cache.get_dict('key'), {})
+
+    def test_types(self):
+        values = {'text': 'value', 'unicode': '\u00e8\u4e2d',
+                  'integer': 1, 'large': -2 ** 40, 'float': 1.5,
+                  'none': None}
+        for key, value in values.items():
+            self.cache.set(key, value)
+            stored = self.cache.get(key, refresh=self.fail)
+            self.assertEqual(stored, value)
+            self.assertTrue(type(stored) is type(value))
+        self.assertEqual(self.cache.get_dict(*values), values)
+
+    def test_boolean(self):
+        # Stored as an integer, as by SQLite
+        self.cache.set('key', True)
+        self.assertEqual(self.cache.get('key'), 1)
+
+    def test_refresh(self):
+        self.assertEqual(self.cache.get('key', refresh=lambda: 'value'),
+                         'value')
+        self.assertEqual(self.cache.get('key', refresh=self.fail), 'value')
+
+    def test_max_age(self):
+        self.cache.set('key', 'old')
+        self.assertEqual(self.cache.get('key', max_age=60), 'old')
+        self.assertEqual(self.cache.get('key', max_age=-10), None)
+        self.assertEqual(self.cache.get('key', max_age=-10,
+                                        refresh=lambda: 'new'), 'new')
+
+    def test_dict(self):
+        self.cache.set_dict({'a': 'value', 'b': 2})
+        self.assertEqual(self.cache.get_dict('a', 'b', 'c'),
+                         {'a': 'value', 'b': 2})
+        self.assertEqual(self.cache.get_dict(
+                                'a', 'c', refresh=lambda: {'a': 1, 'c': 3}),
+                         {'a': 1, 'c': 3})
+        self.assertEqual(self.cache.get_dict('a', 'b', 'c'),
+                         {'a': 1, 'b': 2, 'c': 3})
+
+    def test_clear(self):
+        self.cache.set_dict({'a': 1, 'b': 2, 'c': 3})
+        self.cache.clear('a', 'b', 'missing')
+        self.assertEqual(self.cache.get_dict('a', 'b', 'c'), {'c': 3})
+        self.cache.clear_all()
+        self.assertEqual(self.cache.get_dict('a', 'b', 'c'), {})
+
+
+class SQLiteCacheBehaviourTest(CacheTests, unittest.TestCase):
+    def make_cache(self):
+        cache = SQLiteCache(os.path.join(self.directory, 'cache.db'),
+                            sweep_probability=0)
+        cache.create_db_table()
+        return cache
+
+
+class FileCacheBehaviourTest(CacheTests, unittest.TestCase):
+    def make_cache(self):
+        return FileCache(os.path.join(self.directory, 'cache'))
+
+
+class FileCacheMmapBehaviourTest(CacheTests, unittest.TestCase):
+    def make_cache(self):
+        return FileCache(os.path.join(self.directory, 'cache'), use_mmap=True)
+
+
+class FileCacheTest(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.cache = FileCache(self.directory)
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def test_key_types(self):
+        # Python 2 byte strings are the same keys as the same UTF-8 text
+        self.cache.set('\u00e8', 'value')
+        self.assertEqual(self.cache.get('\u00e8'.encode('utf-8')), 'value')
+
+    def test_unsupported_type(self):
+        self.assertRaises(TypeError, self.cache.set, 'key', object())
+        self.assertEqual(self.cache.get('key'), None)
+
+    def test_sweep_temporary_files(self):
+        self.cache.set('key', 'value')
+        directory = os.path.dirname(self.cache._path('key'))
+        stale = os.path.join(directory, FileCache.TEMP_PREFIX + 'stale')
+        fresh = os.path.join(directory, FileCache.TEMP_PREFIX + 'fresh')
+        for path in (stale, fresh):
+            open(path, 'wb').close()
+        mtime = time.time() - FileCache.TEMP_TIMEOUT - 10
+        os.utime(stale, (mtime, mtime))
+        # Writers may still be renaming the recent ones
+        self.cache.clear_all()
+        self.assertEqual(os.listdir(directory),
+                         [FileCache.TEMP_PREFIX + 'fresh'])
+
+
+class SQLiteCacheTest(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.db_path = os.path.join(self.directory, 'cache.db')
+        self.cache = SQLiteCache(self.db_path, sweep_probability=0)
+        self.cache.create_db_table()
+
+    def tearDown(self):
+        sqlite.close_all()
+        shutil.rmtree(self.directory)
+
+    def test_set_none(self):
+        self.cache.set('key', None)
+        self.assertEqual(self.cache.get_dict('key'), {'key': None})
+
+    def test_refresh_none(self):
+        self.assertEqual(self.cache.get('key', refresh=lambda: None), None)
+        self.assertEqual(self.cache.get_dict('key'), {'key': None})
+
+    def test_sweep_keeps_long_max_age(self):
+        cache = SQLiteCache(self.db_path, default_timeout=1)
+        cache.set('key', 'value')
+        cache.sweep(int(time.time()) + 10)
+        self.assertEqual(cache.get('key', max_age=3600), 'value')
+
+    def test_sweep_expire_after(self):
+        cache = SQLiteCache(self.db_path, expire_after=5)
+        cache.set('key', 'value')
+        cache.sweep(int(time.time()) + 10)
+        self.assertEqual(cache.get('key', max_age=3600), None)
+
+    def assertUnlocked(self):
+        conn = sqlite3.connect(self.db_path, timeout=0)
+        try:
+            conn.execute("INSERT INTO CacheLeases VALUES ('other', 0)")
+            conn.rollback()
+        finally:
+            conn.close()
+
+    def test_failed_store_rolls_back(self):
+        self.cache.set('key', 'value')
+        # object() can't be stored
+        self.assertRaises(sqlite3.Error, self.cache.set_dict,
+                          {'a': 'value', 'b': object(), 'c': 'value'})
+        self.assertUnlocked()
+        self.assertEqual(self.cache.get('key'), 'value')
+
+    def test_failed_store_releases_lease(self):
+        self.assertRaises(sqlite3.Error, self.cache.get, 'key',
+                          refresh=object)
+        self.assertUnlocked()
+        self.assertEqual(sqlite.connect(self.db_path).execute(
+                            'SELECT COUNT(*) FROM CacheLeases').fetchone()[0],
+                         0)
+
+    def make_old_db(self, rows):
+        db_path = os.path.join(self.directory, 'old.db')
+        conn = sqlite3.connect(db_path)
+        conn.execute('''CREATE TABLE Cache (key TEXT PRIMARY KEY, value TEXT,
+                                            creation TEXT NOT NULL)''')
+        creation = time.strftime('%Y-%m-%dT%H:%M:%SZ', time.gmtime())
+        conn.executemany('INSERT INTO Cache VALUES (?, ?, ?)',
+                         [(key, value, creation) for key, value in rows])
+        conn.commit()
+        conn.close()
+        cache = SQLiteCache(db_path, sweep_probability=0)
+        cache.upgrade_db_table()
+        return cache
+
+    def test_upgrade_none(self):
+        cache = self.make_old_db([('none', None), ('text', 'value')])
+        self.assertEqual(cache.get_dict('none', 'text'),
+                         {'none': None, 'text': 'value'})
+
+    def test_upgrade_types(self):
+        # Values are stored as in a new table
+        cache = self.make_old_db([('text', 'value')])
+        cache.set_dict({'integer': 1, 'float': 1.5})
+        values = cache.get_dict('text', 'integer', 'float')
+        self.assertEqual(values, {'text': 'value', 'integer': 1, 'float': 1.5})
+        self.assertTrue(type(values['integer']) is int)
+        self.assertTrue(type(values['float']) is float)
+
+    def test_upgrade_intermediate(self):
+        # Tables with integer times, but TEXT values, with and without the
+        # access and size columns
+        for columns in ('',
+                        ', access INTEGER NOT NULL, size INTEGER NOT NULL'):
+            db_path = os.path.join(self.directory, 'intermediate.db')
+            conn = sqlite3.connect(db_path)
+            conn.execute('''CREATE TABLE Cache (key TEXT PRIMARY KEY,
+                                                value TEXT,
+                                                creation INTEGER NOT NULL
+                                                {0})'''.format(columns))
+            now = int(time.time())
+            conn.execute('INSERT INTO Cache VALUES (?, ?, ?{0})'.format(
+                                            ', 7, 5' if columns else ''),
+                         ('text', 'value', now))
+            conn.commit()
+            conn.close()
+            cache = SQLiteCache(db_path, sweep_probability=0)
+            cache.upgrade_db_table()
+            conn = sqlite.connect(db_path)
+            types = dict((row[1], row[2]) for row in conn.execute(
+                                                'PRAGMA table_info(Cache)'))
+            self.assertEqual(types['value'], 'BLOB')
+            self.assertEqual(
+                    conn.execute('SELECT access FROM Cache').fetchone(),
+                    (7 if columns else now, ))
+            cache.set('integer', 1)
+            self.assertEqual(cache.get_dict('text', 'integer'),
+                             {'text': 'value', 'integer': 1})
+            self.assertTrue(type(cache.get('integer')) is int)
+            sqlite.close_all()
+            os.unlink(db_path)
+
+
+if __name__ == '__main__':
+    unittest.main()
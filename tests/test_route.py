@@ -0,0 +1,196 @@
+# Retort - Simple Python CGI framework.
+# Copyright (C) 2016 Dario Giovannetti <dev@dariogiovannetti.net>
+#
+# This file is part of Retort.
+#
+# Retort is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# Retort is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with Retort.  If not, see <http://www.gnu.org/licenses/>.
+
+from __future__ import (absolute_import, division,
+                        print_function, unicode_literals)
+
+import io
+import re
+import shutil
+import tempfile
+import unittest
+from copy import copy
+
+from retort import Retort
+from retort.cache import FileCache, OutputCache
+from retort.gateway import StreamGateway
+from retort.route import (RouteDefault, RouteExact, RouteRegex, _Dispatcher,
+                          _literal_prefix)
+
+
+class FakeRequest(object):
+    def __init__(self, url, method='GET'):
+        self.redirect_url = url
+        self.method = method
+
+
+class FakeApp(object):
+    def __init__(self, url, method='GET'):
+        self.request = FakeRequest(url, method)
+
+
+def matches(route, url):
+    # As in _Route.attempt
+    route = copy(route)
+    route.serve_args = []
+    route.serve_kwargs = {}
+    return route.test(FakeApp(url))
+
+
+class RecordingRoute(RouteRegex):
+    def serve(self, app, *args, **kwargs):
+        self.served.append(args)
+
+
+class MethodRoute(RecordingRoute):
+    # A subclass that adds a condition to test()
+    def test(self, app):
+        return (app.request.method == 'POST' and
+                super(MethodRoute, self).test(app))
+
+
+class RouteRegexTest(unittest.TestCase):
+    def test_attempt(self):
+        route = RecordingRoute(r'/a/(\d+)', 'handler')
+        route.served = []
+        route.attempt(FakeApp('/a/b'))
+        route.attempt(FakeApp('/a/12'))
+        self.assertEqual([args[0].group(1) for args in route.served], ['12'])
+
+    def test_subclass_test(self):
+        route = MethodRoute('/a', 'handler')
+        route.served = []
+        route.attempt(FakeApp('/a'))
+        self.assertEqual(route.served, [])
+        route.attempt(FakeApp('/a', method='POST'))
+        self.assertEqual(len(route.served), 1)
+
+
+class LiteralPrefixTest(unittest.TestCase):
+    def test_prefix(self):
+        for pattern, prefix in (('/abc', '/abc'),
+                                ('^/abc$', '/abc'),
+                                (r'\A/abc', '/abc'),
+                                (r'/a\.b\/c\d', '/a.b/c'),
+                                ('/ab*', '/a'),
+                                ('/ab?', '/a'),
+                                ('/ab{2}', '/a'),
+                                ('/ab+', '/ab'),
+                                ('/a.c', '/a'),
+                                ('/a[bc]', '/a'),
+                                ('/a(?:b|c)', '/a'),
+                                ('/a(?P<name>b)', '/a'),
+                                ('/a(?=b)', '/a'),
+                                ('/a|/b', ''),
+                                ('(/a|/b)/c', ''),
+                                ('/a[|]b', '/a'),
+                                ('(?i)/abc', ''),
+                                ('(?s)/abc', '')):
+            self.assertEqual(_literal_prefix(pattern), prefix, pattern)
+
+    def test_flags(self):
+        self.assertEqual(_literal_prefix('/abc', re.IGNORECASE), '')
+        self.assertEqual(_literal_prefix('/abc', re.VERBOSE), '')
+        self.assertEqual(_literal_prefix('/abc', re.DOTALL), '/abc')
+
+
+class DispatcherTest(unittest.TestCase):
+    ROUTES = (
+        RouteExact('/users/new', 'exact'),
+        RouteRegex(r'/users/(\d+)$', 'regex'),
+        RouteRegex('/users/new$', 'shadowed'),
+        RouteExact('/users/new', 'duplicate'),
+        RouteRegex('/a|/b', 'alternation'),
+        RouteRegex('(/c|/d)/e', 'group alternation'),
+        RouteRegex('(?i)/case', 'inline flag'),
+        RouteRegex('/upper', 'flag', flags=re.IGNORECASE),
+        RouteRegex('/ab?c', 'optional'),
+        RouteRegex('/ab*d', 'star'),
+        RouteRegex('/x{2}', 'repeat'),
+        RouteRegex('/plus+', 'plus'),
+        RouteRegex(r'/dot\.html', 'escaped dot'),
+        RouteRegex(r'/esc\/aped', 'escaped slash'),
+        RouteRegex(r'/\d+', 'digits'),
+        RouteRegex('/opt(?:ional)?/x', 'non-capturing group'),
+        RouteRegex('/set[ab]', 'set'),
+        RouteRegex('/pipe[|]', 'pipe in set'),
+        RouteRegex('/caf\u00e9', 'unicode'),
+        RouteRegex('/users', 'prefix'),
+        RouteDefault('default'),
+    )
+    URLS = ('', '/', '/users/new', '/users/12', '/users/12/x', '/users',
+            '/a', '/b', '/ab', '/c/e', '/d/e', '/e', '/case', '/CASE',
+            '/Case/x', '/upper', '/UPPER', '/ac', '/abc', '/abbc', '/ad',
+            '/abbbd', '/x', '/xx', '/xxx', '/plus', '/pluss', '/plu',
+            '/dot.html', '/dotxhtml', '/esc/aped', '/1', '/123/x',
+            '/opt/x', '/optional/x', '/optiona/x', '/seta', '/setc',
+            '/pipe|', '/pipe', '/caf\u00e9', '/cafe')
+
+    def first_match(self, routes, url):
+        for route in routes:
+            if matches(route, url):
+                return route
+        return None
+
+    def test_candidates(self):
+        # Test the routes in every order, so that each one may shadow the
+        # others
+        for routes in (self.ROUTES, self.ROUTES[::-1]):
+            dispatcher = _Dispatcher(routes)
+            for url in self.URLS:
+                candidates = dispatcher.candidates(url)
+                self.assertEqual(self.first_match(candidates, url),
+                                 self.first_match(routes, url), url)
+                # In declaration order
+                self.assertEqual(candidates,
+                                 sorted(candidates, key=routes.index))
+
+    def test_duplicate_exact(self):
+        dispatcher = _Dispatcher(self.ROUTES)
+        self.assertEqual([route.handler for route
+                          in dispatcher.candidates('/users/new')
+                          if matches(route, '/users/new')],
+                         ['exact', 'shadowed', 'prefix', 'default'])
+
+
+class LazyHandlerTest(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def serve(self, handler):
+        output_cache = OutputCache(cache=FileCache(self.directory))
+        app = Retort(routes=[RouteExact('/', handler,
+                                        output_cache=output_cache)],
+                     handlers={})
+        out = io.BytesIO()
+        app._serve(StreamGateway({'PATH_INFO': '/', 'REQUEST_METHOD': 'GET'},
+                                 None, out))
+        return out.getvalue()
+
+    def test_output_cache_hit(self):
+        self.assertTrue(self.serve(lambda app: 'stored').endswith(b'stored'))
+        # The module doesn't exist, so importing it would fail
+        self.assertTrue(self.serve('retort_missing_module:make').endswith(
+                                                                    b'stored'))
+
+
+if __name__ == '__main__':
+    unittest.main()
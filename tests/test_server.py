@@ -0,0 +1,254 @@
+# Retort - Simple Python CGI framework.
+# Copyright (C) 2016 Dario Giovannetti <dev@dariogiovannetti.net>
+#
+# This file is part of Retort.
+#
+# Retort is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# Retort is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with Retort.  If not, see <http://www.gnu.org/licenses/>.
+
+from __future__ import (absolute_import, division,
+                        print_function, unicode_literals)
+
+import socket
+import struct
+import unittest
+
+from retort import Retort
+from retort.route import RouteExact
+from retort import server
+from retort.server import (FastCGIServer, SCGIServer, _FastCGIStdout,
+                           _format_fastcgi_params, _parse_fastcgi_params)
+
+HEADER = struct.Struct(str('!BBHHBx'))
+
+
+def echo(app):
+    environ = app.gateway.environ
+    return '{0} {1} {2}'.format(environ['PATH_INFO'],
+                                len(environ.get('HTTP_X_LONG', '')),
+                                app.gateway.stdin.read().decode('utf-8'))
+
+
+def make_app():
+    return Retort(routes=[RouteExact('/echo', echo)], handlers={})
+
+
+def record(type_, request_id, content=b'', padding=None):
+    if padding is None:
+        padding = -len(content) % 8
+    return (HEADER.pack(1, type_, request_id, len(content), padding) +
+            content + b'\xff' * padding)
+
+
+def begin_request(request_id, role=server._FCGI_RESPONDER, flags=0):
+    return record(server._FCGI_BEGIN_REQUEST, request_id,
+                  server._FCGI_BEGIN_REQUEST_BODY.pack(role, flags))
+
+
+def parse_records(data):
+    """
+    Return the (type, request id, content) of each record in data.
+    """
+    records = []
+    while data:
+        type_, request_id, length, padding = HEADER.unpack(
+                                                data[:HEADER.size])[1:]
+        end = HEADER.size + length + padding
+        if len(data) < end:
+            raise ValueError('Truncated record')
+        records.append((type_, request_id,
+                        data[HEADER.size:HEADER.size + length]))
+        data = data[end:]
+    return records
+
+
+def converse(server_, data):
+    """
+    Send data to the server's handle_connection() and return its answer.
+    """
+    client, sock = socket.socketpair()
+    try:
+        client.sendall(data)
+        # The server reads the end of the connection after data
+        client.shutdown(socket.SHUT_WR)
+        server_.handle_connection(sock)
+        # As the workers do, since files made with makefile() may still
+        # reference the socket
+        server_._close(sock)
+        chunks = []
+        while True:
+            chunk = client.recv(65536)
+            if not chunk:
+                break
+            chunks.append(chunk)
+        return b''.join(chunks)
+    finally:
+        client.close()
+        sock.close()
+
+
+class FastCGIParamsTest(unittest.TestCase):
+    def test_round_trip(self):
+        params = [('SHORT', 'value'), ('EMPTY', ''), ('LONG', 'x' * 200),
+                  ('N' * 130, 'name longer than 127 bytes')]
+        data = _format_fastcgi_params(params)
+        # 4-byte lengths have the high bit set
+        self.assertEqual(data[:2], b'\x05\x05')
+        self.assertTrue(b'\x04\x80\x00\x00\xc8LONG' in data)
+        self.assertEqual(_parse_fastcgi_params(data), dict(params))
+
+    def test_empty(self):
+        self.assertEqual(_parse_fastcgi_params(b''), {})
+
+
+class FastCGIStdoutTest(unittest.TestCase):
+    def test_split(self):
+        class Connection(object):
+            def __init__(self):
+                self.records = []
+
+            def write_record(self, type_, request_id, content=b''):
+                self.records.append((type_, request_id, content))
+
+        connection = Connection()
+        stdout = _FastCGIStdout(connection, 3)
+        stdout.write(b'x' * (server._FCGI_MAX_CONTENT + 1))
+        stdout.close()
+        self.assertEqual(
+            [(type_, request_id, len(content))
+             for type_, request_id, content in connection.records],
+            [(server._FCGI_STDOUT, 3, server._FCGI_MAX_CONTENT),
+             (server._FCGI_STDOUT, 3, 1), (server._FCGI_STDOUT, 3, 0)])
+
+
+class FastCGIServerTest(unittest.TestCase):
+    def setUp(self):
+        self.server = FastCGIServer(make_app(), None)
+
+    def request(self, request_id, body=b'body', flags=0):
+        """
+        Return the records of a request.
+        """
+        params = _format_fastcgi_params([('PATH_INFO', '/echo'),
+                                         ('REQUEST_METHOD', 'POST'),
+                                         ('HTTP_X_LONG', 'x' * 300)])
+        return [
+            begin_request(request_id, flags=flags),
+            # A stream can be split anywhere, even within a name
+            record(server._FCGI_PARAMS, request_id, params[:7]),
+            record(server._FCGI_PARAMS, request_id, params[7:]),
+            record(server._FCGI_PARAMS, request_id),
+            # Padding longer than needed is allowed
+            record(server._FCGI_STDIN, request_id, body[:1], padding=15),
+            record(server._FCGI_STDIN, request_id, body[1:]),
+            record(server._FCGI_STDIN, request_id)]
+
+    def assertResponse(self, records, request_id, body=b'body'):
+        stdout = b''.join(content for type_, record_id, content in records
+                          if type_ == server._FCGI_STDOUT and
+                          record_id == request_id)
+        self.assertTrue(stdout.startswith(b'Status: 200 OK\r\n'), stdout)
+        self.assertTrue(stdout.endswith(b'\r\n\r\n/echo 300 ' + body), stdout)
+        # The stream ends with an empty record, then the request
+        self.assertEqual(records[-2], (server._FCGI_STDOUT, request_id, b''))
+        self.assertEqual(records[-1], (
+                    server._FCGI_END_REQUEST, request_id,
+                    server._FCGI_END_REQUEST_BODY.pack(
+                                    0, server._FCGI_REQUEST_COMPLETE)))
+
+    def test_request(self):
+        records = parse_records(converse(self.server,
+                                         b''.join(self.request(1))))
+        self.assertResponse(records, 1)
+
+    def test_keep_connection(self):
+        data = b''.join(self.request(1, flags=server._FCGI_KEEP_CONN) +
+                        self.request(2, b'next'))
+        records = parse_records(converse(self.server, data))
+        end = [index for index, (type_, _, _) in enumerate(records)
+               if type_ == server._FCGI_END_REQUEST][0]
+        self.assertResponse(records[:end + 1], 1)
+        self.assertResponse(records[end + 1:], 2, b'next')
+
+    def test_multiplexed(self):
+        records = self.request(1)
+        # A second request begins before the first one is complete, and its
+        # records are ignored
+        records[4:4] = [begin_request(2),
+                        record(server._FCGI_PARAMS, 2, b'\x01\x01ab'),
+                        record(server._FCGI_STDIN, 2, b'ignored')]
+        data = b''.join(records)
+        records = parse_records(converse(self.server, data))
+        self.assertEqual(records[0], (
+                    server._FCGI_END_REQUEST, 2,
+                    server._FCGI_END_REQUEST_BODY.pack(
+                                    0, server._FCGI_CANT_MPX_CONN)))
+        self.assertResponse(records[1:], 1)
+
+    def test_unknown_role(self):
+        records = parse_records(converse(self.server, begin_request(
+                                                1, role=2)))
+        self.assertEqual(records, [(
+                    server._FCGI_END_REQUEST, 1,
+                    server._FCGI_END_REQUEST_BODY.pack(
+                                    0, server._FCGI_UNKNOWN_ROLE))])
+
+    def test_abort(self):
+        data = (begin_request(1) +
+                record(server._FCGI_ABORT_REQUEST, 1))
+        records = parse_records(converse(self.server, data))
+        self.assertEqual(records, [(
+                    server._FCGI_END_REQUEST, 1,
+                    server._FCGI_END_REQUEST_BODY.pack(
+                                    0, server._FCGI_REQUEST_COMPLETE))])
+
+    def test_management_records(self):
+        data = (record(server._FCGI_GET_VALUES, 0, _format_fastcgi_params(
+                            [('FCGI_MPXS_CONNS', ''), ('UNKNOWN', '')])) +
+                record(99, 0))
+        records = parse_records(converse(self.server, data))
+        self.assertEqual(records, [
+            (server._FCGI_GET_VALUES_RESULT, 0,
+             _format_fastcgi_params([('FCGI_MPXS_CONNS', '0')])),
+            (server._FCGI_UNKNOWN_TYPE, 0,
+             server._FCGI_UNKNOWN_TYPE_BODY.pack(99))])
+
+
+class SCGIServerTest(unittest.TestCase):
+    def setUp(self):
+        self.server = SCGIServer(make_app(), None)
+
+    def netstring(self, headers):
+        data = b''.join(name + b'\0' + value + b'\0'
+                        for name, value in headers)
+        return '{0}:'.format(len(data)).encode('ascii') + data + b','
+
+    def test_request(self):
+        data = self.netstring([(b'CONTENT_LENGTH', b'4'), (b'SCGI', b'1'),
+                               (b'PATH_INFO', b'/echo'),
+                               (b'REQUEST_METHOD', b'POST'),
+                               (b'HTTP_X_LONG', b'x' * 300)]) + b'body'
+        answer = converse(self.server, data)
+        self.assertTrue(answer.startswith(b'Status: 200 OK\r\n'), answer)
+        self.assertTrue(answer.endswith(b'\r\n\r\n/echo 300 body'), answer)
+
+    def test_malformed(self):
+        data = self.netstring([(b'PATH_INFO', b'/echo')])
+        # The netstring must end with a comma
+        self.assertEqual(converse(self.server, data[:-1] + b';'), b'')
+        # The connection ends before the length
+        self.assertEqual(converse(self.server, b'12'), b'')
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,160 @@
+# Retort - Simple Python CGI framework.
+# Copyright (C) 2016 Dario Giovannetti <dev@dariogiovannetti.net>
+#
+# This file is part of Retort.
+#
+# Retort is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# Retort is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with Retort.  If not, see <http://www.gnu.org/licenses/>.
+
+from __future__ import (absolute_import, division,
+                        print_function, unicode_literals)
+
+import io
+import shutil
+import tempfile
+import unittest
+
+from retort import Retort, sqlite
+from retort.gateway import StreamGateway
+from retort.route import RouteExact
+from retort.session import SignedCookieSession, TokenSQLiteSession
+
+
+def serve(app, url, cookie='', **environ):
+    """
+    Return the headers, the body and the session cookie of the response.
+    """
+    environ.update(PATH_INFO=url, HTTP_COOKIE=str(cookie))
+    environ.setdefault('REQUEST_METHOD', 'GET')
+    out = io.BytesIO()
+    app._serve(StreamGateway(environ, None, out))
+    head, _, body = out.getvalue().decode('utf-8').partition('\r\n\r\n')
+    for line in head.split('\r\n'):
+        if line.startswith('Set-Cookie: S='):
+            cookie = 'S=' + line[len('Set-Cookie: S='):].split(';')[0]
+    return head, body, cookie
+
+
+def make_app(session):
+    # The default routes and handlers are shared by all the instances
+    return Retort(routes=[], handlers={}, default_session=session)
+
+
+class HandOverTest(unittest.TestCase):
+    """
+    A handler that changes the session and then hands the request over with
+    redirect() or divert() must not lose the changes.
+    """
+    def setUp(self):
+        self.tempdir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        sqlite.close_all()
+        shutil.rmtree(self.tempdir)
+
+    def serve(self, app, url, cookie=''):
+        return serve(app, url, cookie)[1:]
+
+    def make_app(self, session):
+        app = make_app(session)
+
+        def login(app):
+            app.session.initiate('user')
+            app.redirect('/count')
+
+        def count(app):
+            app.session.data['count'] = app.session.data.get('count', 0) + 1
+            app.divert('show')
+
+        def show(app):
+            return '{0}'.format(app.session.data.get('count'))
+
+        app.add_routes(RouteExact('/login', login),
+                       RouteExact('/count', count),
+                       RouteExact('/show', show))
+        app.add_handlers({'show': app.routes[-1]})
+        return app
+
+    def check(self, session):
+        app = self.make_app(session)
+        cookie = self.serve(app, '/login')[1]
+        self.assertTrue(cookie)
+        body, cookie = self.serve(app, '/count', cookie)
+        self.assertEqual(body, '1')
+        body, cookie = self.serve(app, '/count', cookie)
+        self.assertEqual(body, '2')
+        self.assertEqual(self.serve(app, '/show', cookie)[0], '2')
+
+    def test_token_sqlite_session(self):
+        session = TokenSQLiteSession(
+            self.tempdir + '/sessions.db', 'example.com', 100,
+            cookie_name=str('S'))
+        session.create_db_table()
+        self.check(session)
+
+    def test_signed_cookie_session(self):
+        self.check(SignedCookieSession(['key'], 'example.com', 100,
+                                       cookie_name=str('S')))
+
+
+class NotModifiedTest(unittest.TestCase):
+    """
+    Response.check_etag() serves 304 from inside the handler, which must not
+    lose the changes to the session.
+    """
+    def setUp(self):
+        self.tempdir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        sqlite.close_all()
+        shutil.rmtree(self.tempdir)
+
+    def check(self, session):
+        app = make_app(session)
+
+        def login(app):
+            app.session.initiate('user')
+            return ''
+
+        def visit(app):
+            app.session.data['visited'] = True
+            app.response.check_etag('v1')
+            return 'body'
+
+        def show(app):
+            return '{0}'.format(app.session.data.get('visited'))
+
+        app.add_routes(RouteExact('/login', login),
+                       RouteExact('/visit', visit),
+                       RouteExact('/show', show))
+        cookie = serve(app, '/login')[2]
+        head, body, cookie = serve(app, '/visit', cookie,
+                                   HTTP_IF_NONE_MATCH='"v1"')
+        self.assertTrue('Status: 304' in head)
+        self.assertEqual(body, '')
+        self.assertEqual(serve(app, '/show', cookie)[1], 'True')
+
+    def test_token_sqlite_session(self):
+        session = TokenSQLiteSession(
+            self.tempdir + '/sessions.db', 'example.com', 100,
+            cookie_name=str('S'))
+        session.create_db_table()
+        self.check(session)
+
+    def test_signed_cookie_session(self):
+        self.check(SignedCookieSession(['key'], 'example.com', 100,
+                                       cookie_name=str('S')))
+
+
+if __name__ == '__main__':
+    unittest.main()
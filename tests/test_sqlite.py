@@ -0,0 +1,74 @@
+# Retort - Simple Python CGI framework.
+# Copyright (C) 2016 Dario Giovannetti <dev@dariogiovannetti.net>
+#
+# This file is part of Retort.
+#
+# Retort is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# Retort is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with Retort.  If not, see <http://www.gnu.org/licenses/>.
+
+from __future__ import (absolute_import, division,
+                        print_function, unicode_literals)
+
+import os
+import shutil
+import tempfile
+import unittest
+
+from retort import sqlite
+from retort.cache import SQLiteCache
+from retort.session import TokenSQLiteSession
+
+
+class CreateDatabaseTest(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+
+    def tearDown(self):
+        sqlite.close_all()
+        shutil.rmtree(self.directory)
+
+    def assertPragma(self, db_path, name, value):
+        conn = sqlite.connect(db_path)
+        self.assertEqual('{0}'.format(conn.execute(
+                        'PRAGMA {0}'.format(name)).fetchone()[0]).lower(),
+                         value)
+
+    def test_cache(self):
+        db_path = os.path.join(self.directory, 'cache.db')
+        SQLiteCache(db_path).create_db_table()
+        # INCREMENTAL
+        self.assertPragma(db_path, 'auto_vacuum', '2')
+        self.assertPragma(db_path, 'journal_mode', 'wal')
+
+    def test_sessions(self):
+        db_path = os.path.join(self.directory, 'sessions.db')
+        TokenSQLiteSession(db_path, 'example.com', 3600).create_db_table()
+        # FULL
+        self.assertPragma(db_path, 'auto_vacuum', '1')
+        self.assertPragma(db_path, 'journal_mode', 'wal')
+
+    def test_sweep_frees_pages(self):
+        db_path = os.path.join(self.directory, 'cache.db')
+        cache = SQLiteCache(db_path, max_entries=10, sweep_probability=0)
+        cache.create_db_table()
+        cache.set_dict(dict(('key{0}'.format(index), 'x' * 4000)
+                            for index in range(200)))
+        conn = sqlite.connect(db_path)
+        pages = conn.execute('PRAGMA page_count').fetchone()[0]
+        cache.sweep()
+        self.assertTrue(conn.execute('PRAGMA page_count').fetchone()[0] <
+                        pages // 2)
+
+
+if __name__ == '__main__':
+    unittest.main()
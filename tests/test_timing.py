@@ -0,0 +1,88 @@
+# Retort - Simple Python CGI framework.
+# Copyright (C) 2016 Dario Giovannetti <dev@dariogiovannetti.net>
+#
+# This file is part of Retort.
+#
+# Retort is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# Retort is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with Retort.  If not, see <http://www.gnu.org/licenses/>.
+
+from __future__ import (absolute_import, division,
+                        print_function, unicode_literals)
+
+import io
+import os
+import re
+import sys
+import unittest
+import subprocess
+
+from retort import Retort
+from retort.gateway import StreamGateway
+from retort.route import RouteExact
+from retort.timing import Timing
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def serve(app, url):
+    out = io.BytesIO()
+    app._serve(StreamGateway({'PATH_INFO': url, 'REQUEST_METHOD': 'GET'},
+                             None, out))
+    return out.getvalue().decode('utf-8').partition('\r\n\r\n')[0]
+
+
+class TimingTest(unittest.TestCase):
+    def test_server_timing(self):
+        app = Retort(routes=[RouteExact('/', lambda app: 'body')],
+                     timing=Timing())
+        headers = serve(app, '/').split('\r\n')
+        values = [header[len('Server-Timing: '):] for header in headers
+                  if header.startswith('Server-Timing: ')]
+        self.assertEqual(len(values), 1)
+        metrics = values[0].split(', ')
+        for metric in metrics:
+            self.assertTrue(re.match(r'^[a-z_]+;dur=\d+\.\d{3}$', metric),
+                            metric)
+        self.assertEqual([metric.partition(';')[0] for metric in metrics],
+                         ['dispatch', 'session', 'handler', 'session_save',
+                          'response', 'total'])
+
+    def test_no_server_timing(self):
+        app = Retort(routes=[RouteExact('/', lambda app: 'body')],
+                     timing=Timing(server_timing=False))
+        self.assertFalse('Server-Timing' in serve(app, '/'))
+
+    def test_not_imported(self):
+        # Run in a new interpreter, since this module imports retort.timing
+        code = '''
+import io, sys
+from retort import Retort
+from retort.gateway import StreamGateway
+from retort.route import RouteExact
+app = Retort(routes=[RouteExact('/', lambda app: 'body')])
+app._serve(StreamGateway({'PATH_INFO': '/', 'REQUEST_METHOD': 'GET'},
+                         None, io.BytesIO()))
+print('retort.timing' in sys.modules)
+'''
+        env = dict(os.environ)
+        env['PYTHONPATH'] = os.pathsep.join(filter(None, (
+                                    ROOT, env.get('PYTHONPATH'))))
+        process = subprocess.Popen([sys.executable, '-c', code], env=env,
+                                   stdout=subprocess.PIPE)
+        output = process.communicate()[0]
+        self.assertEqual(process.returncode, 0)
+        self.assertEqual(output.strip(), b'False')
+
+
+if __name__ == '__main__':
+    unittest.main()